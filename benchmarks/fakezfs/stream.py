@@ -0,0 +1,124 @@
+# Synthetic zfs send streams of the fake zfs server (see zfs in this directory).
+# The streams are valid for snapdump.zstream and zstreamdump, record checksums and END checksums
+# included, and deterministic:
+# the blocks of a full stream depend on the dataset name only, so consecutive full dumps carry the same
+# data, and an incremental stream carries changed_fraction of the blocks, new for every snapshot.
+# ratio is the incompressible fraction of each block, the rest is zeros.
+# The data comes from a pool of distinct blocks, the fletcher-4 checksum of each pool block is
+# computed once and combined into the running checksum of the stream in constant time, so streams
+# of tens of GB are generated at pipe speed.
+import hashlib
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from snapdump.zstream import CHECKSUM_OFFSET, DMU_BACKUP_MAGIC, RECORD_SIZE, Fletcher4  # noqa: E402
+
+MASK64 = (1 << 64) - 1
+BLOCK_SIZE = 128 * 1024
+DRR_BEGIN, DRR_OBJECT, DRR_WRITE, DRR_END = 0, 1, 3, 5
+# DMU_BACKUP_FEATURE_LARGE_BLOCKS and friends are not needed by the readers
+VERSIONINFO = (1 << 2) | 1
+
+
+def guid_of(name):
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], "little") or 1
+
+
+# fletcher-4 state after data of n_words words with checksum block_state (from a zero state)
+# following a stream with checksum state
+def combine(state, block_state, n_words):
+    a, b, c, d = state
+    sa, sb, sc, sd = block_state
+    n = n_words
+    t2 = n * (n + 1) // 2
+    t3 = n * (n + 1) * (n + 2) // 6
+    return (
+        (a + sa) & MASK64,
+        (b + n * a + sb) & MASK64,
+        (c + n * b + t2 * a + sc) & MASK64,
+        (d + n * c + t2 * b + t3 * a + sd) & MASK64,
+    )
+
+
+# pool_size distinct blocks and their checksums
+class BlockPool:
+    def __init__(self, seed, ratio, pool_size):
+        self.blocks = []
+        for index in range(pool_size):
+            size = int(BLOCK_SIZE * ratio) // 4 * 4
+            data = random.Random(f"{seed}:{index}").randbytes(size) + bytes(BLOCK_SIZE - size)
+            checksum = Fletcher4()
+            checksum.update(data)
+            self.blocks.append((data, checksum.state))
+
+    def block(self, index):
+        # a stride that is prime to the pool size spreads neighbouring blocks over the pool
+        return self.blocks[(index * 7919) % len(self.blocks)]
+
+
+class StreamWriter:
+    def __init__(self, out):
+        self.out = out
+        self.checksum = Fletcher4()
+
+    def record(self, drr_type, body, payload=None, payload_state=None):
+        header = (struct.pack("<II", drr_type, 0) + body).ljust(CHECKSUM_OFFSET, b"\0")
+        self.checksum.update(header)
+        tail = struct.pack("<4Q", *self.checksum.state)
+        self.checksum.update(tail)
+        self.out.write(header + tail)
+        if payload is not None:
+            self.checksum.state = combine(self.checksum.state, payload_state, len(payload) // 4)
+            self.out.write(payload)
+
+    def begin(self, toguid, fromguid, toname):
+        body = struct.pack("<QQQIIQQ", DMU_BACKUP_MAGIC, VERSIONINFO, 0, 2, 0, toguid, fromguid)
+        record = (struct.pack("<II", DRR_BEGIN, 0) + body + toname.encode()).ljust(RECORD_SIZE, b"\0")
+        # the name runs over the checksum field of BEGIN records, it is not checksummed
+        self.checksum.update(record)
+        self.out.write(record)
+
+    def end(self, toguid):
+        record = struct.pack("<II4QQ", DRR_END, 0, *self.checksum.state, toguid)
+        self.out.write(record.ljust(RECORD_SIZE, b"\0"))
+        self.checksum.reset()
+
+
+# returns the number of blocks of a stream
+def stream_blocks(size, incremental, changed_fraction):
+    blocks = max(1, size // BLOCK_SIZE)
+    if incremental:
+        blocks = max(1, int(blocks * changed_fraction))
+    return blocks
+
+
+# bytes of a stream, for zfs send -nvP
+def stream_size(size, incremental, changed_fraction):
+    return RECORD_SIZE * 3 + stream_blocks(size, incremental, changed_fraction) * (
+        RECORD_SIZE + BLOCK_SIZE
+    )
+
+
+def generate(out, dataset, snapshot, base, size, ratio, changed_fraction, pool_size):
+    toguid = guid_of(f"{dataset}@{snapshot}")
+    fromguid = guid_of(f"{dataset}@{base}") if base is not None else 0
+    incremental = base is not None
+    pool = BlockPool(f"{dataset}@{snapshot}" if incremental else dataset, ratio, pool_size)
+    blocks = stream_blocks(size, incremental, changed_fraction)
+    # the changed blocks of an incremental stream are spread over the dataset
+    stride = max(1, (size // BLOCK_SIZE) // blocks) if incremental else 1
+
+    writer = StreamWriter(out)
+    writer.begin(toguid, fromguid, f"{dataset}@{snapshot}")
+    # object 1, a plain file with 128K blocks
+    writer.record(DRR_OBJECT, struct.pack("<QIIIIBBBBIQ", 1, 19, 44, BLOCK_SIZE, 0, 7, 0, 1, 0, 0, toguid))
+    for index in range(blocks):
+        data, state = pool.block(index * stride)
+        offset = index * stride * BLOCK_SIZE
+        body = struct.pack("<QIIQQQBBB5x", 1, 19, 0, offset, BLOCK_SIZE, toguid, 7, 0, 0)
+        writer.record(DRR_WRITE, body, data, state)
+    writer.end(toguid)
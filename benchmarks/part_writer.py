@@ -0,0 +1,109 @@
+# Throughput of the dump part writer against split.
+# A child process writes --size bytes of random data to a pipe, which is split into parts of
+# --part-size bytes in --dir by:
+#   split : split -b PART_SIZE -a3 (the part writer of older snapdump versions)
+#   writer-N : snapdump.parts.PartWriter with N writes in flight, reading the pipe into its buffers
+#              like the dump pipeline does
+# PartWriter fsyncs every part and split does not, split is also measured followed by a sync of the
+# parts to compare the durable throughput.
+#
+#   python benchmarks/part_writer.py --dir /mnt/backup/bench --size 4G --part-size 1G
+import argparse
+import os
+import shutil
+import sys
+import time
+from subprocess import PIPE, Popen, check_call
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snapdump.cli import parse_size  # noqa: E402
+from snapdump.parts import PartWriter  # noqa: E402
+from snapdump.pipeline import PUMP_CHUNK_SIZE  # noqa: E402
+
+# writes argv[1] bytes of a random block repeated to stdout
+SOURCE = """
+import os, sys
+size = int(sys.argv[1])
+block = memoryview(os.urandom(4 * 1024 * 1024))
+while size > 0:
+    size -= os.write(1, block[: min(size, len(block))])
+"""
+
+
+def source(size):
+    # like the compressor output of a dump, chunks larger than the buffer of the pipe are read
+    # straight into the buffers of the writer
+    return Popen([sys.executable, "-c", SOURCE, str(size)], stdout=PIPE)
+
+
+def wait_source(src):
+    src.stdout.close()
+    if src.wait() != 0:
+        raise Exception(f"The source exited with {src.returncode}")
+
+
+def run_split(directory, size, part_size, sync):
+    src = source(size)
+    check_call(["split", "-b", str(part_size), "-a3", "-", f"{directory}/part-"], stdin=src.stdout)
+    wait_source(src)
+    if sync:
+        for name in os.listdir(directory):
+            fd = os.open(f"{directory}/{name}", os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+
+
+def run_writer(directory, size, part_size, in_flight):
+    src = source(size)
+    writer = PartWriter(
+        f"{directory}/part-", part_size, in_flight=in_flight, buffer_size=PUMP_CHUNK_SIZE
+    )
+    while True:
+        view = writer.buffer()
+        n = src.stdout.readinto(view)
+        if not n:
+            break
+        writer.commit(n)
+    writer.close()
+    wait_source(src)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Part writer throughput")
+    parser.add_argument("--dir", default="/tmp/snapdump-bench", help="Directory the parts are written to")
+    parser.add_argument("--size", default="2G", help="Bytes of the stream")
+    parser.add_argument("--part-size", default="256M", help="Bytes of a part")
+    parser.add_argument("--in-flight", default="1,4", help="Writes in flight of the writer runs")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each variant, the best is shown")
+    args = parser.parse_args()
+    size = parse_size(args.size)
+    part_size = parse_size(args.part_size)
+
+    variants = [
+        ("split", lambda d: run_split(d, size, part_size, False)),
+        ("split+fsync", lambda d: run_split(d, size, part_size, True)),
+    ]
+    for in_flight in (int(x) for x in args.in_flight.split(",")):
+        variants.append(
+            (f"writer-{in_flight}", lambda d, n=in_flight: run_writer(d, size, part_size, n))
+        )
+
+    print(f"{size / (1024 * 1024):.0f} MB in parts of {part_size / (1024 * 1024):.0f} MB to {args.dir}")
+    for name, run in variants:
+        best = None
+        for _ in range(args.repeat):
+            directory = f"{args.dir}/{name}"
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            start = time.perf_counter()
+            run(directory)
+            elapsed = time.perf_counter() - start
+            shutil.rmtree(directory)
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:<14} {size / best / (1024 * 1024):8.1f} MB/s ({best:.2f} seconds)")
+    shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# End to end benchmarks of snapdump against a local fake zfs server (benchmarks/fakezfs).
+# The fake ssh runs the remote commands locally, the fake zfs serves deterministic synthetic send
+# streams (--ratio incompressible, --changed of the blocks in incremental streams) and keeps the
+# snapshots in a state file.
+# For each dataset size a new backup directory and fake server are created, the server starts with
+# --snapshots snapshots of the dataset spread over twice the retention, and the commands are timed:
+#   backup_full, backup_incr (--incrementals runs), verify (local, the whole chain),
+#   verify_remote (zstreamdump on the server), restore (the whole chain), list, cleanup
+# With --servers the dataset is backed up from several fake servers (the servers list) in one run,
+# backup, list and cleanup run on all of them and the other commands on the first one.
+# The stages of each command are taken from its metrics report. The results are written as JSON
+# (--output) and --compare prints the change against the results of an earlier run, it exits with 1
+# if a command got slower by more than --threshold.
+#
+#   python benchmarks/suite.py --sizes 64M,1G,20G --snapshots 5000 --output results-1.0.7.json
+#   python benchmarks/suite.py --sizes 64M,1G,20G --snapshots 5000 --compare results-1.0.7.json
+#   python benchmarks/suite.py --sizes 1G --servers 4 --set backup.max_parallel=4
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from snapdump.cli import TIME_FORMAT, parse_size  # noqa: E402
+
+FAKE_BIN = f"{REPO}/benchmarks/fakezfs/bin"
+DATASET = "bench/data"
+RESTORE_DATASET = "bench/restore"
+RETENTION_DAYS = 90
+# the stage whose bytes are the stream bytes of an operation
+STREAM_STAGES = {"backup": "send", "restore": "recv", "verify": "parse"}
+STAGE_FIELDS = ["bytes", "wall_seconds", "cpu_seconds", "stall_seconds", "idle_seconds", "throttled_seconds"]
+
+
+def get_version():
+    try:
+        out = subprocess.check_output(
+            ["git", "-C", REPO, "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL
+        )
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# sets a dotted key of the config, the value is parsed as JSON if it can be
+def set_option(conf, option):
+    key, _, value = option.partition("=")
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    node = conf
+    names = key.split(".")
+    for name in names[:-1]:
+        node = node.setdefault(name, {})
+    node[names[-1]] = value
+
+
+def write_config(args, work_dir):
+    conf = {
+        "server": {
+            "hostname": "bench",
+            "ssh_user": "root",
+            "identity_file": None,
+            "ssh_options": None,
+            "command_timeout": 0,
+        },
+        "backup": {
+            "directory": f"{work_dir}/backups",
+            "datasets": [DATASET],
+            "interval_days": {"full": 30, "incremental": 0},
+            "retention_days": RETENTION_DAYS,
+            "split_size": args.split_size,
+            "dump_dead_seconds": 60,
+            "compression": {"codec": args.codec},
+            "store": args.store,
+        },
+        "verify": {"mode": "local"},
+        "metrics": {"report_file": f"{work_dir}/report.json"},
+    }
+    if args.servers > 1:
+        del conf["backup"]["datasets"]
+        conf["servers"] = [
+            {"hostname": server, "datasets": [DATASET]} for server in get_servers(args)
+        ]
+    for option in args.set:
+        set_option(conf, option)
+    # JSON is YAML
+    path = f"{work_dir}/config.yml"
+    with open(path, "w") as f:
+        json.dump(conf, f, indent=2)
+    return path
+
+
+def get_servers(args):
+    if args.servers == 1:
+        return ["bench"]
+    return [f"bench{index + 1}" for index in range(args.servers)]
+
+
+# the fake server starts with count snapshots of the dataset, the older half past retention
+def write_state(path, count):
+    now = time.time()
+    span = 2 * RETENTION_DAYS * 24 * 3600
+    snapshots = []
+    for index in range(count):
+        creation = now - span + span * index / max(1, count)
+        name = datetime.utcfromtimestamp(creation).strftime(TIME_FORMAT)
+        if len(snapshots) > 0 and snapshots[-1]["name"] == name:
+            continue
+        snapshots.append({"name": name, "guid": index + 1, "creation": creation})
+    with open(path, "w") as f:
+        json.dump({DATASET: snapshots}, f)
+
+
+def latest_snapshot(state_path):
+    with open(state_path) as f:
+        return json.load(f)[DATASET][-1]["name"]
+
+
+# snapshot names have a one second resolution
+def wait_next_second():
+    time.sleep(1 - time.time() % 1 + 0.01)
+
+
+# sums the stages of the runs of a report by stage name
+def sum_stages(report_path):
+    stages = {}
+    if not os.path.exists(report_path):
+        return stages
+    with open(report_path) as f:
+        report = json.load(f)
+    for run in report["runs"]:
+        for name, stage in run["stages"].items():
+            total = stages.setdefault(name, dict.fromkeys(STAGE_FIELDS, 0))
+            for field in STAGE_FIELDS:
+                total[field] += stage.get(field, 0)
+    for total in stages.values():
+        for field in STAGE_FIELDS[1:]:
+            total[field] = round(total[field], 3)
+    return stages
+
+
+def run_snapdump(config, env, report_path, command):
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, f"{REPO}/bin/snapdump", "-c", config] + command,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise Exception(
+            f"snapdump {' '.join(command)} failed with {process.returncode} :\n"
+            + process.stderr.decode(errors="replace")
+        )
+    return seconds, sum_stages(report_path)
+
+
+def result(size, operation, seconds, stages):
+    stream_stage = STREAM_STAGES.get(operation.split("_")[0])
+    stream_bytes = stages.get(stream_stage, {}).get("bytes", 0)
+    return {
+        "size": size,
+        "operation": operation,
+        "seconds": round(seconds, 3),
+        "stream_bytes": stream_bytes,
+        "mb_per_second": round(stream_bytes / max(seconds, 0.001) / (1024 * 1024), 1),
+        "stages": stages,
+    }
+
+
+def run_size(args, size):
+    work_dir = f"{args.work_dir}/{size}"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    config = write_config(args, work_dir)
+    servers = get_servers(args)
+    for server in servers:
+        write_state(f"{work_dir}/state-{server}.json", args.snapshots)
+    # the commands that are not run on all the servers run on the first one
+    state = f"{work_dir}/state-{servers[0]}.json"
+    first = [] if args.servers == 1 else ["--server", servers[0]]
+    report = f"{work_dir}/report.json"
+    env = dict(os.environ)
+    env.update(
+        PATH=f"{FAKE_BIN}:{env['PATH']}",
+        PYTHONPATH=REPO,
+        SNAPDUMP_FAKE_STATE=f"{work_dir}/state-{{host}}.json",
+        SNAPDUMP_FAKE_SIZE=str(size),
+        SNAPDUMP_FAKE_RATIO=str(args.ratio),
+        SNAPDUMP_FAKE_CHANGED=str(args.changed),
+        SNAPDUMP_FAKE_HANDSHAKE=str(args.handshake),
+    )
+
+    def run(operation, command):
+        seconds, stages = run_snapdump(config, env, report, command)
+        results.append(result(size, operation, seconds, stages))
+        print(
+            f"{size / (1024 * 1024):10.0f} MB {operation:<14} {seconds:8.2f} s"
+            f" {results[-1]['mb_per_second']:8.1f} MB/s",
+            flush=True,
+        )
+
+    results = []
+    wait_next_second()
+    run("backup_full", ["backup", "--no-verify"])
+    for _ in range(args.incrementals):
+        wait_next_second()
+        run("backup_incr", ["backup", "--no-verify"])
+    snapshot = f"{DATASET}@{latest_snapshot(state)}"
+    run("verify", first + ["verify", "-s", snapshot, "--full", "--mode", "local"])
+    run("verify_remote", first + ["verify", "-s", snapshot, "--mode", "remote"])
+    run("restore", first + ["restore", "-s", snapshot, "-d", RESTORE_DATASET])
+    run("list", ["list"])
+    run("cleanup", ["cleanup"])
+    if not args.keep:
+        shutil.rmtree(work_dir)
+    return results
+
+
+# prints the change of the seconds of each command against an earlier run.
+# returns the number of commands slower by more than threshold
+def compare(results, path, threshold):
+    with open(path) as f:
+        before = json.load(f)
+    old = {(x["size"], x["operation"]): x for x in before["results"]}
+    print(f"Compared to {path} ({before['snapdump']}) :")
+    regressions = 0
+    seen = set()
+    for new in results:
+        key = (new["size"], new["operation"])
+        if key not in old or key in seen:
+            continue
+        seen.add(key)
+        change = new["seconds"] / max(old[key]["seconds"], 0.001) - 1
+        slower = change > threshold
+        regressions += slower
+        print(
+            f"{new['size'] / (1024 * 1024):10.0f} MB {new['operation']:<14} "
+            f"{old[key]['seconds']:8.2f} s -> {new['seconds']:8.2f} s {change * 100:+7.1f}%"
+            + (" SLOWER" if slower else "")
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="snapdump benchmarks against a fake zfs server")
+    parser.add_argument("--sizes", default="64M,1G", help="Bytes of the full streams, comma separated")
+    parser.add_argument("--snapshots", type=int, default=1000, help="Snapshots on the server")
+    parser.add_argument("--incrementals", type=int, default=2, help="Incremental dumps after the full")
+    parser.add_argument("--ratio", type=float, default=0.5, help="Incompressible fraction of the data")
+    parser.add_argument("--changed", type=float, default=0.1, help="Fraction of the blocks in incrementals")
+    parser.add_argument("--servers", type=int, default=1, help="Fake servers backed up in one run")
+    parser.add_argument("--handshake", type=float, default=0.05, help="Seconds of an ssh handshake")
+    parser.add_argument("--codec", default="zstd", help="Compression codec of the dumps")
+    parser.add_argument("--store", default="parts", help="Store of the dumps (parts or chunks)")
+    parser.add_argument("--split-size", default="1G", help="Part size of the dumps")
+    parser.add_argument(
+        "--set", action="append", default=[], help="Config option, for example backup.writes_in_flight=4"
+    )
+    parser.add_argument("--work-dir", default="/tmp/snapdump-suite", help="Directory of the backups")
+    parser.add_argument("--keep", action="store_true", help="Keep the backups of each size")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown reported as a regression")
+    args = parser.parse_args()
+
+    report = {
+        "snapdump": get_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "started": int(time.time()),
+        "parameters": vars(args),
+        "results": [],
+    }
+    for size in (parse_size(x) for x in args.sizes.split(",")):
+        report["results"] += run_size(args, size)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    if args.compare is not None and compare(report["results"], args.compare, args.threshold) > 0:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
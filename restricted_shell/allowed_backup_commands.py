@@ -1,11 +1,15 @@
 #!/usr/local/bin/python
 
+import json
 import os
 import re
+import shlex
 import sys
 import subprocess
 
 datasets = ["storage/home", "storage/datasets01"]
+# roots of the trees backed up recursively (backup.recursive), the root and all its children are managed
+recursive_datasets = ["storage/vms"]
 
 
 def denied():
@@ -18,14 +22,61 @@ if "SSH_ORIGINAL_COMMAND" not in os.environ:
 
 cmd = os.environ["SSH_ORIGINAL_COMMAND"]
 
+# dataset names, children of recursive datasets are often named like vm-101-disk-0
+DATASET = r"\w[\w/.:-]*"
+
 # read only, can take arbitrary flags
-re_list = re.compile(r"^zfs list( -\w( [\w/_-]+)?)*$")
+re_list = re.compile(r"^zfs list( -\w( [\w/.:_-]+)?)*$")
 
-# work 	exactly on one snapshot and does not take any additional flags
-re_snap_ops = re.compile(r"^zfs (snapshot|destroy) ([\w/]+)@([\w]+)$")
-re_send = re.compile(r"^zfs send ([\w/]+)@([\w]+)( -i [\w]+)?$")
-re_recv = re.compile(r"^zfs recv -F ([\w/]+)$")
+# work 	exactly on one snapshot and does not take any additional flags,
+# snapshot -r takes the snapshot of a recursive dataset and all its children atomically
+re_snap_ops = re.compile(r"^zfs (snapshot)( -r)? (" + DATASET + r")@([\w]+)$")
+# destroy takes a comma separated list of snapshots and snapshot ranges (first%last) of one dataset,
+# -nvp only shows what would be destroyed
+re_destroy = re.compile(
+    r"^zfs destroy( -nvp)? (" + DATASET + r")@([\w]+(%[\w]+)?(,[\w]+(%[\w]+)?)*)$"
+)
+# send can be compressed (-c) or raw (-w), -nvP only estimates the stream size.
+# incrementals are sent from a snapshot or from a bookmark (dataset#name, quoted in pipelines)
+BOOKMARK = DATASET + r"#[\w]+"
+re_send = re.compile(
+    r"^zfs send( -nvP)?( -[cw])? (" + DATASET + r")@([\w]+)"
+    + r"( -i ([\w]+|" + BOOKMARK + "|'" + BOOKMARK + "'))?$"
+)
+# bookmark of a dumped snapshot, with the name of the snapshot
+re_bookmark = re.compile(r"^zfs bookmark (" + DATASET + r")@([\w]+) (" + DATASET + r")#([\w]+)$")
+# destroy takes a single bookmark
+re_destroy_bookmark = re.compile(r"^zfs destroy (" + DATASET + r")#([\w]+)$")
+re_recv = re.compile(r"^zfs recv -F( -u)? (" + DATASET + r")$")
 zstreamdump = re.compile(r"^zstreamdump$")
+# remote compression runs a compressor after zfs send and a decompressor before zfs recv or zstreamdump
+# (see backup.compression.at), the pipeline is executed without a shell.
+# only the flags snapdump sends are allowed (levels, threads, quiet, stdout and decompress)
+re_codec = re.compile(r"^(gzip|gunzip|pigz|zstd|lz4)( (-[dcq]|-T\d+|-\d+|--ultra|-p \d+))*$")
+agent_cmd = re.compile(r"^snapdump-agent$")
+
+# agent mode (snapdump-agent) : a JSON batch of operations is read from stdin, each operation is
+# checked against the datasets allow-list and executed without a shell, the results are written
+# to stdout as JSON. an operation that fails does not stop the others.
+#   {"op": "list", "dataset": "storage/home"}
+#       snapshots with their guid, createtxg, used bytes and creation time, in creation order
+#   {"op": "snapshot", "dataset": "storage/home", "snapshot": "2018_12_14__00_23_58"}
+#   {"op": "destroy", "dataset": "storage/home", "snapshots": "a%b,c", "dry_run": false}
+#       dry_run returns the number of bytes that would be reclaimed
+#   {"op": "send", "dataset": "storage/home", "snapshot": "b", "base": "a", "flags": "-c"}
+#       the estimated size of the stream, streams are sent with zfs send commands
+re_name = re.compile(r"^[\w]+$")
+re_destroy_spec = re.compile(r"^[\w]+(%[\w]+)?(,[\w]+(%[\w]+)?)*$")
+LIST_PROPERTIES = ["name", "guid", "createtxg", "used", "creation"]
+
+
+# a recursive dataset or one of its children
+def is_recursive(a_dataset):
+    return any(a_dataset == x or a_dataset.startswith(f"{x}/") for x in recursive_datasets)
+
+
+def is_managed(a_dataset):
+    return a_dataset in datasets or is_recursive(a_dataset)
 
 
 def unsupported_dataset_error(a_dataset):
@@ -36,24 +87,161 @@ def unsupported_dataset_error(a_dataset):
 
 
 def execute(a_cmd):
-    subprocess.call(a_cmd, shell=True)
+    # the commands are validated above, they do not need a shell
+    args = shlex.split(a_cmd)
+    os.execvp(args[0], args)
+
+
+def execute_pipeline(a_cmds):
+    first = subprocess.Popen(shlex.split(a_cmds[0]), stdout=subprocess.PIPE)
+    second = subprocess.Popen(shlex.split(a_cmds[1]), stdin=first.stdout)
+    first.stdout.close()
+    ret = second.wait()
+    if first.wait() != 0:
+        ret = first.returncode
+    sys.exit(ret)
+
+
+def allowed_send(a_cmd):
+    m = re_send.match(a_cmd)
+    if m is None:
+        return False
+    if not is_managed(m.group(3)):
+        unsupported_dataset_error(m.group(3))
+    return True
+
+
+def agent_check(op, key, regex):
+    value = op.get(key)
+    if not isinstance(value, str) or not regex.match(value):
+        raise Exception(f"Invalid {key} '{value}'")
+    return value
+
+
+def agent_dataset(op):
+    dataset = op.get("dataset")
+    if not is_managed(dataset):
+        raise Exception(f"{dataset} is not in the list of managed datasets")
+    return dataset
+
+
+def agent_zfs(args):
+    ret = subprocess.run(["zfs"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+        raise Exception(ret.stderr.decode().strip())
+    return [line.split("\t") for line in ret.stdout.decode().splitlines() if len(line) > 0]
+
 
+def agent_op(op):
+    name = op.get("op")
+    if name == "list":
+        dataset = agent_dataset(op)
+        lines = agent_zfs(
+            ["list", "-H", "-p", "-t", "snapshot", "-o", ",".join(LIST_PROPERTIES)]
+            + ["-s", "createtxg", "-d", "1", dataset]
+        )
+        snapshots = []
+        for fields in lines:
+            snapshot = dict(zip(LIST_PROPERTIES, fields))
+            for key in ["createtxg", "used", "creation"]:
+                snapshot[key] = int(snapshot[key])
+            snapshots.append(snapshot)
+        return {"snapshots": snapshots}
+    elif name == "snapshot":
+        dataset = agent_dataset(op)
+        snapshot = agent_check(op, "snapshot", re_name)
+        agent_zfs(["snapshot", f"{dataset}@{snapshot}"])
+        return {}
+    elif name == "destroy":
+        dataset = agent_dataset(op)
+        spec = agent_check(op, "snapshots", re_destroy_spec)
+        if op.get("dry_run", False):
+            lines = agent_zfs(["destroy", "-nvp", f"{dataset}@{spec}"])
+            return {"reclaim": sum(int(x[1]) for x in lines if x[0] == "reclaim")}
+        agent_zfs(["destroy", f"{dataset}@{spec}"])
+        return {}
+    elif name == "send":
+        dataset = agent_dataset(op)
+        snapshot = agent_check(op, "snapshot", re_name)
+        args = ["send", "-nvP"]
+        flags = op.get("flags")
+        if flags is not None:
+            if flags not in ["-c", "-w"]:
+                raise Exception(f"Invalid flags '{flags}'")
+            args.append(flags)
+        args.append(f"{dataset}@{snapshot}")
+        if op.get("base") is not None:
+            args += ["-i", agent_check(op, "base", re_name)]
+        lines = agent_zfs(args)
+        return {"size": int([x for x in lines if x[0] == "size"][0][1])}
+    raise Exception(f"Unsupported operation '{name}'")
 
-if zstreamdump.match(cmd) or re_list.match(cmd):
+
+def agent():
+    try:
+        request = json.loads(sys.stdin.read())
+        ops = request["ops"]
+    except (ValueError, KeyError, TypeError):
+        print("Invalid agent request")
+        sys.exit(1)
+    results = []
+    for op in ops:
+        try:
+            results.append(dict(agent_op(op), ok=True))
+        except Exception as err:
+            results.append({"ok": False, "error": str(err)})
+    print(json.dumps({"results": results}))
+
+
+if agent_cmd.match(cmd):
+    agent()
+elif len(cmd.split(" | ")) == 2:
+    cmds = cmd.split(" | ")
+    if allowed_send(cmds[0]) and re_codec.match(cmds[1]):
+        execute_pipeline(cmds)
+    elif re_codec.match(cmds[0]) and (re_recv.match(cmds[1]) or zstreamdump.match(cmds[1])):
+        execute_pipeline(cmds)
+    else:
+        denied()
+elif zstreamdump.match(cmd) or re_list.match(cmd):
     execute(cmd)
 elif re_snap_ops.match(cmd):
     m = re_snap_ops.match(cmd)
     op = m.group(1)
+    recursive = m.group(2) is not None
+    dataset = m.group(3)
+    snapshot = m.group(4)
+    if is_recursive(dataset) or (not recursive and is_managed(dataset)):
+        execute(cmd)
+    else:
+        unsupported_dataset_error(dataset)
+elif re_destroy.match(cmd):
+    m = re_destroy.match(cmd)
     dataset = m.group(2)
-    snapshot = m.group(3)
-    if dataset in datasets:
+    if is_managed(dataset):
+        execute(cmd)
+    else:
+        unsupported_dataset_error(dataset)
+elif re_bookmark.match(cmd):
+    m = re_bookmark.match(cmd)
+    dataset = m.group(1)
+    if m.group(3) != dataset or m.group(4) != m.group(2):
+        denied()
+    elif is_managed(dataset):
+        execute(cmd)
+    else:
+        unsupported_dataset_error(dataset)
+elif re_destroy_bookmark.match(cmd):
+    m = re_destroy_bookmark.match(cmd)
+    dataset = m.group(1)
+    if is_managed(dataset):
         execute(cmd)
     else:
         unsupported_dataset_error(dataset)
 elif re_send.match(cmd):
     m = re_send.match(cmd)
-    dataset = m.group(1)
-    if dataset in datasets:
+    dataset = m.group(3)
+    if is_managed(dataset):
         execute(cmd)
     else:
         unsupported_dataset_error(dataset)
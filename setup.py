@@ -27,5 +27,6 @@ with open("README.md", "r") as fh:
             "Programming Language :: Python :: 3",
             "License :: OSI Approved :: MIT License",
         ],
-        install_requires=["omegaconf>=1.3.0", "setuptools"],
+        install_requires=["omegaconf>=2.0", "setuptools"],
+        extras_require={"fast": ["numpy"]},
     )
@@ -0,0 +1,130 @@
+# Per dataset catalog of the dumps in a dataset directory.
+# The catalog is an append-only JSON lines file in the dataset directory, each line is one operation:
+#   {"op": "add", "directory": "group/type##snapshot", ...entry}
+#   {"op": "update", "directory": "group/type##snapshot", "fields": {...}}
+#   {"op": "remove_group", "group": "group"}
+# Appends are single writes under a lock, rewrites (compaction and reindex) write a new file and
+# atomically rename it over the old one under the same lock. A truncated last line (crash during
+# append) is ignored, the next append starts a new line after it.
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+CATALOG_FILE = "catalog.jsonl"
+
+# lockf locks are held by the process, the threads of a process (backup workers, daemon tasks)
+# also take the lock of the catalog path
+THREAD_LOCKS = {}
+THREAD_LOCKS_LOCK = threading.Lock()
+
+
+def catalog_path(dataset_dir):
+    return f"{dataset_dir}/{CATALOG_FILE}"
+
+
+def _apply(entries, record):
+    op = record.get("op")
+    if op == "add":
+        entry = dict(record)
+        del entry["op"]
+        entries[entry["directory"]] = entry
+    elif op == "update":
+        if record["directory"] in entries:
+            entries[record["directory"]].update(record["fields"])
+    elif op == "remove_group":
+        for directory in [d for d, e in entries.items() if e["group"] == record["group"]]:
+            del entries[directory]
+
+
+# returns a dict of directory -> entry, or None if the dataset has no catalog
+def read_catalog(dataset_dir):
+    path = catalog_path(dataset_dir)
+    if not os.path.exists(path):
+        return None
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # partially written line
+                continue
+            _apply(entries, record)
+    return entries
+
+
+def _thread_lock(path):
+    with THREAD_LOCKS_LOCK:
+        return THREAD_LOCKS.setdefault(path, threading.Lock())
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# opens the catalog file locked, making sure the locked file was not replaced by a rewrite
+def _open_locked(path):
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+# holds the append lock of the catalog, appends wait until a rewrite is renamed in place
+@contextmanager
+def catalog_lock(dataset_dir):
+    path = catalog_path(dataset_dir)
+    with _thread_lock(path):
+        fd = _open_locked(path)
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+
+def append_catalog(dataset_dir, records):
+    data = "".join(json.dumps(record) + "\n" for record in records).encode()
+    with _thread_lock(catalog_path(dataset_dir)):
+        fd = _open_locked(catalog_path(dataset_dir))
+        try:
+            # a crash during the previous append left a line without its newline, the records are
+            # written on a new line so only the torn one is lost
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                data = b"\n" + data
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# rewrites the catalog with the entries, must be called under catalog_lock
+def write_catalog(dataset_dir, entries):
+    path = catalog_path(dataset_dir)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        for entry in entries.values():
+            f.write(json.dumps(dict(entry, op="add")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    _fsync_dir(dataset_dir)
+
+
+# rewrites the catalog with only the live entries
+def compact_catalog(dataset_dir):
+    if not os.path.exists(catalog_path(dataset_dir)):
+        return
+    with catalog_lock(dataset_dir):
+        write_catalog(dataset_dir, read_catalog(dataset_dir))
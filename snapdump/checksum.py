@@ -0,0 +1,76 @@
+# Checksums of dump parts.
+# Parts are hashed while the dump is written (PartHasher) and re-hashed by scrub (hash_file).
+import hashlib
+
+DEFAULT_ALGORITHM = "sha256"
+ALGORITHMS = ["sha256", "blake2b", "blake3", "xxh3", "none"]
+READ_SIZE = 8 * 1024 * 1024
+
+
+def new_hash(algorithm):
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    elif algorithm == "blake2b":
+        return hashlib.blake2b()
+    elif algorithm == "blake3":
+        try:
+            import blake3
+        except ImportError:
+            raise Exception("blake3 part checksums require the blake3 module (pip install blake3)")
+        return blake3.blake3()
+    elif algorithm == "xxh3":
+        try:
+            import xxhash
+        except ImportError:
+            raise Exception("xxh3 part checksums require the xxhash module (pip install xxhash)")
+        return xxhash.xxh3_128()
+    else:
+        raise Exception(
+            f"Unsupported checksum algorithm '{algorithm}', supported algorithms : {', '.join(ALGORITHMS)}"
+        )
+
+
+# hashes a stream that is split into parts of part_size bytes, one digest per part.
+# digests are the digests of parts that were already hashed, when continuing a stream.
+class PartHasher:
+    def __init__(self, algorithm, part_size, digests=None):
+        self.algorithm = algorithm
+        self.part_size = part_size
+        self.digests = list(digests) if digests is not None else []
+        self.current = None
+        self.offset = 0
+
+    def update(self, chunk):
+        while len(chunk) > 0:
+            if self.current is None:
+                self.current = new_hash(self.algorithm)
+                self.offset = 0
+            n = min(len(chunk), self.part_size - self.offset)
+            self.current.update(chunk[:n])
+            self.offset += n
+            chunk = chunk[n:]
+            if self.offset == self.part_size:
+                self.digests.append(self.current.hexdigest())
+                self.current = None
+
+    def finish(self):
+        if self.current is not None:
+            self.digests.append(self.current.hexdigest())
+            self.current = None
+        return self.digests
+
+
+# returns (digest, size) of a file, reading it sequentially in large chunks
+def hash_file(path, algorithm, read_size=READ_SIZE):
+    h = new_hash(algorithm)
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    size = 0
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            size += n
+    return h.hexdigest(), size
@@ -0,0 +1,604 @@
+# Content defined chunk store of the dumps (backup.store: chunks).
+#
+# Every full dump sends all the blocks of a dataset again, and most of them did not change since the
+# previous one. The chunk store keeps each piece of data once per dataset:
+# the payload of the send stream (the block data that follows each 312 bytes record header) is cut
+# into chunks at content defined boundaries, each chunk is stored once in the .chunks directory of
+# the dataset under its sha256, and a dump is the list of its chunks (chunks.manifest) plus the
+# record headers of its stream (records.gz).
+# The record headers are kept apart from the chunks, they carry the guid of the snapshot and the
+# running checksum of the stream which differ in every stream even when the data does not.
+#
+# A chunk ends where the sum of the last WINDOW bytes of the chunk (each byte mapped to a fixed
+# random value) has its low bits zero, so the boundaries move with the data and a changed block only
+# changes the chunks around it. Chunks are at least average_size / 2 and at most
+# average_size * 4 bytes, average_size on average.
+# The chunks are hashed, compressed and written by a pool of threads (hashlib, zlib and zstandard
+# release the GIL), the stream is rebuilt with python -m snapdump.chunks cat, which reads the chunks
+# ahead with the same pool.
+#
+# Chunks are written while a dump holds the store lock shared, garbage collection takes it
+# exclusively and deletes the chunks that no dump of the dataset lists any more.
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from subprocess import PIPE, Popen
+
+from snapdump.dump import DumpStopped
+from snapdump.metrics import new_stages, stop_stages
+from snapdump.pipeline import PUMP_CHUNK_SIZE, ensure_clean_exit, wait_process
+from snapdump.zstream import DMU_BACKUP_MAGIC, RECORD_SIZE, StreamError, _payload_size
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STORE_DIR = ".chunks"
+STORE_FILE = "store.json"
+LOCK_FILE = "lock"
+MANIFEST_FILE = "chunks.manifest"
+RECORDS_FILE = "records.gz"
+# in-process codecs of the chunks, pigz chunks are gzip members
+CODECS = ["gzip", "zstd", "lz4", "none"]
+DEFAULT_AVERAGE_SIZE = 1024 * 1024
+MIN_AVERAGE_SIZE = 4096
+WINDOW = 64
+# bytes of payload cut into chunks at a time
+BATCH_SIZE = 16 * 1024 * 1024
+# manifest entry: sha256 and size of a chunk
+MANIFEST_ENTRY = struct.Struct("<32sI")
+
+_values = None
+_table = None
+
+
+# the value of each byte in the window sum, fixed forever: the boundaries of stored chunks depend on it
+def _gear_values():
+    global _values
+    if _values is None:
+        values = b"".join(hashlib.sha256(bytes([i])).digest()[:4] for i in range(256))
+        _values = list(struct.unpack("<256I", values))
+    return _values
+
+
+def _gear_table():
+    global _table
+    if _table is None:
+        _table = numpy.array(_gear_values(), dtype=numpy.uint32)
+    return _table
+
+
+class _Codec:
+    def __init__(self, codec, level):
+        self.codec = codec
+        self.level = level
+        self.local = threading.local()
+        if codec == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("zstd chunks require the zstandard module (pip install zstandard)")
+            self.module = zstandard
+        elif codec == "lz4":
+            try:
+                import lz4.frame
+            except ImportError:
+                raise Exception("lz4 chunks require the lz4 module (pip install lz4)")
+            self.module = lz4.frame
+        elif codec not in CODECS:
+            raise Exception(
+                f"Unsupported chunk codec '{codec}', supported codecs : {', '.join(CODECS)}"
+            )
+
+    def compress(self, data):
+        if self.codec == "gzip":
+            level = self.level if self.level is not None else 6
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        if self.codec == "zstd":
+            # compressors are not thread safe, each thread has its own
+            compressor = getattr(self.local, "compressor", None)
+            if compressor is None:
+                level = self.level if self.level is not None else 3
+                compressor = self.local.compressor = self.module.ZstdCompressor(level=level)
+            return compressor.compress(data)
+        if self.codec == "lz4":
+            return self.module.compress(data, compression_level=self.level or 0)
+        return data
+
+    def decompress(self, data):
+        if self.codec == "gzip":
+            decompressor = zlib.decompressobj(31)
+            result = decompressor.decompress(data)
+            if not decompressor.eof or decompressor.unused_data:
+                raise Exception("Invalid gzip chunk")
+            return result
+        if self.codec == "zstd":
+            return self.module.ZstdDecompressor().decompress(data)
+        if self.codec == "lz4":
+            return self.module.decompress(data)
+        return data
+
+
+# the chunk store of a dataset. settings ({"codec", "level", "average_size"}) are used to create a
+# new store, an existing store keeps the settings it was created with
+class ChunkStore:
+    def __init__(self, path, settings=None):
+        self.path = path
+        store_file = f"{path}/{STORE_FILE}"
+        if os.path.exists(store_file):
+            with open(store_file) as f:
+                self.settings = json.load(f)
+        elif settings is None:
+            raise Exception(f"Chunk store {path} does not exist")
+        else:
+            average_size = settings["average_size"]
+            if average_size < MIN_AVERAGE_SIZE or average_size & (average_size - 1) != 0:
+                raise Exception(
+                    f"Chunk average size must be a power of 2 of at least {MIN_AVERAGE_SIZE} bytes"
+                )
+            self.settings = {
+                "version": 1,
+                "codec": settings["codec"],
+                "level": settings["level"],
+                "average_size": average_size,
+            }
+            # validates the codec before the store is created
+            _Codec(self.settings["codec"], self.settings["level"])
+            os.makedirs(path, exist_ok=True)
+            with open(f"{store_file}.tmp", "w") as f:
+                json.dump(self.settings, f, indent=2)
+            os.rename(f"{store_file}.tmp", store_file)
+        self.codec = _Codec(self.settings["codec"], self.settings["level"])
+        # chunks known to be in the store, not checked on disk again
+        self.known = set()
+
+    def chunk_path(self, digest):
+        name = digest.hex()
+        return f"{self.path}/{name[:2]}/{name[2:4]}/{name}"
+
+    # holds the store lock, shared by the dumps and exclusive for garbage collection.
+    # yields False if blocking is False and the lock is not available
+    @contextmanager
+    def lock(self, exclusive=False, blocking=True):
+        with open(f"{self.path}/{LOCK_FILE}", "a") as f:
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(f, flags if blocking else flags | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # stores a chunk unless it is already there.
+    # returns (sha256, bytes written to the store, 0 for a chunk that was already stored)
+    def put(self, data):
+        digest = hashlib.sha256(data).digest()
+        if digest in self.known:
+            return digest, 0
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            self.known.add(digest)
+            return digest, 0
+        compressed = self.codec.compress(data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(compressed)
+            while len(view) > 0:
+                view = view[os.write(fd, view) :]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+        self.known.add(digest)
+        return digest, len(compressed)
+
+    # returns the data of a chunk, checked against its sha256
+    def get(self, digest):
+        path = self.chunk_path(digest)
+        try:
+            with open(path, "rb") as f:
+                compressed = f.read()
+        except FileNotFoundError:
+            raise Exception(f"Chunk {digest.hex()} is missing from {self.path}")
+        data = self.codec.decompress(compressed)
+        if hashlib.sha256(data).digest() != digest:
+            raise Exception(f"Chunk {digest.hex()} in {self.path} is corrupted")
+        return data
+
+    # returns None if the chunk is intact, the error otherwise
+    def check(self, digest):
+        path = self.chunk_path(digest)
+        if not os.path.exists(path):
+            return "missing"
+        try:
+            with open(path, "rb") as f:
+                data = self.codec.decompress(f.read())
+        except Exception as err:
+            return f"cannot decompress : {err}"
+        actual = hashlib.sha256(data).hexdigest()
+        if actual != digest.hex():
+            return f"sha256 {actual} != {digest.hex()}"
+        return None
+
+    # returns {sha256: path} of the chunks in the store
+    def list_chunks(self):
+        chunks = {}
+        for outer in os.listdir(self.path):
+            if len(outer) != 2 or not os.path.isdir(f"{self.path}/{outer}"):
+                continue
+            for inner in os.listdir(f"{self.path}/{outer}"):
+                directory = f"{self.path}/{outer}/{inner}"
+                for name in os.listdir(directory):
+                    path = f"{directory}/{name}"
+                    if name.endswith(".tmp"):
+                        # written by a dump that was killed
+                        chunks[name] = path
+                    else:
+                        chunks[bytes.fromhex(name)] = path
+        return chunks
+
+
+# cuts the payload of a stream into content defined chunks
+class Chunker:
+    def __init__(self, average_size):
+        self.min_size = average_size // 2
+        self.max_size = average_size * 4
+        # the window sum is a boundary once every average_size / 2 bytes on average.
+        # the sums wrap around at 32 bits, which does not change their low bits
+        self.mask = average_size // 2 - 1
+        self.pending = bytearray()
+
+    # returns the first position p in [lo, hi) where the window sum of data[p - WINDOW + 1 : p + 1]
+    # is a boundary, None if there is none. lo is at least WINDOW
+    def _first_boundary(self, data, lo, hi):
+        if numpy is None:
+            return self._first_boundary_python(data, lo, hi)
+        base = lo - WINDOW
+        values = _gear_table()[numpy.frombuffer(data, numpy.uint8, hi - base, base)]
+        sums = numpy.cumsum(values, dtype=numpy.uint32)
+        windows = sums[WINDOW:] - sums[:-WINDOW]
+        hits = numpy.flatnonzero((windows & numpy.uint32(self.mask)) == 0)
+        return lo + int(hits[0]) if len(hits) > 0 else None
+
+    # same boundaries without numpy, a rolling sum byte by byte, much slower
+    def _first_boundary_python(self, data, lo, hi):
+        values = _gear_values()
+        mask = self.mask
+        window = sum(values[x] for x in data[lo - WINDOW : lo])
+        for p in range(lo, hi):
+            window += values[data[p]] - values[data[p - WINDOW]]
+            if window & mask == 0:
+                return p
+        return None
+
+    # returns the end offsets of the chunks in data, with final the rest of data is the last chunk.
+    # a chunk ends after the first boundary past its min_size bytes, or at max_size bytes.
+    # only the bytes past min_size of each chunk are hashed, one average chunk at a time
+    def _cut(self, data, final):
+        ends = []
+        start = 0
+        while True:
+            end = None
+            lo = start + self.min_size - 1
+            limit = min(start + self.max_size - 1, len(data))
+            while end is None and lo < limit:
+                hi = min(lo + 2 * self.min_size, limit)
+                boundary = self._first_boundary(data, lo, hi)
+                if boundary is not None:
+                    end = boundary + 1
+                lo = hi
+            if end is None:
+                if start + self.max_size > len(data):
+                    break
+                end = start + self.max_size
+            ends.append(end)
+            start = end
+        if final and start < len(data):
+            ends.append(len(data))
+        return ends
+
+    # adds payload bytes, returns the chunks completed by them
+    def feed(self, data):
+        self.pending += data
+        if len(self.pending) < BATCH_SIZE:
+            return []
+        return self._flush(False)
+
+    # returns the remaining chunks at the end of the stream
+    def finish(self):
+        return self._flush(True)
+
+    def _flush(self, final):
+        ends = self._cut(self.pending, final)
+        chunks = []
+        start = 0
+        with memoryview(self.pending) as view:
+            for end in ends:
+                chunks.append(bytes(view[start:end]))
+                start = end
+        del self.pending[:start]
+        return chunks
+
+
+# payload sizes of the records of a send stream
+class _Records:
+    def __init__(self):
+        self.endian = None
+
+    def payload_size(self, header):
+        if self.endian is None:
+            if struct.unpack_from("<Q", header, 8)[0] == DMU_BACKUP_MAGIC:
+                self.endian = "<"
+            elif struct.unpack_from(">Q", header, 8)[0] == DMU_BACKUP_MAGIC:
+                self.endian = ">"
+            else:
+                raise StreamError("Not a zfs send stream (invalid magic)")
+        (drr_type,) = struct.unpack_from(f"{self.endian}I", header, 0)
+        return _payload_size(drr_type, header, self.endian)
+
+
+# splits a send stream into the record headers, written to records, and the payload chunks
+class _Splitter:
+    def __init__(self, records, chunker):
+        self.records = records
+        self.chunker = chunker
+        self.sizes = _Records()
+        self.header = bytearray()
+        # payload bytes left in the current record
+        self.payload = 0
+        self.payload_bytes = 0
+
+    # returns the chunks completed by data
+    def feed(self, data):
+        chunks = []
+        while len(data) > 0:
+            if self.payload > 0:
+                n = min(self.payload, len(data))
+                chunks += self.chunker.feed(data[:n])
+                self.payload -= n
+                self.payload_bytes += n
+                data = data[n:]
+                continue
+            n = min(RECORD_SIZE - len(self.header), len(data))
+            self.header += data[:n]
+            data = data[n:]
+            if len(self.header) == RECORD_SIZE:
+                self.records.write(self.header)
+                self.payload = self.sizes.payload_size(self.header)
+                self.header = bytearray()
+        return chunks
+
+    def finish(self):
+        if len(self.header) > 0 or self.payload > 0:
+            raise StreamError("Truncated zfs stream")
+        return self.chunker.finish()
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_manifest(dump_dir):
+    with open(f"{dump_dir}/{MANIFEST_FILE}", "rb") as f:
+        data = f.read()
+    return list(MANIFEST_ENTRY.iter_unpack(data))
+
+
+# Writes the output of send_cmd into the store, the manifest and the record headers go to dump_dir.
+# jobs threads hash, compress and write the chunks. The chunks of the dumps in known_dirs are taken
+# as stored without looking for them on disk (the dumps the new one most likely repeats).
+# progress, stop and throttle are the same as for dump.write_dump_stream, a stopped dump is not
+# resumed but the next dump finds its chunks stored.
+# Returns ({"codec", "count", "bytes", "new", "stored"} of the chunks, the pipeline stages)
+def write_chunked_stream(
+    send_cmd, store, dump_dir, jobs, known_dirs=(), progress=None, stop=None, throttle=None
+):
+    stages = new_stages("send", "chunk", "store")
+    send_stage, chunk_stage, store_stage = stages["send"], stages["chunk"], stages["store"]
+    summary = {"codec": store.settings["codec"], "count": 0, "bytes": 0, "new": 0, "stored": 0}
+    cpu_lock = threading.Lock()
+
+    def put(data):
+        cpu_start = time.thread_time()
+        result = store.put(data)
+        with cpu_lock:
+            store_stage.cpu_seconds += time.thread_time() - cpu_start
+        return result
+
+    # unbuffered, the manifest is written as the dump advances (see cli.is_dump_in_progress)
+    manifest = open(f"{dump_dir}/{MANIFEST_FILE}", "wb", buffering=0)
+    records = gzip.open(f"{dump_dir}/{RECORDS_FILE}", "wb", compresslevel=6)
+    splitter = _Splitter(records, Chunker(store.settings["average_size"]))
+    futures = deque()
+    # directories of the new chunks, fsynced for their renames at the end
+    directories = set()
+
+    def submit(chunks):
+        for chunk in chunks:
+            futures.append((executor.submit(put, chunk), len(chunk)))
+        # at most two chunks per thread wait to be stored
+        while len(futures) > 2 * jobs:
+            collect()
+
+    def collect():
+        future, size = futures.popleft()
+        start = time.perf_counter()
+        digest, stored = future.result()
+        store_stage.stall_seconds += time.perf_counter() - start
+        manifest.write(MANIFEST_ENTRY.pack(digest, size))
+        summary["count"] += 1
+        summary["bytes"] += size
+        if stored > 0:
+            directories.add(os.path.dirname(store.chunk_path(digest)))
+            summary["new"] += 1
+            summary["stored"] += stored
+            store_stage.bytes += stored
+
+    buf = bytearray(PUMP_CHUNK_SIZE)
+    view = memoryview(buf)
+    send = Popen(send_cmd, stdout=PIPE, bufsize=0)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    offset = 0
+    try:
+        with store.lock():
+            # under the lock, garbage collection cannot delete them
+            for known_dir in known_dirs:
+                if os.path.exists(f"{known_dir}/{MANIFEST_FILE}"):
+                    store.known.update(digest for digest, size in read_manifest(known_dir))
+            while True:
+                if stop is not None and stop.is_set():
+                    raise DumpStopped("Dump stopped, the next dump reuses the chunks stored so far")
+                start = time.perf_counter()
+                n = send.stdout.readinto(view)
+                send_stage.stall_seconds += time.perf_counter() - start
+                if n:
+                    offset += n
+                    send_stage.bytes = offset
+                    if throttle is not None:
+                        send_stage.throttled_seconds += throttle(n)
+                    if progress is not None:
+                        progress(offset)
+                start, cpu_start = time.perf_counter(), time.thread_time()
+                chunks = splitter.feed(view[:n]) if n else splitter.finish()
+                chunk_stage.stall_seconds += time.perf_counter() - start
+                chunk_stage.cpu_seconds += time.thread_time() - cpu_start
+                chunk_stage.bytes = splitter.payload_bytes
+                submit(chunks)
+                if not n:
+                    break
+            while len(futures) > 0:
+                collect()
+            send_stage.cpu_seconds += wait_process(send)
+            ensure_clean_exit(send)
+            if offset == 0:
+                # a zfs send stream is never empty, the remote command did not run
+                raise Exception(f"{' '.join(send_cmd)} did not send anything")
+            for directory in directories:
+                _fsync_path(directory)
+    except BaseException:
+        send.kill()
+        send.wait()
+        for future, size in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        records.close()
+        manifest.close()
+    for name in (MANIFEST_FILE, RECORDS_FILE):
+        _fsync_path(f"{dump_dir}/{name}")
+    stop_stages(stages)
+    return summary, stages
+
+
+# yields the data of the chunks in order, read ahead by jobs threads
+def _read_chunks(store, manifest, jobs):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = deque()
+        entries = iter(manifest)
+        try:
+            for digest, size in entries:
+                futures.append(executor.submit(store.get, digest))
+                if len(futures) > 2 * jobs:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+# writes the send stream of a chunked dump to out
+def cat_dump(store, dump_dir, out, jobs):
+    chunks = _read_chunks(store, read_manifest(dump_dir), jobs)
+    sizes = _Records()
+    current = memoryview(b"")
+    with gzip.open(f"{dump_dir}/{RECORDS_FILE}", "rb") as records:
+        while True:
+            header = records.read(RECORD_SIZE)
+            if len(header) == 0:
+                break
+            if len(header) < RECORD_SIZE:
+                raise StreamError(f"Truncated record headers in {dump_dir}")
+            out.write(header)
+            size = sizes.payload_size(header)
+            while size > 0:
+                if len(current) == 0:
+                    current = memoryview(next(chunks, b""))
+                    if len(current) == 0:
+                        raise StreamError(f"The chunks of {dump_dir} end before its records")
+                n = min(size, len(current))
+                out.write(current[:n])
+                current = current[n:]
+                size -= n
+    if len(current) > 0 or next(chunks, None) is not None:
+        raise StreamError(f"The chunks of {dump_dir} do not match its records")
+    out.flush()
+
+
+# deletes the chunks of the store that are not listed by the manifests in dump_dirs.
+# with dry_run nothing is deleted. returns (chunks, bytes) deleted, None if a dump holds the store
+def collect_garbage(store, dump_dirs, dry_run=False):
+    with store.lock(exclusive=True, blocking=False) as locked:
+        if not locked:
+            return None
+        referenced = set()
+        for dump_dir in dump_dirs:
+            if os.path.exists(f"{dump_dir}/{MANIFEST_FILE}"):
+                referenced.update(digest for digest, size in read_manifest(dump_dir))
+        count = size = 0
+        for digest, path in store.list_chunks().items():
+            if digest in referenced:
+                continue
+            count += 1
+            size += os.path.getsize(path)
+            if not dry_run:
+                os.remove(path)
+        return count, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="snapdump chunk store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    cat_parser = subparsers.add_parser("cat", help="Writes the send stream of a dump to stdout")
+    cat_parser.add_argument("store", help="Chunk store directory")
+    cat_parser.add_argument("dump_dir", help="Dump directory")
+    cat_parser.add_argument(
+        "--jobs", "-j", type=int, default=os.cpu_count(), help="Number of chunks read in parallel"
+    )
+    args = parser.parse_args()
+    try:
+        with open(sys.stdout.fileno(), "wb", buffering=PUMP_CHUNK_SIZE, closefd=False) as out:
+            cat_dump(ChunkStore(args.store), args.dump_dir, out, max(1, args.jobs))
+    except BrokenPipeError:
+        # the reader stopped, like cat
+        sys.exit(1)
+    except Exception as err:
+        print(f"snapdump.chunks: {err}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
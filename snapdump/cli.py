@@ -1,42 +1,321 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import os
 import shutil
-from subprocess import Popen, PIPE, check_output
+import signal
+import sys
+import threading
+from contextlib import ExitStack
+from subprocess import DEVNULL, CalledProcessError, Popen, PIPE
 import time
 from datetime import datetime
 import glob
-from omegaconf import OmegaConf
-import pkg_resources
+import json
 import re
+import shlex
+
+from snapdump.compression import (
+    DEFAULT_CODEC,
+    compress_cmd,
+    decompress_cmd,
+    get_compression_settings,
+    is_remote,
+)
+from snapdump.metrics import PROGRESS, REPORT, Stage, format_stages, new_stages, stop_stages
+from snapdump.prefetch import Prefetcher
+from snapdump.ratelimit import LIMITER
+from snapdump.ssh import get_control_master, close_control_masters
+from snapdump.config import default_daemon_socket, load_config, server_configs
+from snapdump.catalog import (
+    append_catalog,
+    catalog_lock,
+    compact_catalog,
+    read_catalog,
+    write_catalog,
+)
+from snapdump.checksum import DEFAULT_ALGORITHM, hash_file
+from snapdump.pipeline import (
+    ensure_clean_exit,
+    kill_pipeline,
+    reap_pipeline,
+    start_pipeline,
+    wait_process,
+)
+from snapdump.dump import (
+    CHECKPOINT_FILE,
+    DEFAULT_CHECKPOINT_SIZE,
+    DumpStopped,
+    StreamChanged,
+    read_checkpoint,
+    write_dump_stream,
+)
 
 CRON = False
 VERBOSE = False
 TIME_FORMAT = "%Y_%m_%d__%H_%M_%S"
 SNAPSHOT_SUFFIX = "snapshot-part-"
 TEMPDIR_SUFFIX = "dump-in-progress"
+METADATA_FILE = "snapdump.json"
+# datasets of the trees backed up recursively (backup.recursive), in the backup directory
+TREES_FILE = "trees.json"
+# same units as split: K, M, G.. are powers of 1024 and KB, MB, GB.. are powers of 1000
+SIZE_UNITS = "KMGTPEZY"
+# send mode -> zfs send flags
+SEND_MODES = {"plain": [], "compressed": ["-c"], "raw": ["-w"]}
+VERIFY_MODES = ["local", "remote", "both"]
+# parts : compressed parts of split_size bytes, chunks : content defined chunk store (snapdump.chunks)
+STORES = ["parts", "chunks"]
+CHUNK_STORE_DIR = ".chunks"
+DEFAULT_CHUNK_AVERAGE_SIZE = "1M"
+# maximum number of snapshots or snapshot ranges destroyed by a single zfs destroy
+DESTROY_BATCH_SIZE = 100
+
+# (kind, key) -> semaphore, shared by all backup workers
+SEMAPHORES = {}
+SEMAPHORES_LOCK = threading.Lock()
+# once set, running dumps stop at a checkpoint (daemon shutdown)
+STOP_DUMPS = threading.Event()
+# (server, dataset) -> (file system of the backup directory, bytes) reserved by an admitted dump
+# that is not done
+SPACE_RESERVED = {}
+SPACE_LOCK = threading.Lock()
+# (server, dataset) -> snapshots of the dataset listed by the agent when the backup run was planned
+SNAPSHOT_LISTS = {}
+SNAPSHOT_LISTS_LOCK = threading.Lock()
+# (server, dataset) -> bookmarks of the dataset, listed once a dumped snapshot is gone from the server
+BOOKMARK_LISTS = {}
+TREES_LOCK = threading.Lock()
 
 
 def log(msg):
     if not CRON:
+        PROGRESS.clear()
         print(msg)
 
 
+def log_error(msg):
+    PROGRESS.clear()
+    print(msg, file=sys.stderr)
+
+
+def get_semaphore(kind, key, limit):
+    with SEMAPHORES_LOCK:
+        if (kind, key) not in SEMAPHORES:
+            SEMAPHORES[(kind, key)] = threading.BoundedSemaphore(limit)
+        return SEMAPHORES[(kind, key)]
+
+
+def get_server_key(conf):
+    return f"{conf.server.ssh_user}@{conf.server.hostname}"
+
+
+# returns the configs of the servers a command runs on (see config.server_configs), all of them or
+# the server with the name or hostname name
+def get_servers(conf, name=None):
+    servers = server_configs(conf)
+    if name is None:
+        return servers
+    selected = [x for x in servers if name in (x.server.get("name", None), x.server.hostname)]
+    if len(selected) == 0:
+        names = [x.server.get("name", None) or x.server.hostname for x in servers]
+        raise Exception(f"Unknown server '{name}', servers : {', '.join(names)}")
+    return selected
+
+
+# returns the servers that back up the dataset (a dataset or a recursive root), all the servers
+# without a dataset. a single server backs up any dataset
+def get_dataset_servers(servers, dataset):
+    if dataset is None or len(servers) == 1:
+        return servers
+    selected = [x for x in servers if dataset in get_backup_units(x) + get_datasets(x)]
+    if len(selected) == 0:
+        raise Exception(f"{dataset} is not backed up from any server")
+    return selected
+
+
+# returns the server a restore or a verify of the dataset runs on
+def get_dataset_server(servers, dataset):
+    selected = get_dataset_servers(servers, dataset)
+    if len(selected) > 1:
+        names = [x.server.name for x in selected]
+        raise Exception(
+            f"{dataset} is backed up from several servers ({', '.join(names)}), "
+            "pick one with --server"
+        )
+    return selected[0]
+
+
+# the datasets of the servers list are reported with the name of their server, name:dataset
+def get_dataset_label(conf, dataset):
+    name = conf.server.get("name", None)
+    if name is None:
+        return dataset
+    return f"{name}:{dataset}"
+
+
+# the file system of the backup directory, the directories of several servers on the same file
+# system share its writer slots
+def get_backup_target(conf):
+    path = conf.backup.directory
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+# acquires a send slot for the server and a writer slot for the file system of the backup directory.
+# a limit of 0 (the default) is not enforced.
+def dump_slots(conf):
+    stack = ExitStack()
+    max_sends = conf.backup.get("max_sends_per_server", 0)
+    if max_sends > 0:
+        stack.enter_context(get_semaphore("send", get_server_key(conf), max_sends))
+    max_writers = conf.backup.get("max_writers_per_directory", 0)
+    if max_writers > 0:
+        stack.enter_context(get_semaphore("writer", get_backup_target(conf), max_writers))
+    return stack
+
+
 def get_ssh_cmd_arr(conf):
     cmd = ["ssh", f"{conf.server.ssh_user}@{conf.server.hostname}"]
     if conf.server.identity_file is not None:
         cmd += ["-i", f"{conf.server.identity_file}"]
     if conf.server.ssh_options is not None:
         cmd += conf.server.ssh_options.split(" ")
+    # bulk transfer tuning, a fast cipher and no ssh compression of already compressed streams
+    if conf.server.get("cipher", None) is not None:
+        cmd += ["-c", conf.server.cipher]
+    if conf.server.get("ssh_compression", None) is not None:
+        cmd += ["-o", f"Compression={'yes' if conf.server.ssh_compression else 'no'}"]
+    if conf.server.get("multiplex", True):
+        # all ssh invocations, including streaming ones, share one connection per server
+        cmd += get_control_master(cmd).options()
     return cmd
 
 
-def ssh_cmd(conf, command):
+def close_ssh_connections():
+    for destination, stats in close_control_masters():
+        log(
+            f"SSH {destination} : {stats['handshakes']} handshake(s) took "
+            f"{stats['handshake_seconds']:.2f} seconds, {stats['sessions']} multiplexed sessions "
+            f"saved about {stats['saved_seconds']:.2f} seconds"
+        )
+
+
+# 0 (the default) for no limit, zfs destroy of many snapshots and zfs send -nvP of large datasets
+# can take long
+def get_command_timeout(conf):
+    return conf.server.get("command_timeout", 0)
+
+
+# returns a coroutine that runs a command on the server and returns its output (see engine.py).
+# the ssh connection is established before, outside of the event loop
+def ssh_cmd_async(conf, command, stderr=None):
+    # imported on use, asyncio makes it slow to import
+    from snapdump.engine import run_command
+
     cmd = get_ssh_cmd_arr(conf) + command
     if VERBOSE:
         log('EXECUTING "{0}"'.format(" ".join(cmd)))
-    return check_output(cmd)
+    return run_command(cmd, stderr=stderr, timeout=get_command_timeout(conf))
+
+
+def ssh_cmd(conf, command, stderr=None):
+    from snapdump.engine import ENGINE
+
+    return ENGINE.run(ssh_cmd_async(conf, command, stderr))
+
+
+# runs a batch of operations with the agent of the restricted shell (snapdump-agent), see
+# restricted_shell/allowed_backup_commands.py. returns the results in the order of the operations
+def agent_call(conf, ops):
+    from snapdump.engine import ENGINE, run_command
+
+    cmd = get_ssh_cmd_arr(conf) + ["snapdump-agent"]
+    if VERBOSE:
+        log(f"AGENT {json.dumps(ops)}")
+    out = ENGINE.run(
+        run_command(
+            cmd, timeout=get_command_timeout(conf), input=json.dumps({"ops": ops}).encode()
+        )
+    )
+    return json.loads(out)["results"]
+
+
+# the engine is only started once a remote command runs
+def close_engine():
+    engine = sys.modules.get("snapdump.engine")
+    if engine is not None:
+        engine.ENGINE.close()
+
+
+def parse_size(size):
+    m = re.match(r"^(\d+)\s*(([KMGTPEZY])(B|iB)?)?$", str(size).strip())
+    if m is None:
+        raise Exception(f"Invalid size '{size}'")
+    value = int(m.group(1))
+    if m.group(3) is not None:
+        base = 1000 if m.group(4) == "B" else 1024
+        value *= base ** (SIZE_UNITS.index(m.group(3)) + 1)
+    return value
+
+
+# a rate in bytes per second, None for no limit
+def parse_rate(rate):
+    if rate is None or str(rate).strip() in ("unlimited", "none", "off"):
+        return None
+    value = parse_size(rate)
+    if value <= 0:
+        raise Exception(f"Invalid rate '{rate}'")
+    return value
+
+
+# "HH:MM" -> minutes since midnight. yaml reads unquoted times after 09:59 as a number of minutes
+def parse_time_of_day(value):
+    if isinstance(value, int):
+        minutes = value
+    else:
+        m = re.match(r"^(\d{1,2}):(\d{2})$", str(value).strip())
+        if m is None:
+            raise Exception(f"Invalid time of day '{value}', expected HH:MM")
+        minutes = int(m.group(1)) * 60 + int(m.group(2))
+    if not 0 <= minutes <= 24 * 60:
+        raise Exception(f"Invalid time of day '{value}'")
+    return minutes
+
+
+# returns (rate outside of the windows, [(start minute, end minute, rate)])
+def get_rate_limit_settings(conf):
+    rate_limit = conf.get("rate_limit", None) or {}
+    windows = [
+        (
+            parse_time_of_day(window["start"]),
+            parse_time_of_day(window["end"]),
+            parse_rate(window.get("rate", None)),
+        )
+        for window in rate_limit.get("windows", None) or []
+    ]
+    return parse_rate(rate_limit.get("rate", None)), windows
+
+
+def configure_rate_limit(conf):
+    LIMITER.configure(*get_rate_limit_settings(conf))
+
+
+# SIGHUP reloads the rate limit from the config file, for runs that last longer than a window
+def reload_rate_limit(config_file):
+    try:
+        configure_rate_limit(load_config(config_file))
+        log(f"Reloaded the rate limit from {config_file}")
+    except Exception as err:
+        log_error(f"Error reloading the rate limit : {err}")
+
+
+def format_rate(rate):
+    if rate is None:
+        return "unlimited"
+    return f"{rate / (1024 * 1024):.1f} MB/s"
 
 
 def normalize_dataset_name(dataset):
@@ -53,11 +332,25 @@ def parse_timestamp(dirname):
         return 0
 
 
-def get_backup_directory(conf, dataset, now):
+# returns the names of the group directories in a dataset directory
+def get_group_dirs(dataset_dir):
+    return [x for x in os.listdir(dataset_dir) if parse_timestamp(x) != 0]
+
+
+# returns the group directory the next dump of the dataset goes to.
+# a new group directory is created when the full interval has passed, with create=False it is
+# only named and not created (for the backup plan and dry runs)
+def get_backup_directory(conf, dataset, now, create=True):
     nowtime = datetime.utcfromtimestamp(now).strftime(TIME_FORMAT)
     dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
     newest_dir = get_newest_file(dataset_dir)
     full_dir = "%s/%s" % (dataset_dir, nowtime)
+    if not create:
+        if newest_dir is None or parse_timestamp(newest_dir) + conf.backup.interval_days.full * (
+            60.0 * 60 * 24
+        ) <= now:
+            return full_dir
+        return f"{dataset_dir}/{newest_dir}"
     if newest_dir is None:
         os.makedirs(full_dir)
         if VERBOSE:
@@ -85,18 +378,207 @@ def get_backup_directory(conf, dataset, now):
 def get_newest_file(path):
     if not os.path.exists(path):
         return None
-    files = sorted(os.listdir(path), key=parse_timestamp)
+    files = sorted(get_group_dirs(path), key=parse_timestamp)
     if len(files) > 0:
         return files[-1]
     return None
 
 
-def chain(p1, p2_command):
-    return Popen(p2_command, stdin=p1.stdout, stdout=PIPE)
+def read_dump_metadata(dump_dir):
+    metadata_file = f"{dump_dir}/{METADATA_FILE}"
+    if not os.path.exists(metadata_file):
+        # dumps created before metadata was recorded
+        return {"compression": {"codec": DEFAULT_CODEC}, "send_mode": "plain"}
+    with open(metadata_file) as f:
+        return json.load(f)
 
 
-def zfs_snapshot(conf, dataset, snapshot_name):
-    ssh_cmd(conf, ["zfs", "snapshot", f"{dataset}@{snapshot_name}"])
+def write_dump_metadata(dump_dir, metadata):
+    with open(f"{dump_dir}/{METADATA_FILE}.tmp", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.rename(f"{dump_dir}/{METADATA_FILE}.tmp", f"{dump_dir}/{METADATA_FILE}")
+
+
+# returns the sorted list of part files of a dump
+def get_dump_parts(dump_dir):
+    return [
+        f"{dump_dir}/{file}"
+        for file in sorted(os.listdir(dump_dir))
+        if file.startswith(SNAPSHOT_SUFFIX)
+    ]
+
+
+# reads the catalog entry of a dump from the dump directory
+def read_dump_entry(dataset_dir, directory):
+    dump_dir = f"{dataset_dir}/{directory}"
+    group_dir, snapshot_dir = directory.split("/")
+    snap_type, snap_name = snapshot_dir.split("##")
+    entry = read_dump_metadata(dump_dir)
+    entry.update(
+        directory=directory,
+        group=group_dir,
+        type=snap_type,
+        snapshot=snap_name,
+        parts=[[os.path.basename(f), os.path.getsize(f)] for f in get_dump_parts(dump_dir)],
+    )
+    return entry
+
+
+# rebuilds the catalog of a dataset directory from the dumps on disk
+def reindex_dataset(dataset_dir):
+    entries = {}
+    # a dump that is appended while the directory is scanned is not lost by the rewrite
+    with catalog_lock(dataset_dir):
+        for group_dir in get_group_dirs(dataset_dir):
+            if not os.path.isdir(f"{dataset_dir}/{group_dir}"):
+                continue
+            for snapshot_dir in os.listdir(f"{dataset_dir}/{group_dir}"):
+                if len(snapshot_dir.split("##")) != 2 or snapshot_dir.endswith(TEMPDIR_SUFFIX):
+                    continue
+                directory = f"{group_dir}/{snapshot_dir}"
+                entries[directory] = read_dump_entry(dataset_dir, directory)
+        write_catalog(dataset_dir, entries)
+    return entries
+
+
+# returns the catalog entries of the dataset, the catalog is built from disk if it does not exist yet
+def get_catalog(dataset_dir):
+    entries = read_catalog(dataset_dir)
+    if entries is None:
+        if VERBOSE:
+            log(f"Building catalog for {dataset_dir}")
+        entries = reindex_dataset(dataset_dir)
+    return entries
+
+
+# updates the metadata of a dump both in the dump directory and in the catalog
+def update_dump_metadata(dataset_dir, entry, **fields):
+    dump_dir = f"{dataset_dir}/{entry['directory']}"
+    metadata = read_dump_metadata(dump_dir)
+    metadata.update(fields)
+    write_dump_metadata(dump_dir, metadata)
+    append_catalog(
+        dataset_dir, [{"op": "update", "directory": entry["directory"], "fields": fields}]
+    )
+    entry.update(fields)
+
+
+def get_send_mode(conf):
+    send = conf.backup.get("send", None)
+    mode = "plain" if send is None else send.get("mode", "plain")
+    if mode not in SEND_MODES:
+        raise Exception(
+            f"Unsupported send mode '{mode}', supported modes : {', '.join(SEND_MODES.keys())}"
+        )
+    return mode
+
+
+# compressed and raw streams keep the blocks compressed as they are stored in the pool,
+# the local compression stage can optionally be skipped for them.
+# backup.bookmarks : enabled creates a bookmark of every dumped snapshot, keep_snapshots is the
+# number of the newest dumped snapshots cleanup keeps on the server (None keeps them until retention)
+def get_bookmark_settings(conf):
+    bookmarks = conf.backup.get("bookmarks", None) or {}
+    settings = {
+        "enabled": bookmarks.get("enabled", False),
+        "keep_snapshots": bookmarks.get("keep_snapshots", None),
+    }
+    keep = settings["keep_snapshots"]
+    if keep is not None and (not isinstance(keep, int) or keep < 0):
+        raise Exception(f"Invalid backup.bookmarks.keep_snapshots '{keep}', expected a number >= 0")
+    return settings
+
+
+def get_dump_compression_settings(conf, send_mode):
+    send = conf.backup.get("send", None)
+    skip_compression = send is not None and send.get("skip_compression", False)
+    if send_mode != "plain" and skip_compression:
+        return {"codec": "none", "level": None, "threads": 0, "at": "local"}
+    return get_compression_settings(conf)
+
+
+# returns the commands as a single pipeline for the remote shell (cmd1 | cmd2 | ...)
+def remote_pipeline(commands):
+    return " | ".join(" ".join(shlex.quote(arg) for arg in cmd) for cmd in commands)
+
+
+def get_store_type(conf):
+    store = conf.backup.get("store", "parts")
+    if store not in STORES:
+        raise Exception(f"Unsupported store '{store}', supported stores : {', '.join(STORES)}")
+    return store
+
+
+# settings of a new chunk store, the chunks are compressed in-process with the codec of the dumps
+def get_chunk_store_settings(conf, send_mode):
+    compression = get_dump_compression_settings(conf, send_mode)
+    chunks = conf.backup.get("chunks", None) or {}
+    return {
+        # pigz writes gzip members
+        "codec": "gzip" if compression["codec"] == "pigz" else compression["codec"],
+        "level": compression["level"],
+        "average_size": parse_size(chunks.get("average_size", DEFAULT_CHUNK_AVERAGE_SIZE)),
+    }
+
+
+# number of threads hashing and compressing the chunks, the compression threads (all cores for 0)
+def get_chunk_jobs(conf):
+    threads = get_compression_settings(conf)["threads"]
+    return threads if threads > 0 else os.cpu_count() or 1
+
+
+# stored bytes of a dump, for a chunked dump the bytes of the chunks it added to the store
+def get_entry_size(entry):
+    return sum(size for name, size in entry["parts"]) + entry.get("chunks", {}).get("stored", 0)
+
+
+# returns the directories of all the dumps of the dataset, including the dumps in progress
+def get_dump_dirs(dataset_dir, exclude_groups=()):
+    dump_dirs = []
+    for group_dir in get_group_dirs(dataset_dir):
+        if group_dir in exclude_groups or not os.path.isdir(f"{dataset_dir}/{group_dir}"):
+            continue
+        for snapshot_dir in os.listdir(f"{dataset_dir}/{group_dir}"):
+            if len(snapshot_dir.split("##")) == 2:
+                dump_dirs.append(f"{dataset_dir}/{group_dir}/{snapshot_dir}")
+    return dump_dirs
+
+
+# returns the zfs recv command matching the send mode the dump was created with
+def get_recv_cmd(metadata, dest_dataset):
+    if metadata.get("send_mode", "plain") == "raw":
+        # raw streams of encrypted datasets are received without loading keys, do not mount them
+        return ["zfs", "recv", "-F", "-u", dest_dataset]
+    return ["zfs", "recv", "-F", dest_dataset]
+
+
+# returns the commands that writes the uncompressed stream of a dump to stdout,
+# or the compressed stream without decompress
+def read_dump_cmds(dataset_dir, entry, decompress=True):
+    dump_dir = f"{dataset_dir}/{entry['directory']}"
+    if entry.get("store") == "chunks":
+        # the stream is rebuilt uncompressed from the chunk store of the dataset
+        store_dir = f"{dataset_dir}/{CHUNK_STORE_DIR}"
+        return [[sys.executable, "-m", "snapdump.chunks", "cat", store_dir, dump_dir]]
+    cmds = [["cat"] + [f"{dump_dir}/{name}" for name, size in entry["parts"]]]
+    if decompress and decompress_cmd(entry["compression"]) is not None:
+        cmds.append(decompress_cmd(entry["compression"]))
+    return cmds
+
+
+# with recursive the snapshot of the dataset and all its children is taken atomically
+def zfs_snapshot(conf, dataset, snapshot_name, recursive=False):
+    forget_snapshot_list(conf, dataset, recursive)
+    ssh_cmd(
+        conf, ["zfs", "snapshot"] + (["-r"] if recursive else []) + [f"{dataset}@{snapshot_name}"]
+    )
+
+
+# bookmarks keep the incremental source of a snapshot once the snapshot is destroyed, they take no space
+def zfs_bookmark(conf, dataset, snapshot_name):
+    with SNAPSHOT_LISTS_LOCK:
+        BOOKMARK_LISTS.pop((get_server_key(conf), dataset), None)
+    ssh_cmd(conf, ["zfs", "bookmark", f"{dataset}@{snapshot_name}", f"{dataset}#{snapshot_name}"])
 
 
 def delete_temporary_dump_dirs(backup_dir):
@@ -116,77 +598,247 @@ def is_dump_in_progress(conf, backup_dir):
     return False
 
 
-def ensure_clean_exit(process):
-    if process.returncode != 0:
-        raise Exception(
-            f"{' '.join(process.args)} exited with non zero exit code {process.returncode}"
-        )
+# base_snapshot_name is the -i argument, a snapshot name or a bookmark (dataset#name, see get_send_base)
+def get_zfs_send_cmd(dataset, snapshot_name, base_snapshot_name, send_mode):
+    zfs_cmd = ["zfs", "send"] + SEND_MODES[send_mode] + [f"{dataset}@{snapshot_name}"]
+    if base_snapshot_name is not None:
+        zfs_cmd += ["-i", base_snapshot_name]
+    return zfs_cmd
+
+
+# returns the estimated size of the stream of a zfs send command (zfs send -nvP), None if it is not available
+def zfs_send_estimate(conf, zfs_cmd):
+    from snapdump.engine import CommandTimeout
+
+    try:
+        out = ssh_cmd(conf, ["zfs", "send", "-nvP"] + zfs_cmd[2:], stderr=DEVNULL)
+    except (CalledProcessError, CommandTimeout):
+        return None
+    for line in get_lines(out):
+        fields = line.split("\t")
+        if fields[0] == "size":
+            return int(fields[1])
+    return None
+
+
+# dumps the stream of send_cmd into the chunk store of the dataset.
+# the chunks of the newest group are the ones the dump most likely repeats, they are not looked up
+# on disk. returns (the chunks metadata of the dump, the pipeline stages)
+def write_chunk_dump(conf, dataset, backup_dir, send_cmd, send_mode, temporary_dir):
+    from snapdump.chunks import ChunkStore, write_chunked_stream
+
+    dataset_dir = os.path.dirname(backup_dir)
+    store = ChunkStore(
+        f"{dataset_dir}/{CHUNK_STORE_DIR}", get_chunk_store_settings(conf, send_mode)
+    )
+    entries = [x for x in get_stored_snapshots(dataset_dir) if x.get("store") == "chunks"]
+    known_dirs = [
+        f"{dataset_dir}/{x['directory']}" for x in entries if x["group"] == entries[-1]["group"]
+    ]
+    return write_chunked_stream(
+        send_cmd,
+        store,
+        temporary_dir,
+        get_chunk_jobs(conf),
+        known_dirs=known_dirs,
+        progress=lambda offset: PROGRESS.update(dataset, offset),
+        stop=STOP_DUMPS,
+        throttle=LIMITER.consume,
+    )
+
 
+def get_checkpoint_size(conf):
+    size = conf.backup.get("checkpoint_size", None)
+    if size is None:
+        return DEFAULT_CHECKPOINT_SIZE
+    return parse_size(size)
 
+
+# dumps a snapshot, with resume a dead dump of the snapshot is continued from its last checkpoint
 def zfs_dump_snapshot(
-    conf, backup_dir, dataset, snapshot_name, base_snapshot_name=None
+    conf, backup_dir, dataset, snapshot_name, base_snapshot_name=None, resume=False
 ):
-    zfs_cmd = ["zfs", "send", f"{dataset}@{snapshot_name}"]
-    backup_type = "full"
+    backup_type = "full" if base_snapshot_name is None else "incr"
+    parts_dir = f"{backup_dir}/{backup_type}##{snapshot_name}"
+    temporary_dir = f"{parts_dir}.{TEMPDIR_SUFFIX}"
+    if resume:
+        # the dump continues with the settings it was started with
+        metadata = read_dump_metadata(temporary_dir)
+        send_mode = metadata["send_mode"]
+    else:
+        send_mode = get_send_mode(conf)
+
+    send_base = None
+    if base_snapshot_name is not None:
+        send_base = get_send_base(conf, dataset, base_snapshot_name)
+        if send_base is None:
+            raise Exception(f"{dataset}@{base_snapshot_name} and its bookmark are not on the zfs server")
+    zfs_cmd = get_zfs_send_cmd(dataset, snapshot_name, send_base, send_mode)
+    action = "Resuming" if resume else "Creating"
     if base_snapshot_name is None:
-        log("Creating full snapshot dump for {0}@{1}".format(dataset, snapshot_name))
+        log(f"{action} full snapshot dump for {get_dataset_label(conf, dataset)}@{snapshot_name}")
     else:
         log(
-            "Creating incremental snapshot dump for {0}@{1} based on {2}".format(
-                dataset, snapshot_name, base_snapshot_name
-            )
+            f"{action} incremental snapshot dump for {get_dataset_label(conf, dataset)}@{snapshot_name} "
+            f"based on {base_snapshot_name}"
+            + (" (bookmark)" if "#" in send_base else "")
         )
-        zfs_cmd += ["-i", base_snapshot_name]
-        backup_type = "incr"
 
-    if is_dump_in_progress(conf, backup_dir):
-        log(f"Dump is already in progress in {backup_dir}, bailing up")
-        return False
-
-    # delete dead dump directories
-    delete_temporary_dump_dirs(backup_dir)
-
-    parts_dir = f"{backup_dir}/{backup_type}##{snapshot_name}"
-    temporary_dir = f"{parts_dir}.{TEMPDIR_SUFFIX}"
-    os.makedirs(temporary_dir)
+    if not resume:
+        if is_dump_in_progress(conf, backup_dir):
+            log(f"Dump is already in progress in {backup_dir}, bailing up")
+            return False
 
-    ssh = Popen(get_ssh_cmd_arr(conf) + zfs_cmd, stdout=PIPE)
-    gzip = chain(ssh, "gzip")
-    split = chain(
-        gzip,
-        [
-            "split",
-            "-b",
-            conf.backup.split_size,
-            "-a3",
-            "-",
-            f"{temporary_dir}/{SNAPSHOT_SUFFIX}",
-        ],
+        # delete dead dump directories
+        delete_temporary_dump_dirs(backup_dir)
+
+        os.makedirs(temporary_dir)
+        metadata = {
+            "compression": get_dump_compression_settings(conf, send_mode),
+            "send_mode": send_mode,
+            "base_snapshot": base_snapshot_name,
+        }
+        if get_store_type(conf) == "chunks":
+            # the chunks are compressed by the store, the stream read back is not compressed
+            metadata.update(
+                store="chunks",
+                compression={"codec": "none", "level": None, "threads": 0, "at": "local"},
+            )
+        write_dump_metadata(temporary_dir, metadata)
+
+    algorithm = conf.backup.get("part_checksum", DEFAULT_ALGORITHM)
+    send_cmd = get_ssh_cmd_arr(conf) + zfs_cmd
+    compress = compress_cmd(metadata["compression"])
+    remote = is_remote(metadata["compression"])
+    if remote:
+        # the stream is compressed on the server, the checkpoints of the dump are in compressed bytes
+        send_cmd = get_ssh_cmd_arr(conf) + [remote_pipeline([zfs_cmd, compress])]
+        compress = None
+    with dump_slots(conf):
+        if PROGRESS.enabled:
+            # the estimate is the size of the uncompressed stream
+            PROGRESS.start(dataset, None if remote else zfs_send_estimate(conf, zfs_cmd))
+        try:
+            if metadata.get("store") == "chunks":
+                checksums = None
+                metadata["chunks"], stages = write_chunk_dump(
+                    conf, dataset, backup_dir, send_cmd, send_mode, temporary_dir
+                )
+                write_dump_metadata(temporary_dir, metadata)
+            else:
+                # parts are hashed while they are written, no second read pass is needed
+                checksums, stages = write_dump_stream(
+                    send_cmd,
+                    compress,
+                    f"{temporary_dir}/{SNAPSHOT_SUFFIX}",
+                    parse_size(conf.backup.split_size),
+                    None if algorithm == "none" else algorithm,
+                    get_checkpoint_size(conf),
+                    resume=resume,
+                    progress=lambda offset: PROGRESS.update(dataset, offset),
+                    stop=STOP_DUMPS,
+                    throttle=LIMITER.consume,
+                    in_flight=conf.backup.get("writes_in_flight", 1),
+                )
+        finally:
+            PROGRESS.finish(dataset)
+    REPORT.add(
+        "backup",
+        get_dataset_label(conf, dataset),
+        snapshot_name,
+        stages,
+        type=backup_type,
+        resumed=resume,
     )
-
-    ssh.stdout.close()
-    gzip.stdout.close()
-    split.communicate()
-    ssh.wait()
-    gzip.wait()
-    ensure_clean_exit(ssh)
-    ensure_clean_exit(gzip)
-    ensure_clean_exit(split)
+    log(f"Dumped {get_dataset_label(conf, dataset)}@{snapshot_name} : {format_stages(stages)}")
+    if "chunks" in metadata:
+        chunks = metadata["chunks"]
+        log(
+            f"Stored {chunks['new']} new of {chunks['count']} chunks, "
+            f"{chunks['stored'] / (1024 * 1024):.1f} MB for {chunks['bytes'] / (1024 * 1024):.1f} MB of data"
+        )
+    if checksums is not None:
+        parts = [os.path.basename(x) for x in get_dump_parts(temporary_dir)]
+        digests = checksums["digests"]
+        if len(parts) != len(digests):
+            raise Exception(
+                f"Expected {len(digests)} parts in {temporary_dir}, found {len(parts)}"
+            )
+        metadata["checksums"] = {
+            "algorithm": checksums["algorithm"],
+            "parts": dict(zip(parts, digests)),
+        }
+        write_dump_metadata(temporary_dir, metadata)
 
     cleanup_dataset_snapshots(conf, dataset)
 
     os.rename(temporary_dir, parts_dir)
+    dataset_dir = os.path.dirname(backup_dir)
+    directory = f"{os.path.basename(backup_dir)}/{os.path.basename(parts_dir)}"
+    # make sure the catalog exists before adding to it, otherwise it will be built without older dumps
+    get_catalog(dataset_dir)
+    append_catalog(
+        dataset_dir, [dict(read_dump_entry(dataset_dir, directory), op="add")]
+    )
+    if get_bookmark_settings(conf)["enabled"]:
+        try:
+            zfs_bookmark(conf, dataset, snapshot_name)
+        except Exception as err:
+            # the next incremental is sent from the snapshot while it is on the server
+            log_error(f"Error creating the bookmark of {dataset}@{snapshot_name} : {err}")
     return True
 
 
+# resumes the dead dumps in the group directory that have a checkpoint.
+# returns the outcome, or None if there was nothing to resume
+def resume_dumps(conf, backup_dir, dataset, verify):
+    tempdirs = [
+        x
+        for x in glob.glob(f"{backup_dir}/*.{TEMPDIR_SUFFIX}")
+        if read_checkpoint(x) is not None
+    ]
+    if len(tempdirs) == 0:
+        return None
+    if is_dump_in_progress(conf, backup_dir):
+        log(f"Dump is already in progress in {backup_dir}, bailing up")
+        return "in-progress"
+
+    dumps = []
+    for tempdir in tempdirs:
+        backup_type, snapshot_name = os.path.basename(tempdir).split(".")[0].split("##")
+        dumps.append((parse_timestamp(snapshot_name), tempdir, backup_type, snapshot_name))
+
+    zfs_snapshots = [x.split("@")[1] for x in zfs_get_dataset_snapshots(conf, dataset)]
+    outcome = None
+    for _, tempdir, backup_type, snapshot_name in sorted(dumps):
+        base_snapshot_name = read_dump_metadata(tempdir).get("base_snapshot")
+        if snapshot_name not in zfs_snapshots or (
+            base_snapshot_name is not None
+            and get_send_base(conf, dataset, base_snapshot_name) is None
+        ):
+            log(f"Snapshots of dead dump {tempdir} are not on the zfs server, deleting it")
+            shutil.rmtree(tempdir)
+            continue
+        try:
+            zfs_dump_snapshot(
+                conf, backup_dir, dataset, snapshot_name, base_snapshot_name, resume=True
+            )
+        except StreamChanged as err:
+            log(f"Cannot resume {tempdir} ({err}), deleting it")
+            shutil.rmtree(tempdir)
+            continue
+        if verify:
+            verify_impl(conf, dataset, snapshot_name)
+        outcome = f"{backup_type} (resumed)"
+    return outcome
+
+
 def get_lines(s):
     return list(filter(len, s.decode().split("\n")))
 
 
-def zfs_get_dataset_snapshots(conf, dataset):
-    ret = ssh_cmd(
-        conf,
-        [
+def zfs_list_snapshots_cmd(dataset):
+    return [
             "zfs",
             "list",
             "-H",
@@ -198,20 +850,176 @@ def zfs_get_dataset_snapshots(conf, dataset):
             "creation",
             "-r",
             dataset,
-        ],
-    )
-    return get_lines(ret)
+        ]
+
+
+def zfs_get_dataset_snapshots(conf, dataset):
+    with SNAPSHOT_LISTS_LOCK:
+        snapshots = SNAPSHOT_LISTS.get((get_server_key(conf), dataset))
+    if snapshots is not None:
+        return snapshots
+    # -r lists the snapshots of the children too
+    return [
+        x
+        for x in get_lines(ssh_cmd(conf, zfs_list_snapshots_cmd(dataset)))
+        if x.split("@")[0] == dataset
+    ]
+
+
+# lists the snapshots of the datasets with a single agent round trip (server.agent),
+# zfs_get_dataset_snapshots uses the lists until the snapshots of a dataset change
+def plan_snapshot_lists(conf, datasets):
+    if not conf.server.get("agent", False) or len(datasets) == 0:
+        return
+    try:
+        results = agent_call(conf, [{"op": "list", "dataset": dataset} for dataset in datasets])
+    except Exception as err:
+        log_error(f"snapdump-agent failed, listing the snapshots of each dataset : {err}")
+        return
+    with SNAPSHOT_LISTS_LOCK:
+        for dataset, result in zip(datasets, results):
+            if result["ok"]:
+                SNAPSHOT_LISTS[(get_server_key(conf), dataset)] = [
+                    x["name"] for x in result["snapshots"]
+                ]
+            elif VERBOSE:
+                log(f"Agent could not list {dataset} : {result['error']}")
+
+
+# with recursive the lists of the children of the dataset are forgotten too
+def forget_snapshot_list(conf, dataset, recursive=False):
+    server = get_server_key(conf)
+    with SNAPSHOT_LISTS_LOCK:
+        for lists in [SNAPSHOT_LISTS, BOOKMARK_LISTS]:
+            lists.pop((server, dataset), None)
+            if recursive:
+                for key in [x for x in lists if x[0] == server and x[1].startswith(f"{dataset}/")]:
+                    lists.pop(key)
+
+
+def zfs_list_bookmarks_cmd(dataset):
+    return ["zfs", "list", "-H", "-t", "bookmark", "-o", "name", "-r", dataset]
+
+
+# returns the names of the bookmarks of the dataset, without the dataset
+def zfs_get_dataset_bookmarks(conf, dataset):
+    with SNAPSHOT_LISTS_LOCK:
+        bookmarks = BOOKMARK_LISTS.get((get_server_key(conf), dataset))
+    if bookmarks is not None:
+        return bookmarks
+    bookmarks = [
+        x.split("#")[1]
+        for x in get_lines(ssh_cmd(conf, zfs_list_bookmarks_cmd(dataset)))
+        if x.split("#")[0] == dataset
+    ]
+    with SNAPSHOT_LISTS_LOCK:
+        BOOKMARK_LISTS[(get_server_key(conf), dataset)] = bookmarks
+    return bookmarks
+
+
+# returns the source of an incremental send from the dumped snapshot base_snapshot_name : the
+# snapshot while it is on the server, then its bookmark (dataset#name), None if neither is.
+# the bookmarks are only listed once the snapshot is gone
+def get_send_base(conf, dataset, base_snapshot_name):
+    zfs_snapshots = [x.split("@")[1] for x in zfs_get_dataset_snapshots(conf, dataset)]
+    if base_snapshot_name in zfs_snapshots:
+        return base_snapshot_name
+    if base_snapshot_name in zfs_get_dataset_bookmarks(conf, dataset):
+        return f"{dataset}#{base_snapshot_name}"
+    return None
+
+
+# returns the roots of the dataset trees that are backed up recursively (backup.recursive)
+def get_recursive_roots(conf):
+    return list(conf.backup.get("recursive", None) or [])
+
+
+# returns the datasets and the recursive roots of the config, a tree is backed up as one unit
+def get_backup_units(conf):
+    units = list(conf.backup.get("datasets", None) or [])
+    return units + [root for root in get_recursive_roots(conf) if root not in units]
 
 
-# returns sorted snapshot names in the directory
+# returns {root: datasets of the tree} as found by the last backup of each tree
+def read_trees(conf):
+    path = f"{conf.backup.directory}/{TREES_FILE}"
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_tree(conf, root, datasets):
+    path = f"{conf.backup.directory}/{TREES_FILE}"
+    with TREES_LOCK:
+        trees = read_trees(conf)
+        trees[root] = datasets
+        os.makedirs(conf.backup.directory, exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(trees, f, indent=2)
+        os.rename(f"{path}.tmp", path)
+
+
+# returns the datasets of a backup unit : the datasets of the tree its last backup found for a
+# recursive root, the dataset itself otherwise. does not use the network
+def get_unit_datasets(conf, dataset):
+    if dataset not in get_recursive_roots(conf):
+        return [dataset]
+    return read_trees(conf).get(dataset, [dataset])
+
+
+# returns all the datasets of the config, the datasets of the trees included
+def get_datasets(conf):
+    datasets = [x for unit in get_backup_units(conf) for x in get_unit_datasets(conf, unit)]
+    return list(dict.fromkeys(datasets))
+
+
+# returns the datasets a command operates on : the datasets of the unit dataset, or all of them
+def get_command_datasets(conf, dataset):
+    if dataset is None:
+        return get_datasets(conf)
+    return get_unit_datasets(conf, dataset)
+
+
+# lists the datasets of the tree under root with a single zfs list, parents before their children
+def zfs_list_tree(conf, root):
+    out = ssh_cmd(conf, ["zfs", "list", "-H", "-o", "name", "-r", root])
+    # snapshots are listed too on pools with listsnapshots=on
+    return sorted(x for x in get_lines(out) if "@" not in x)
+
+
+# lists the snapshots of all the datasets of a tree with a single zfs list,
+# zfs_get_dataset_snapshots uses the lists until the snapshots of a dataset change
+def plan_tree_snapshot_lists(conf, root, datasets):
+    lists = {dataset: [] for dataset in datasets}
+    for name in get_lines(ssh_cmd(conf, zfs_list_snapshots_cmd(root))):
+        if name.split("@")[0] in lists:
+            lists[name.split("@")[0]].append(name)
+    server = get_server_key(conf)
+    with SNAPSHOT_LISTS_LOCK:
+        SNAPSHOT_LISTS.update({(server, dataset): names for dataset, names in lists.items()})
+
+
+# takes the snapshot of all the datasets of a tree at once (zfs snapshot -r), except with dry_run,
+# and lists their snapshots. returns the datasets of the tree
+def snapshot_tree(conf, root, now, dry_run=False):
+    datasets = zfs_list_tree(conf, root)
+    if not dry_run:
+        write_tree(conf, root, datasets)
+        snapshot_name = datetime.utcfromtimestamp(now).strftime(TIME_FORMAT)
+        zfs_snapshot(conf, root, snapshot_name, recursive=True)
+    plan_tree_snapshot_lists(conf, root, datasets)
+    return datasets
+
+
+# returns sorted snapshot names in the group directory
 def get_snapshot_names(backup_dir):
-    files = os.listdir(backup_dir)
-    files = list(
-        filter(
-            lambda x: len(x.split("##")) == 2 and not x.endswith(TEMPDIR_SUFFIX), files
-        )
-    )
-    snap_names = [v.split("##")[1] for v in files]
+    group_dir = os.path.basename(backup_dir)
+    snap_names = [
+        entry["snapshot"]
+        for entry in get_catalog(os.path.dirname(backup_dir)).values()
+        if entry["group"] == group_dir
+    ]
     return sorted(snap_names, key=parse_timestamp)
 
 
@@ -220,12 +1028,12 @@ def get_and_verify_latest_snapshot(conf, backup_dir, dataset):
     if len(snaps) == 0:
         return None
     latest = snaps[-1]
-    zfs_snapshots = [x.split("@")[1] for x in zfs_get_dataset_snapshots(conf, dataset)]
-    if latest not in zfs_snapshots:
+    if get_send_base(conf, dataset, latest) is None:
         # If this happens something is wrong, not sure how to proceed.
         # Did someone  manually delete the snapshots from the zfs server?
         # An easy way out would be to delete the whole directory and let the
         # backup create a fresh full snapshot and take it from there.
+        # With backup.bookmarks the incremental is sent from the bookmark of the snapshot.
         raise Exception(
             "{0}@{1} snapshot is not on the zfs server, cannot take incremental snapshot. aborting.".format(
                 dataset, latest
@@ -234,53 +1042,527 @@ def get_and_verify_latest_snapshot(conf, backup_dir, dataset):
     return latest
 
 
-def snapshot(conf, backup_dir, dataset, now, verify):
+# returns the outcome of the backup: full, incr, skipped, in-progress or the type of a resumed dump.
+# with taken the zfs snapshot was already taken by the planner
+def snapshot(conf, backup_dir, dataset, now, verify, taken=False):
+    # interrupted dumps are completed first, new snapshots are taken by the next run
+    resumed = resume_dumps(conf, backup_dir, dataset, verify)
+    if resumed is not None:
+        return resumed
     nowtime = datetime.utcfromtimestamp(now).strftime(TIME_FORMAT)
+    if is_dump_in_progress(conf, backup_dir):
+        log(f"Dump is already in progress in {backup_dir}, bailing up")
+        return "in-progress"
     newest_snapshot = get_and_verify_latest_snapshot(conf, backup_dir, dataset)
-    zfs_snapshot(conf, dataset, nowtime)
-    created = False
-    if newest_snapshot is None:
-        created = zfs_dump_snapshot(conf, backup_dir, dataset, nowtime)
-    else:
+    backup_type = "full"
+    if newest_snapshot is not None:
         ctime = parse_timestamp(newest_snapshot)
         delta_days = (now - ctime) / (60.0 * 60 * 24)
-        if delta_days >= conf.backup.interval_days.incremental:
-            created = zfs_dump_snapshot(
-                conf, backup_dir, dataset, nowtime, newest_snapshot
-            )
-        else:
+        if delta_days < conf.backup.interval_days.incremental:
             log(f"Latest dir new enough, skipping {dataset} snapshot")
-            return
+            return "skipped"
+        backup_type = "incr"
 
-    if verify and created:
+    # the zfs snapshot is only taken once a dump is due
+    if not taken:
+        zfs_snapshot(conf, dataset, nowtime)
+    created = zfs_dump_snapshot(conf, backup_dir, dataset, nowtime, newest_snapshot)
+    if not created:
+        return "in-progress"
+    if verify:
         verify_impl(conf, dataset, nowtime)
+    return backup_type
 
 
-# returns a sorted list of tupples (group_dir, snapshot_type, snapshot_name, dir)
+# returns a list of catalog entries (group, type, snapshot, directory, parts and the dump metadata)
 # list is sorted from older to newer snapshots
 def get_stored_snapshots(dataset_dir):
-    snapshots = []
-    for group_dir in os.listdir(dataset_dir):
-        for snapshot_dir in os.listdir(f"{dataset_dir}/{group_dir}"):
-            snap_type = snapshot_dir.split("##")[0]
-            snap_name = snapshot_dir.split("##")[1]
-            snapshots.append(
-                (group_dir, snap_type, snap_name, f"{group_dir}/{snapshot_dir}")
+    snapshots = list(get_catalog(dataset_dir).values())
+    return sorted(snapshots, key=lambda x: parse_timestamp(x["snapshot"]))
+
+
+# returns the time the next backup of the dataset is due, decided from the local state only
+# (the dump directories and the catalog), and the outcome of a backup before that time
+# (skipped or in-progress)
+def get_backup_due_time(conf, dataset, now):
+    day = 60.0 * 60 * 24
+    dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+    newest_dir = get_newest_file(dataset_dir)
+    if newest_dir is None:
+        return now, None
+    full_due = parse_timestamp(newest_dir) + conf.backup.interval_days.full * day
+    if full_due <= now:
+        return full_due, None
+    backup_dir = f"{dataset_dir}/{newest_dir}"
+    if len(glob.glob(f"{backup_dir}/*.{TEMPDIR_SUFFIX}")) > 0:
+        if is_dump_in_progress(conf, backup_dir):
+            return now + conf.backup.dump_dead_seconds, "in-progress"
+        # the dead dump is resumed or deleted
+        return now, None
+    snaps = get_snapshot_names(backup_dir)
+    if len(snaps) == 0:
+        return now, None
+    incr_due = parse_timestamp(snaps[-1]) + conf.backup.interval_days.incremental * day
+    return min(full_due, incr_due), "skipped"
+
+
+# decides from the local state only whether a dataset has anything to do, so cron runs with
+# nothing to do do not touch the network.
+# returns the outcome (skipped or in-progress) if there is nothing to do, None if a backup is due
+def plan_dataset(conf, dataset, now):
+    due, outcome = get_backup_due_time(conf, dataset, now)
+    if due <= now:
+        return None
+    if outcome == "in-progress":
+        log(f"Dump of {dataset} is already in progress, bailing up")
+    else:
+        log(f"Latest dir new enough, skipping {dataset} snapshot")
+    return outcome
+
+
+# returns the bytes available in the backup directory and the bytes of the dumps past retention
+def get_backup_space(conf, now):
+    path = conf.backup.directory
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st = os.statvfs(path)
+    expired = 0
+    for dataset in get_datasets(conf):
+        dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+        if os.path.exists(dataset_dir):
+            catalog = get_catalog(dataset_dir)
+            expired += sum(
+                get_group_size(catalog, directory)
+                for directory in get_expired_group_dirs(conf, dataset_dir, now)
             )
+    return st.f_bavail * st.f_frsize, expired
+
+
+# stored bytes per stream byte of the verified dumps of a dataset, 1 without any
+def get_compression_ratio(dataset_dir):
+    stream_bytes = stored_bytes = 0
+    for entry in get_catalog(dataset_dir).values():
+        if "stream" in entry:
+            stream_bytes += entry["stream"]["bytes"]
+            stored_bytes += get_entry_size(entry)
+    if stream_bytes == 0:
+        return 1.0
+    return stored_bytes / stream_bytes
 
-    return sorted(snapshots, key=lambda x: parse_timestamp(x[2]))
 
+# estimates the stream of a snapshot that is not taken yet (backup --dry-run) : the space written
+# since the latest snapshot for an incremental dump, the logical size of the dataset for a full dump.
+# returns None if it is not available
+def zfs_property_estimate(conf, dataset, incremental):
+    from snapdump.engine import CommandTimeout
 
+    prop = "written" if incremental else "logicalreferenced"
+    try:
+        # -r keeps the command in the form the restricted shell accepts, the dataset is listed first
+        out = ssh_cmd(conf, ["zfs", "list", "-H", "-p", "-o", prop, "-r", dataset], stderr=DEVNULL)
+    except (CalledProcessError, CommandTimeout):
+        return None
+    lines = get_lines(out)
+    if len(lines) == 0 or not lines[0].isdigit():
+        return None
+    return int(lines[0])
+
+
+# plans the next dump of a due dataset, with dry_run nothing is changed on the server or on disk.
+# returns {"dataset", "type" (full, incr, resume or None if there is nothing to dump), "snapshot",
+# "base", "estimate" (bytes of the stream, None if unknown), "size" (estimated bytes to write),
+# "taken"}.
+# the snapshot of a new dump is taken here (taken is True), zfs send -nvP needs it. with taken the
+# snapshot was already taken with the snapshot of its tree
+def plan_dump(conf, dataset, now, dry_run=False, taken=False):
+    dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+    backup_dir = get_backup_directory(conf, dataset, now, create=False)
+    plan = {
+        "dataset": dataset,
+        "type": None,
+        "snapshot": None,
+        "base": None,
+        "estimate": None,
+        "size": 0,
+        "taken": False,
+    }
+    if os.path.isdir(backup_dir) and is_dump_in_progress(conf, backup_dir):
+        return plan
+    ratio = get_compression_ratio(dataset_dir) if os.path.exists(dataset_dir) else 1.0
+
+    tempdirs = [
+        x
+        for x in glob.glob(f"{backup_dir}/*.{TEMPDIR_SUFFIX}")
+        if read_checkpoint(x) is not None
+    ]
+    if len(tempdirs) > 0:
+        # the dead dumps are resumed (see resume_dumps), only the rest of their parts is written
+        plan["type"] = "resume"
+        for tempdir in sorted(tempdirs):
+            metadata = read_dump_metadata(tempdir)
+            snapshot_name = os.path.basename(tempdir).split(".")[0].split("##")[1]
+            base_snapshot_name = metadata.get("base_snapshot")
+            send_base = None
+            if base_snapshot_name is not None:
+                send_base = get_send_base(conf, dataset, base_snapshot_name)
+            estimate = None
+            if base_snapshot_name is None or send_base is not None:
+                estimate = zfs_send_estimate(
+                    conf,
+                    get_zfs_send_cmd(dataset, snapshot_name, send_base, metadata["send_mode"]),
+                )
+            if estimate is None:
+                # the snapshots are gone, the dump is deleted instead
+                continue
+            stored = sum(os.path.getsize(x) for x in get_dump_parts(tempdir))
+            plan.update(
+                snapshot=snapshot_name,
+                base=base_snapshot_name,
+                estimate=(plan["estimate"] or 0) + estimate,
+                size=plan["size"] + max(0, int(estimate * ratio) - stored),
+            )
+        return plan
+
+    base_snapshot_name = None
+    if os.path.isdir(backup_dir):
+        base_snapshot_name = get_and_verify_latest_snapshot(conf, backup_dir, dataset)
+    if base_snapshot_name is not None:
+        delta_days = (now - parse_timestamp(base_snapshot_name)) / (60.0 * 60 * 24)
+        if delta_days < conf.backup.interval_days.incremental:
+            return plan
+    snapshot_name = datetime.utcfromtimestamp(now).strftime(TIME_FORMAT)
+    plan.update(
+        type="full" if base_snapshot_name is None else "incr",
+        snapshot=snapshot_name,
+        base=base_snapshot_name,
+    )
+    if dry_run:
+        plan["estimate"] = zfs_property_estimate(conf, dataset, base_snapshot_name is not None)
+    else:
+        if not taken:
+            zfs_snapshot(conf, dataset, snapshot_name)
+        plan["taken"] = True
+        send_base = None
+        if base_snapshot_name is not None:
+            send_base = get_send_base(conf, dataset, base_snapshot_name)
+        plan["estimate"] = zfs_send_estimate(
+            conf, get_zfs_send_cmd(dataset, snapshot_name, send_base, get_send_mode(conf))
+        )
+    if plan["estimate"] is not None:
+        plan["size"] = int(plan["estimate"] * ratio)
+    return plan
+
+
+def get_min_free_space(conf):
+    return parse_size(conf.backup.get("min_free_space", 0))
+
+
+# admits the planned dumps that fit in the backup directory, largest first. the space reserved by
+# the running dumps on the same file system and backup.min_free_space are not available. the dumps past retention count as
+# free space, they are deleted before a dump that needs their space (without dry_run).
+# returns (admitted plans, deferred plans)
+def admit_dumps(conf, plans, now, dry_run=False):
+    min_free_space = get_min_free_space(conf)
+    with SPACE_LOCK:
+        free, expired = get_backup_space(conf, now)
+        target = get_backup_target(conf)
+        free -= min_free_space
+        free -= sum(size for dev, size in SPACE_RESERVED.values() if dev == target)
+        admitted, deferred = [], []
+        for plan in sorted(plans, key=lambda x: x["size"], reverse=True):
+            if plan["size"] > free + expired:
+                deferred.append(plan)
+                continue
+            if plan["size"] > free:
+                if not dry_run:
+                    for dataset in get_datasets(conf):
+                        dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+                        if os.path.exists(dataset_dir):
+                            delete_expired_dump_dirs(conf, dataset_dir, now)
+                free += expired
+                expired = 0
+            free -= plan["size"]
+            admitted.append(plan)
+            if not dry_run:
+                SPACE_RESERVED[(get_server_key(conf), plan["dataset"])] = (target, plan["size"])
+    return admitted, deferred
+
+
+def release_space(conf, dataset):
+    with SPACE_LOCK:
+        SPACE_RESERVED.pop((get_server_key(conf), dataset), None)
+
+
+# the dump does not fit in the backup directory, its snapshot is taken again once it fits
+def defer_dump(conf, plan):
+    log_error(
+        f"Not enough space in {conf.backup.directory} for the dump of {plan['dataset']} "
+        f"({plan['size'] / (1024.0 * 1024 * 1024):.2f} GB), deferring it"
+    )
+    if plan["taken"]:
+        try:
+            ssh_cmd(conf, ["zfs", "destroy", f"{plan['dataset']}@{plan['snapshot']}"])
+            forget_snapshot_list(conf, plan["dataset"])
+        except Exception as err:
+            log_error(f"Error destroying {plan['dataset']}@{plan['snapshot']} : {err}")
+
+
+# results are the datasets and trees whose planning failed
+def log_backup_plan(conf, datasets, plans, admitted, deferred, results, now):
+    free, expired = get_backup_space(conf, now)
+    log(
+        f"Backup plan, {free / (1024.0 * 1024 * 1024):.2f} GB free in {conf.backup.directory}, "
+        f"{expired / (1024.0 * 1024 * 1024):.2f} GB in dumps past retention:"
+    )
+    for plan in admitted + deferred:
+        dataset = plan["dataset"]
+        label = get_dataset_label(conf, dataset)
+        if plan["type"] is None:
+            log(f"\t{label} : nothing to dump")
+            continue
+        what = f"{plan['type']} dump of {dataset}@{plan['snapshot']}"
+        if plan["base"] is not None:
+            what += f" based on {plan['base']}"
+        if plan["estimate"] is None:
+            size = "stream size unknown"
+        else:
+            size = (
+                f"stream about {plan['estimate'] / (1024.0 * 1024 * 1024):.2f} GB, "
+                f"{plan['size'] / (1024.0 * 1024 * 1024):.2f} GB to write"
+            )
+        if plan in deferred:
+            log(f"\t{label} : deferred, not enough space for the {what} ({size})")
+        else:
+            log(f"\t{label} : {what} ({size})")
+    failed = {dataset: err for dataset, outcome, elapsed, err in results if outcome == "failed"}
+    for dataset in datasets:
+        label = get_dataset_label(conf, dataset)
+        if dataset in failed:
+            log(f"\t{label} : planning failed: {failed[dataset]}")
+        elif dataset not in plans:
+            due, _ = get_backup_due_time(conf, dataset, now)
+            log(f"\t{label} : not due until {format_time(due)}")
+
+
+# returns (dataset, outcome, elapsed seconds, error).
+# without a plan the dump is planned and admitted here.
+# with taken the snapshot was taken with the snapshot of the tree of the dataset
+def backup_dataset(conf, dataset, now, verify, plan=None, taken=False):
+    start = time.time()
+    try:
+        outcome = plan_dataset(conf, dataset, now)
+        if outcome is None:
+            if plan is None:
+                plan = plan_dump(conf, dataset, now, taken=taken)
+                _, deferred = admit_dumps(conf, [plan], now)
+                if len(deferred) > 0:
+                    defer_dump(conf, plan)
+                    return dataset, "deferred", time.time() - start, None
+            backup_dir = get_backup_directory(conf, dataset, now)
+            outcome = snapshot(conf, backup_dir, dataset, now, verify, taken=plan["taken"])
+        return dataset, outcome, time.time() - start, None
+    except DumpStopped as err:
+        log(f"Stopped backing up {get_dataset_label(conf, dataset)} : {err}")
+        return dataset, "stopped", time.time() - start, None
+    except Exception as err:
+        log_error(f"Error backing up {get_dataset_label(conf, dataset)} : {err}")
+        return dataset, "failed", time.time() - start, err
+    finally:
+        release_space(conf, dataset)
+        # the next backup of the dataset lists its snapshots and bookmarks again
+        forget_snapshot_list(conf, dataset)
+
+
+# backs up the datasets of a tree one after the other, from one snapshot of the whole tree.
+# returns (root, outcome, elapsed seconds, error), the outcome of the root unless a dataset of
+# the tree failed or was deferred
+def backup_tree(conf, root, now, verify):
+    start = time.time()
+    try:
+        datasets = snapshot_tree(conf, root, now)
+    except Exception as err:
+        log_error(f"Error snapshotting the tree of {root} : {err}")
+        return root, "failed", time.time() - start, err
+    try:
+        results = [backup_dataset(conf, dataset, now, verify, taken=True) for dataset in datasets]
+    finally:
+        # the daemon lists the snapshots again for the next backup of the tree
+        forget_snapshot_list(conf, root, recursive=True)
+    outcome, error = results[0][1], None
+    for dataset, dataset_outcome, elapsed, err in results:
+        if dataset_outcome == "failed" and error is None:
+            outcome, error = "failed", err
+        elif dataset_outcome == "deferred" and error is None:
+            outcome = "deferred"
+    return root, outcome, time.time() - start, error
+
+
+# the datasets of the recursive roots that are due are backed up from one snapshot of their tree,
+# the roots that are not due stand for the datasets their last backup found.
+# returns (datasets, datasets whose snapshot is taken, results of the trees that failed)
+def expand_backup_units(conf, units, now, dry_run=False):
+    roots = get_recursive_roots(conf)
+    datasets, taken, results = [], set(), []
+    for unit in units:
+        if unit not in roots or get_backup_due_time(conf, unit, now)[0] > now:
+            datasets += get_unit_datasets(conf, unit)
+            continue
+        try:
+            tree = snapshot_tree(conf, unit, now, dry_run)
+        except Exception as err:
+            log_error(f"Error snapshotting the tree of {unit} : {err}")
+            datasets.append(unit)
+            results.append((unit, "failed", 0.0, err))
+            continue
+        datasets += tree
+        if not dry_run:
+            taken.update(tree)
+    return list(dict.fromkeys(datasets)), taken, results
+
+
+# plans the backup run of a server : the trees of the due recursive roots are snapshotted, the
+# streams of the due datasets are estimated and their dumps admitted. returns {"conf", "datasets",
+# "taken", "failed_trees", "due", "plans", "admitted", "deferred", "results"}
+def plan_backup(conf, units, now, jobs, dry_run=False):
+    datasets, taken, results = expand_backup_units(conf, units, now, dry_run)
+    failed_trees = [dataset for dataset, outcome, elapsed, err in results]
+    # the snapshots of all the datasets that are due are listed at once, the snapshots of the
+    # trees were listed with the trees
+    due = [
+        dataset
+        for dataset in datasets
+        if dataset not in failed_trees and get_backup_due_time(conf, dataset, now)[0] <= now
+    ]
+    plan_snapshot_lists(conf, [dataset for dataset in due if dataset not in taken])
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the streams of the due datasets are estimated before anything is dumped
+    plans = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            (dataset, executor.submit(plan_dump, conf, dataset, now, dry_run, dataset in taken))
+            for dataset in due
+        ]
+        for dataset, future in futures:
+            try:
+                plans[dataset] = future.result()
+            except Exception as err:
+                label = get_dataset_label(conf, dataset)
+                log_error(f"Error planning the backup of {label} : {err}")
+                results.append((dataset, "failed", 0.0, err))
+    admitted, deferred = admit_dumps(conf, list(plans.values()), now, dry_run)
+    return {
+        "conf": conf,
+        "datasets": datasets,
+        "taken": taken,
+        "failed_trees": failed_trees,
+        "due": due,
+        "plans": plans,
+        "admitted": admitted,
+        "deferred": deferred,
+        "results": results,
+    }
+
+
+# the servers are planned concurrently, then the dumps of all the servers share the
+# backup.max_parallel workers : the next dump goes to the server with the fewest running dumps,
+# at most backup.max_sends_per_server run per server (see scheduler.py)
 def backup(conf, args):
     now = int(time.time())  # UTC unixtime
     verify = not args.no_verify
-    if args.dataset:
-        backup_dir = get_backup_directory(conf, args.dataset, now)
-        snapshot(conf, backup_dir, args.dataset, now, verify)
-    else:
-        for dataset in conf.backup.datasets:
-            backup_dir = get_backup_directory(conf, dataset, now)
-            snapshot(conf, backup_dir, dataset, now, verify)
+    servers = get_dataset_servers(get_servers(conf, args.server), args.dataset)
+    jobs = args.jobs
+    if jobs is None:
+        jobs = conf.backup.get("max_parallel", 1)
+
+    # checked before the planning takes any snapshot
+    get_min_free_space(conf)
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(servers)))) as executor:
+        futures = [
+            executor.submit(
+                plan_backup,
+                server,
+                [args.dataset] if args.dataset else get_backup_units(server),
+                now,
+                jobs,
+                args.dry_run,
+            )
+            for server in servers
+        ]
+        runs = [future.result() for future in futures]
+    if args.dry_run:
+        for run in runs:
+            log_backup_plan(
+                run["conf"],
+                run["datasets"],
+                run["plans"],
+                run["admitted"],
+                run["deferred"],
+                run["results"],
+                now,
+            )
+        return 1 if any(len(run["results"]) > 0 for run in runs) else 0
+
+    # each task runs get_backup_directory + snapshot for one dataset,
+    # a failure in one dataset does not stop the others.
+    tasks = []
+    for run in runs:
+        server = run["conf"]
+        for plan in run["deferred"]:
+            defer_dump(server, plan)
+            run["results"].append((plan["dataset"], "deferred", 0.0, None))
+        # the largest dumps of each server start first, they bound the length of a parallel run
+        order = [plan["dataset"] for plan in run["admitted"]]
+        order += [
+            dataset
+            for dataset in run["datasets"]
+            if dataset not in run["due"] and dataset not in run["failed_trees"]
+        ]
+        for dataset in order:
+            tasks.append(
+                (
+                    get_server_key(server),
+                    functools.partial(
+                        backup_dataset,
+                        server,
+                        dataset,
+                        now,
+                        verify,
+                        run["plans"].get(dataset),
+                        dataset in run["taken"],
+                    ),
+                )
+            )
+        run["tasks"] = len(order)
+    from snapdump.scheduler import run_fair
+
+    results = run_fair(tasks, jobs, conf.backup.get("max_sends_per_server", 0))
+    for run in runs:
+        run["results"] += results[: run["tasks"]]
+        results = results[run["tasks"] :]
+        run["results"].sort(key=lambda x: run["datasets"].index(x[0]))
+
+    log("Backup summary:")
+    failed, deferred = [], []
+    for run in runs:
+        for dataset, outcome, elapsed, err in run["results"]:
+            label = get_dataset_label(run["conf"], dataset)
+            log(f"\t{label} : {outcome} ({elapsed:.1f} seconds)")
+            REPORT.add_backup(label, outcome, elapsed)
+            if err is not None:
+                failed.append(label)
+            elif outcome == "deferred":
+                deferred.append(label)
+    if len(failed) > 0:
+        log_error(f"Backup failed for {', '.join(failed)}")
+    if len(deferred) > 0:
+        log_error(f"Backup deferred for {', '.join(deferred)}, not enough space")
+    if len(failed) > 0 or len(deferred) > 0:
+        return 1
+    return 0
 
 
 def get_snapshots_chain(dataset_dir, snapshot_name):
@@ -288,20 +1570,10 @@ def get_snapshots_chain(dataset_dir, snapshot_name):
         raise Exception(f"Directory does not exist {dataset_dir}")
     # finds group:
     snapshots = get_stored_snapshots(dataset_dir)
-    groups = [
-        group_dir
-        for group_dir, snap_type, snap_name, directory in snapshots
-        if snap_name == snapshot_name
-    ]
+    groups = [x["group"] for x in snapshots if x["snapshot"] == snapshot_name]
     if len(groups) == 0:
         raise Exception(f"snapshot '{snapshot_name}' does not exist")
-    group = groups[0]
-
-    def index_of(lst, predicate):
-        for idx, e in enumerate(lst):
-            if predicate(e):
-                return idx
-        return -1
+    group_dir = groups[0]
 
     def index_of(lst, predicate):
         for idx, e in enumerate(lst):
@@ -309,71 +1581,294 @@ def get_snapshots_chain(dataset_dir, snapshot_name):
                 return idx
         return -1
 
-    # finds group:
-    snapshots = get_stored_snapshots(dataset_dir)
-    group_dir = [
-        group_dir
-        for group_dir, snap_type, snap_name, directory in snapshots
-        if snap_name == snapshot_name
-    ][0]
-
-    # group_dir, snap_type, snap_name, dir
-    first_index = index_of(snapshots, lambda x: x[0] == group_dir)
-    last_index = index_of(snapshots, lambda x: x[2] == snapshot_name)
+    first_index = index_of(snapshots, lambda x: x["group"] == group_dir)
+    last_index = index_of(snapshots, lambda x: x["snapshot"] == snapshot_name)
     assert first_index != -1 and last_index != -1
     return snapshots[first_index : last_index + 1]
 
 
+def get_restore_settings(conf):
+    restore_conf = conf.get("restore", None)
+    if restore_conf is None:
+        restore_conf = {}
+    return {"prefetch_size": parse_size(restore_conf.get("prefetch_size", "256M"))}
+
+
+# returns the snapshot names of the destination dataset, None if the destination dataset does not exist
+def zfs_get_dest_snapshots(conf, dest_dataset):
+    from snapdump.engine import CommandTimeout
+
+    try:
+        out = ssh_cmd(conf, zfs_list_snapshots_cmd(dest_dataset), stderr=DEVNULL)
+    except (CalledProcessError, CommandTimeout):
+        return None
+    return [x.split("@")[1] for x in get_lines(out) if x.split("@")[0] == dest_dataset]
+
+
+def restore_dataset(conf, dataset, snapshot_name, dest_dataset):
+    log(f"Restoring snapshot {dataset}@{snapshot_name} to {dest_dataset}")
+    dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+    chain = get_snapshots_chain(dataset_dir, snapshot_name)
+
+    # an interrupted restore continues from the first stream that is not on the destination.
+    # streams are received without zfs recv -s, a resume token is continued by zfs send -t from the
+    # source snapshot, a dump cannot be fed from the offset of the token
+    dest_snapshots = zfs_get_dest_snapshots(conf, dest_dataset)
+    if dest_snapshots is not None:
+        skipped = 0
+        while skipped < len(chain) and chain[skipped]["snapshot"] in dest_snapshots:
+            skipped += 1
+        if skipped > 0:
+            log(f"Skipping {skipped} stream(s) already received by {dest_dataset}")
+            chain = chain[skipped:]
+
+    # the next streams are read and decompressed while the current one is received.
+    # the dumps that were compressed on the server are sent compressed and decompressed there,
+    # whatever the current compression.at setting is
+    settings = get_restore_settings(conf)
+    prefetcher = Prefetcher(
+        [
+            read_dump_cmds(dataset_dir, entry, decompress=not is_remote(entry["compression"]))
+            for entry in chain
+        ],
+        settings["prefetch_size"],
+    )
+    prefetcher.start()
+    try:
+        for entry, read_stage in zip(chain, prefetcher.stats):
+            log(f"Receiving {entry['type']} stream {dataset}@{entry['snapshot']}")
+            stages = {"read": read_stage, "recv": Stage("recv")}
+            recv_stage = stages["recv"]
+            recv_cmd = get_recv_cmd(entry, dest_dataset)
+            if is_remote(entry["compression"]):
+                recv_cmd = [remote_pipeline([decompress_cmd(entry["compression"]), recv_cmd])]
+            ssh = Popen(
+                get_ssh_cmd_arr(conf) + recv_cmd,
+                stdin=PIPE,
+                bufsize=0,
+            )
+            progress_key = f"{dest_dataset}@{entry['snapshot']}"
+            PROGRESS.start(progress_key, entry.get("stream", {}).get("bytes"))
+            try:
+                for chunk in prefetcher.stream():
+                    recv_stage.throttled_seconds += LIMITER.consume(len(chunk))
+                    start = time.perf_counter()
+                    ssh.stdin.write(chunk)
+                    recv_stage.stall_seconds += time.perf_counter() - start
+                    recv_stage.bytes += len(chunk)
+                    PROGRESS.update(progress_key, recv_stage.bytes)
+                ssh.stdin.close()
+            except BrokenPipeError:
+                # zfs recv failed, its exit code is checked below
+                pass
+            except BaseException:
+                ssh.kill()
+                ssh.wait()
+                raise
+            finally:
+                PROGRESS.finish(progress_key)
+            recv_stage.cpu_seconds = wait_process(ssh)
+            ensure_clean_exit(ssh)
+            recv_stage.stop()
+            # the recv stage is idle while it waits for data
+            recv_stage.idle_seconds = read_stage.stall_seconds
+            REPORT.add(
+                "restore",
+                get_dataset_label(conf, dataset),
+                entry["snapshot"],
+                stages,
+                dest=dest_dataset,
+            )
+            log(f"\tReceived {recv_stage.bytes / (1024 * 1024):.1f} MB : {format_stages(stages)}")
+    finally:
+        prefetcher.close()
+
+
+# with recursive the dataset and all its children that have a dump of the snapshot are restored,
+# parents before their children, under the destination dataset
 def restore(conf, args):
     dataset, snapshot_name = args.snapshot.split("@")
+    conf = get_dataset_server(get_servers(conf, args.server), dataset)
     dest_dataset = args.dest_dataset
     if dest_dataset is None:
         dest_dataset = f"{dataset}_restore"
-    log(f"Restoring snapshot {dataset}@{snapshot_name} to {dest_dataset}")
-    dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
-    for group_dir, snap_type, snap_name, directory in get_snapshots_chain(
-        dataset_dir, snapshot_name
-    ):
-        files = [
-            f"{dataset_dir}/{directory}/{file}"
-            for file in sorted(os.listdir(f"{dataset_dir}/{directory}"))
-        ]
-        cat = Popen(["cat"] + files, stdout=PIPE)
-        gunzip = chain(cat, ["gunzip", "-c"])
-        ssh = chain(gunzip, get_ssh_cmd_arr(conf) + ["zfs", "recv", "-F", dest_dataset])
-        cat.stdout.close()
-        gunzip.stdout.close()
-        ssh.communicate()
-        cat.wait()
-        gunzip.wait()
-        ensure_clean_exit(ssh)
-        ensure_clean_exit(gunzip)
-        ensure_clean_exit(cat)
-
-
-def verify_impl(conf, dataset, snapshot_name):
-    log(f"Verifying snapshot {dataset}@{snapshot_name}")
-    dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+    if not args.recursive:
+        restore_dataset(conf, dataset, snapshot_name, dest_dataset)
+        return
+    datasets = sorted(
+        x for x in get_datasets(conf) if x == dataset or x.startswith(f"{dataset}/")
+    )
+    restored = 0
+    for name in datasets:
+        dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(name)}"
+        if not os.path.exists(dataset_dir) or snapshot_name not in [
+            entry["snapshot"] for entry in get_catalog(dataset_dir).values()
+        ]:
+            log(f"No dump of {name}@{snapshot_name}, skipping it")
+            continue
+        restore_dataset(conf, name, snapshot_name, dest_dataset + name[len(dataset) :])
+        restored += 1
+    if restored == 0:
+        raise Exception(f"snapshot '{snapshot_name}' does not exist in the tree of {dataset}")
+    log(f"Restored {restored} datasets of the tree of {dataset}@{snapshot_name}")
+
+
+def get_verify_settings(conf):
+    verify_conf = conf.get("verify", None)
+    if verify_conf is None:
+        verify_conf = {}
+    mode = verify_conf.get("mode", "local")
+    if mode not in VERIFY_MODES:
+        raise Exception(
+            f"Unsupported verify mode '{mode}', supported modes : {', '.join(VERIFY_MODES)}"
+        )
+    checksums = verify_conf.get("checksums", "auto")
+    if checksums == "auto":
+        from snapdump import zstream
+
+        # checksum verification without numpy is too slow for large dumps
+        checksums = zstream.numpy is not None
+    return mode, checksums
+
+
+# a file wrapper that accounts the time spent waiting for reads to a stage
+class MeteredReader:
+    def __init__(self, f, stage, progress_key=None):
+        self.f = f
+        self.stage = stage
+        self.progress_key = progress_key
+
+    def read(self, n):
+        start = time.perf_counter()
+        data = self.f.read(n)
+        self.stage.stall_seconds += time.perf_counter() - start
+        self.stage.bytes += len(data)
+        if self.progress_key is not None:
+            PROGRESS.update(self.progress_key, self.stage.bytes)
+        return data
+
+
+# parses the stream of a dump locally, returns the stream description (see zstream.parse_stream)
+def verify_dump_local(dataset, dataset_dir, entry, verify_checksums):
+    # imported on use, numpy makes it slow to import
+    from snapdump import zstream
+
+    stages = new_stages("read", "parse")
+    processes = start_pipeline(
+        read_dump_cmds(dataset_dir, entry), bufsize=zstream.DEFAULT_READ_SIZE
+    )
+    progress_key = f"{dataset}@{entry['snapshot']}"
+    PROGRESS.start(progress_key, entry.get("stream", {}).get("bytes"))
+    cpu_start = time.thread_time()
+    try:
+        stream = zstream.parse_stream(
+            MeteredReader(processes[-1].stdout, stages["read"], progress_key),
+            verify_checksums,
+        )
+    except zstream.StreamError as err:
+        kill_pipeline(processes)
+        raise Exception(
+            f"Corrupted zfs stream in {dataset_dir}/{entry['directory']} : {err}"
+        )
+    finally:
+        PROGRESS.finish(progress_key)
+    stages["parse"].cpu_seconds = time.thread_time() - cpu_start
+    stages["parse"].bytes = stream["bytes"]
+    # the reading pipeline is idle while the stream is parsed
+    stages["read"].cpu_seconds = reap_pipeline(processes)
+    stop_stages(stages)
+    stages["read"].idle_seconds = stages["read"].wall_seconds - stages["read"].stall_seconds
+    stages["parse"].stall_seconds = stages["read"].idle_seconds
+    REPORT.add("verify", dataset, entry["snapshot"], stages)
+    if VERBOSE:
+        log(f"Verified {entry['directory']} : {format_stages(stages)}")
+    return stream
+
+
+# The guids and checksum of each dump are stored in its metadata once it is verified.
+# Unless full is True, only dumps from the first dump without a stored stream are read and
+# the first one is chained to the stored toguid of its predecessor. if all the dumps were
+# verified before only the last one is read again.
+def verify_local(dataset, dataset_dir, snapshots_chain, verify_checksums, full=False):
+    start = 0
+    if not full:
+        unverified = [idx for idx, e in enumerate(snapshots_chain) if "stream" not in e]
+        start = unverified[0] if len(unverified) > 0 else len(snapshots_chain) - 1
+
+    prev_to_guid = None
+    for idx, entry in enumerate(snapshots_chain):
+        snap_name = entry["snapshot"]
+        if idx < start:
+            stream = entry["stream"]
+        else:
+            if VERBOSE:
+                log(f"Reading {dataset_dir}/{entry['directory']}")
+            parsed = verify_dump_local(dataset, dataset_dir, entry, verify_checksums)
+            stream = {
+                "toguid": f"{parsed['toguid']:x}",
+                "fromguid": f"{parsed['fromguid']:x}",
+                "checksum": parsed["checksum"],
+                "bytes": parsed["bytes"],
+            }
+            stored = entry.get("stream", None)
+            if stored is not None and (
+                stored["toguid"] != stream["toguid"]
+                or stored["checksum"] != stream["checksum"]
+            ):
+                raise Exception(
+                    f"Stream of {snap_name} differs from the stream verified before"
+                )
+        from_guid = stream["fromguid"]
+        if from_guid != "0" and from_guid != prev_to_guid:
+            raise Exception(
+                f"Mismatch in guid chain at {snap_name} : {from_guid} != {prev_to_guid}"
+            )
+        prev_to_guid = stream["toguid"]
+        if idx >= start:
+            update_dump_metadata(
+                dataset_dir, entry, stream=dict(stream, verified=int(time.time()))
+            )
+
 
-    files = []
-    for group_dir, snap_type, snap_name, directory in get_snapshots_chain(
-        dataset_dir, snapshot_name
-    ):
-        files += [
-            f"{dataset_dir}/{directory}/{file}"
-            for file in sorted(os.listdir(f"{dataset_dir}/{directory}"))
+def verify_remote(conf, dataset_dir, snapshots_chain):
+    # dumps in the chain may use different codecs, each one is decompressed on its own
+    # into a single zstreamdump.
+    # a chain of dumps of a single codec that were all compressed on the server is decompressed
+    # on the server, whatever the current compression.at setting is
+    decompress_cmds = {
+        json.dumps(decompress_cmd(entry["compression"])) for entry in snapshots_chain
+    }
+    remote = all(is_remote(entry["compression"]) for entry in snapshots_chain)
+    if remote and len(decompress_cmds) == 1:
+        decompress = decompress_cmd(snapshots_chain[0]["compression"])
+        sources = [
+            read_dump_cmds(dataset_dir, entry, decompress=False) for entry in snapshots_chain
+        ]
+        zstreamdump_cmd = get_ssh_cmd_arr(conf) + [
+            remote_pipeline([decompress, ["zstreamdump"]])
         ]
-    cat = Popen(["cat"] + files, stdout=PIPE)
-    gunzip = chain(cat, ["gunzip", "-c"])
-    ssh = chain(gunzip, get_ssh_cmd_arr(conf) + ["zstreamdump"])
-    cat.stdout.close()
-    gunzip.stdout.close()
-    out = ssh.communicate()
-    cat.wait()
-    gunzip.wait()
-    ensure_clean_exit(ssh)
-    ensure_clean_exit(gunzip)
-    ensure_clean_exit(cat)
+    else:
+        sources = [read_dump_cmds(dataset_dir, entry) for entry in snapshots_chain]
+        zstreamdump_cmd = get_ssh_cmd_arr(conf) + ["zstreamdump"]
+
+    # the sources are run one after the other into zstreamdump ((cat 1; cat 2; ..) | zstreamdump),
+    # its output is read by a thread while they run
+    zstreamdump = Popen(zstreamdump_cmd, stdin=PIPE, stdout=PIPE)
+    output = []
+    reader = threading.Thread(target=lambda: output.append(zstreamdump.stdout.read()), daemon=True)
+    reader.start()
+    try:
+        for commands in sources:
+            reap_pipeline(start_pipeline(commands, stdout=zstreamdump.stdin))
+        zstreamdump.stdin.close()
+        reader.join()
+        zstreamdump.wait()
+    except BaseException:
+        zstreamdump.kill()
+        zstreamdump.wait()
+        raise
+    ensure_clean_exit(zstreamdump)
+    lines = output[0].splitlines()
 
     from_guid = -1
     to_guid = -1
@@ -381,7 +1876,7 @@ def verify_impl(conf, dataset, snapshot_name):
     # toguid = 6314ecefe1c7f1d8
     # fromguid = 0
     reg = re.compile(r"(toguid|fromguid) = ([\w]+)")
-    for s in out[0].splitlines():
+    for s in lines:
         s = s.decode("utf-8").strip()
         m = reg.match(s)
         if m:
@@ -394,31 +1889,44 @@ def verify_impl(conf, dataset, snapshot_name):
                 from_guid = guid
                 if from_guid != "0" and from_guid != prev_to_guid:
                     raise Exception(
-                        f"Mistmatch in guid chain : {from_guid} != {to_guid}"
+                        f"Mismatch in guid chain : {from_guid} != {prev_to_guid}"
                     )
+
+
+def verify_impl(conf, dataset, snapshot_name, mode=None, full=False):
+    log(f"Verifying snapshot {get_dataset_label(conf, dataset)}@{snapshot_name}")
+    dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+    conf_mode, verify_checksums = get_verify_settings(conf)
+    if mode is None:
+        mode = conf_mode
+    snapshots_chain = get_snapshots_chain(dataset_dir, snapshot_name)
+    if mode in ("local", "both"):
+        verify_local(
+            get_dataset_label(conf, dataset), dataset_dir, snapshots_chain, verify_checksums, full
+        )
+    if mode in ("remote", "both"):
+        verify_remote(conf, dataset_dir, snapshots_chain)
     log("ZFS stream intact")
 
 
 def verify(conf, args):
     dataset, snapshot_name = args.snapshot.split("@")
-    verify_impl(conf, dataset, snapshot_name)
+    conf = get_dataset_server(get_servers(conf, args.server), dataset)
+    verify_impl(conf, dataset, snapshot_name, args.mode, args.full)
 
 
-def list_dataset_snapshots(conf, dataset):
-    print(f"{dataset}:")
+def list_dataset_snapshots(conf, dataset, entries=None):
+    print(f"{get_dataset_label(conf, dataset)}:")
     dataset_dir = "%s/%s" % (conf.backup.directory, normalize_dataset_name(dataset))
-    if os.path.exists(dataset_dir):
+    if entries is None and os.path.exists(dataset_dir):
+        entries = get_stored_snapshots(dataset_dir)
+    if entries is not None:
         total = 0
-        for (group_dir, snap_type, snap_name, directory) in get_stored_snapshots(
-            dataset_dir
-        ):
-            dump_dir = f"{dataset_dir}/{directory}"
+        for entry in entries:
+            snap_type = entry["type"]
+            snap_name = entry["snapshot"]
             marker = "=" if snap_type == "full" else "+"  # = full, + = incremental
-            size_bytes = sum(
-                os.path.getsize(f"{dump_dir}/{f}")
-                for f in os.listdir(dump_dir)
-                if os.path.isfile(f"{dump_dir}/{f}")
-            )
+            size_bytes = get_entry_size(entry)
             total += size_bytes
             size_gb = size_bytes / (1024.0 * 1024 * 1024)
             total_gb = total / (1024.0 * 1024 * 1024)
@@ -428,69 +1936,451 @@ def list_dataset_snapshots(conf, dataset):
             print(f"\t{marker} {dataset}@{snap_name}, {size_str} GB")
 
 
-def cleanup_dataset_snapshots(conf, dataset):
+# groups the expired snapshots into zfs destroy specs. snapshot_names are all the snapshots of the
+# dataset in creation order, runs of expired snapshots that are next to each other become ranges
+# (first%last) and the other expired snapshots are listed one by one
+def get_destroy_specs(snapshot_names, expired):
+    specs = []
+    run = []
+    for name in snapshot_names + [None]:
+        if name is not None and name in expired:
+            run.append(name)
+            continue
+        if len(run) > 2:
+            specs.append(f"{run[0]}%{run[-1]}")
+        else:
+            specs += run
+        run = []
+    return specs
+
+
+# destroys the snapshots with one zfs destroy per DESTROY_BATCH_SIZE specs (comma separated).
+# with dry_run nothing is destroyed, returns the number of bytes that would be reclaimed
+def zfs_destroy_snapshots(conf, dataset, specs, dry_run=False):
+    reclaim = 0
+    if not dry_run:
+        forget_snapshot_list(conf, dataset)
+    for idx in range(0, len(specs), DESTROY_BATCH_SIZE):
+        batch = ",".join(specs[idx : idx + DESTROY_BATCH_SIZE])
+        if dry_run:
+            out = ssh_cmd(conf, ["zfs", "destroy", "-nvp", f"{dataset}@{batch}"])
+            for line in get_lines(out):
+                fields = line.split("\t")
+                if fields[0] == "reclaim":
+                    reclaim += int(fields[1])
+        else:
+            ssh_cmd(conf, ["zfs", "destroy", f"{dataset}@{batch}"])
+    return reclaim
+
+
+# returns the group directories of a dataset that are past retention
+def get_expired_group_dirs(conf, dataset_dir, now):
+    return [
+        directory
+        for directory in get_group_dirs(dataset_dir)
+        if conf.backup.retention_days <= (now - int(parse_timestamp(directory))) / (60.0 * 60 * 24)
+    ]
+
+
+def get_group_size(catalog, directory):
+    return sum(get_entry_size(entry) for entry in catalog.values() if entry["group"] == directory)
+
+
+def delete_expired_dump_dirs(conf, dataset_dir, now, dry_run=False):
+    catalog = get_catalog(dataset_dir)
+    deleted = False
+    for directory in get_expired_group_dirs(conf, dataset_dir, now):
+        if dry_run:
+            log(
+                f"Would delete old snapshot dir {dataset_dir}/{directory}, "
+                f"{get_group_size(catalog, directory) / (1024.0 * 1024 * 1024):.2f} GB"
+            )
+            continue
+        log(f"Deleting old snapshot dir {dataset_dir}/{directory}")
+        # remove from the catalog first, a dump in the catalog must always exist on disk
+        append_catalog(dataset_dir, [{"op": "remove_group", "group": directory}])
+        shutil.rmtree(f"{dataset_dir}/{directory}")
+        deleted = True
+    if deleted:
+        compact_catalog(dataset_dir)
+
+
+# deletes the chunks that no dump of the dataset lists any more (backup.store: chunks).
+# with dry_run the dumps past retention are not deleted yet, their chunks are counted as deleted
+def collect_chunk_garbage(conf, dataset_dir, now, dry_run=False):
+    store_dir = f"{dataset_dir}/{CHUNK_STORE_DIR}"
+    if not os.path.exists(store_dir):
+        return
+    from snapdump.chunks import ChunkStore, collect_garbage
+
+    expired = get_expired_group_dirs(conf, dataset_dir, now) if dry_run else []
+    result = collect_garbage(
+        ChunkStore(store_dir), get_dump_dirs(dataset_dir, exclude_groups=expired), dry_run
+    )
+    if result is None:
+        log(f"Skipping chunk garbage collection of {dataset_dir}, a dump is writing chunks")
+        return
+    count, size = result
+    if count > 0:
+        action = "Would delete" if dry_run else "Deleted"
+        log(
+            f"{action} {count} unreferenced chunks of {dataset_dir}, "
+            f"{size / (1024.0 * 1024 * 1024):.2f} GB"
+        )
+
+
+def cleanup_dataset_snapshots(conf, dataset, dry_run=False):
     now = int(time.time())  # UTC unixtime
     dataset_dir = "%s/%s" % (conf.backup.directory, normalize_dataset_name(dataset))
     if not os.path.exists(dataset_dir):
         raise Exception(f"Directory does not exist {dataset_dir}")
+    from snapdump.engine import ENGINE
+
+    # the zfs snapshots are listed while the old dump dirs are deleted, unless they were listed
+    # with the snapshots of the tree of the dataset
+    with SNAPSHOT_LISTS_LOCK:
+        snapshots = SNAPSHOT_LISTS.get((get_server_key(conf), dataset))
+    if snapshots is None:
+        snapshots_future = ENGINE.submit(ssh_cmd_async(conf, zfs_list_snapshots_cmd(dataset)))
+    settings = get_bookmark_settings(conf)
+    if settings["enabled"]:
+        bookmarks_future = ENGINE.submit(ssh_cmd_async(conf, zfs_list_bookmarks_cmd(dataset)))
+
     # Cleaning up old snapshot dump dirs
-    for directory in os.listdir(dataset_dir):
-        timestamp = int(parse_timestamp(directory))
-        delta_seconds = now - timestamp
-        if conf.backup.retention_days <= delta_seconds / (60.0 * 60 * 24):
-            log(f"Deleting old snapshot dir {dataset_dir}/{directory}")
-            shutil.rmtree(f"{dataset_dir}/{directory}")
+    delete_expired_dump_dirs(conf, dataset_dir, now, dry_run)
+    collect_chunk_garbage(conf, dataset_dir, now, dry_run)
 
     # Cleaning up old zfs snapshots
-    for snapshot_name in [
-        x.split("@")[1] for x in zfs_get_dataset_snapshots(conf, dataset)
-    ]:
+    if snapshots is None:
+        snapshots = get_lines(snapshots_future.result())
+    snapshot_names = [x.split("@")[1] for x in snapshots if x.split("@")[0] == dataset]
+    expired = set()
+    for snapshot_name in snapshot_names:
         timestamp = int(parse_timestamp(snapshot_name))
         # manual snapshots will not have parseable timestamp, we should leave those alone
         if timestamp != 0:
             delta_seconds = now - timestamp
             if conf.backup.retention_days <= delta_seconds / (60.0 * 60 * 24):
-                log(f"Deleting old ZFS snapshot {dataset}@{snapshot_name} from server")
-                ssh_cmd(conf, ["zfs", "destroy", f"{dataset}@{snapshot_name}"])
+                expired.add(snapshot_name)
+
+    # dumped snapshots that have a bookmark are not needed for the next incremental, all but the
+    # newest backup.bookmarks.keep_snapshots are destroyed before retention
+    bookmarked = set()
+    if settings["enabled"]:
+        bookmarks = [
+            x.split("#")[1]
+            for x in get_lines(bookmarks_future.result())
+            if x.split("#")[0] == dataset
+        ]
+        dumped = sorted(
+            {entry["snapshot"] for entry in get_catalog(dataset_dir).values()}, key=parse_timestamp
+        )
+        keep = settings["keep_snapshots"]
+        if keep is not None:
+            on_server = [x for x in dumped if x in snapshot_names and x not in expired]
+            bookmarked = {x for x in on_server[: max(0, len(on_server) - keep)] if x in bookmarks}
+        cleanup_bookmarks(conf, dataset, bookmarks, dumped[-1] if dumped else None, now, dry_run)
+
+    if len(expired) + len(bookmarked) == 0:
+        return
+    specs = get_destroy_specs(snapshot_names, expired | bookmarked)
+    what = []
+    if len(expired) > 0:
+        what.append(f"{len(expired)} old ZFS snapshots")
+    if len(bookmarked) > 0:
+        what.append(f"{len(bookmarked)} dumped ZFS snapshots with a bookmark")
+    what = " and ".join(what)
+    if dry_run:
+        reclaim = zfs_destroy_snapshots(conf, dataset, specs, dry_run=True)
+        log(
+            f"Would delete {what} of {get_dataset_label(conf, dataset)} ({', '.join(specs)}), "
+            f"reclaiming {reclaim / (1024.0 * 1024 * 1024):.2f} GB"
+        )
+    else:
+        log(f"Deleting {what} of {get_dataset_label(conf, dataset)} from server ({', '.join(specs)})")
+        zfs_destroy_snapshots(conf, dataset, specs)
+
+
+# destroys the bookmarks past retention, except the bookmark of the newest dumped snapshot (newest),
+# the next incremental may be sent from it
+def cleanup_bookmarks(conf, dataset, bookmarks, newest, now, dry_run=False):
+    expired = [
+        name
+        for name in bookmarks
+        if name != newest
+        and parse_timestamp(name) != 0
+        and conf.backup.retention_days <= (now - parse_timestamp(name)) / (60.0 * 60 * 24)
+    ]
+    if len(expired) == 0:
+        return
+    if dry_run:
+        log(f"Would delete {len(expired)} old ZFS bookmarks of {dataset} ({', '.join(expired)})")
+        return
+    log(f"Deleting {len(expired)} old ZFS bookmarks of {dataset} from server ({', '.join(expired)})")
+    with SNAPSHOT_LISTS_LOCK:
+        BOOKMARK_LISTS.pop((get_server_key(conf), dataset), None)
+    # zfs destroy takes a single bookmark
+    for name in expired:
+        ssh_cmd(conf, ["zfs", "destroy", f"{dataset}#{name}"])
+
+
+# cleans up the datasets of a backup unit, the snapshots of a tree are listed at once
+def cleanup_unit(conf, dataset, dry_run=False):
+    if dataset not in get_recursive_roots(conf):
+        cleanup_dataset_snapshots(conf, dataset, dry_run)
+        return
+    datasets = get_unit_datasets(conf, dataset)
+    plan_tree_snapshot_lists(conf, dataset, datasets)
+    try:
+        for name in datasets:
+            # datasets of the tree whose first dump failed have no directory
+            if os.path.exists(f"{conf.backup.directory}/{normalize_dataset_name(name)}"):
+                cleanup_dataset_snapshots(conf, name, dry_run)
+    finally:
+        forget_snapshot_list(conf, dataset, recursive=True)
 
 
 def list_snapshots(conf, args):
-    if args.dataset is not None:
-        list_dataset_snapshots(conf, args.dataset)
-    else:
-        # list all dataset snapshots
-        for dataset in conf.backup.datasets:
-            list_dataset_snapshots(conf, dataset)
+    for server in get_dataset_servers(get_servers(conf, args.server), args.dataset):
+        datasets = get_command_datasets(server, args.dataset)
+        # a running daemon answers from its cached catalogs
+        response = daemon_request(
+            server,
+            {
+                "command": "list",
+                "server": server.server.get("name", None),
+                "datasets": list(datasets),
+            },
+        )
+        for dataset in datasets:
+            entries = None if response is None else response["datasets"].get(dataset)
+            list_dataset_snapshots(server, dataset, entries)
+
+
+# returns a list of (entry, part name, error) for the corrupted parts of the dataset.
+# the chunks of chunked dumps are checked against their sha256, a corrupted chunk is reported for
+# the first dump that lists it
+def scrub_dataset(conf, dataset, executor):
+    dataset_dir = f"{conf.backup.directory}/{normalize_dataset_name(dataset)}"
+    if not os.path.exists(dataset_dir):
+        return []
+
+    def check_part(entry, name, size, expected, algorithm):
+        path = f"{dataset_dir}/{entry['directory']}/{name}"
+        if not os.path.exists(path):
+            return entry, name, "missing"
+        digest, actual_size = hash_file(path, algorithm)
+        if actual_size != size:
+            return entry, name, f"size {actual_size} != {size}"
+        if digest != expected:
+            return entry, name, f"{algorithm} {digest} != {expected}"
+        return entry, name, None
+
+    def check_chunk(entry, store, digest):
+        return entry, f"chunk {digest.hex()}", store.check(digest)
+
+    futures = []
+    unchecked = 0
+    store = None
+    chunks = {}
+    for entry in get_stored_snapshots(dataset_dir):
+        if entry.get("store") == "chunks":
+            from snapdump.chunks import ChunkStore, read_manifest
+
+            if store is None:
+                store = ChunkStore(f"{dataset_dir}/{CHUNK_STORE_DIR}")
+            for digest, size in read_manifest(f"{dataset_dir}/{entry['directory']}"):
+                if digest not in chunks:
+                    chunks[digest] = entry
+                    futures.append(executor.submit(check_chunk, entry, store, digest))
+        checksums = entry.get("checksums", None)
+        for name, size in entry["parts"]:
+            if checksums is None or name not in checksums["parts"]:
+                unchecked += 1
+                continue
+            futures.append(
+                executor.submit(
+                    check_part,
+                    entry,
+                    name,
+                    size,
+                    checksums["parts"][name],
+                    checksums["algorithm"],
+                )
+            )
+    results = [future.result() for future in futures]
+    log(
+        f"Scrubbed {len(results) - len(chunks)} parts"
+        + (f" and {len(chunks)} chunks" if len(chunks) > 0 else "")
+        + f" of {dataset}"
+        + (f", {unchecked} parts have no checksum" if unchecked > 0 else "")
+    )
+    return [x for x in results if x[2] is not None]
+
+
+def scrub(conf, args):
+    corrupted = []
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        for server in get_dataset_servers(get_servers(conf, args.server), args.dataset):
+            for dataset in get_command_datasets(server, args.dataset):
+                label = get_dataset_label(server, dataset)
+                for entry, name, error in scrub_dataset(server, dataset, executor):
+                    log_error(
+                        f"CORRUPTED {label}@{entry['snapshot']} ({entry['directory']}) part {name} : {error}"
+                    )
+                    corrupted.append(name)
+    if len(corrupted) > 0:
+        return 1
+    log("All parts intact")
+    return 0
+
+
+def reindex(conf, args):
+    for server in get_dataset_servers(get_servers(conf, args.server), args.dataset):
+        for dataset in get_command_datasets(server, args.dataset):
+            dataset_dir = f"{server.backup.directory}/{normalize_dataset_name(dataset)}"
+            if os.path.exists(dataset_dir):
+                entries = reindex_dataset(dataset_dir)
+                log(f"Indexed {len(entries)} dumps of {get_dataset_label(server, dataset)}")
 
 
 def cleanup_snapshots(conf, args):
-    if args.dataset is not None:
-        cleanup_dataset_snapshots(conf, args.dataset)
-    else:
-        # list all dataset snapshots
-        for dataset in conf.backup.datasets:
-            cleanup_dataset_snapshots(conf, dataset)
+    for server in get_dataset_servers(get_servers(conf, args.server), args.dataset):
+        if args.dataset is not None:
+            cleanup_unit(server, args.dataset, args.dry_run)
+        else:
+            # list all dataset snapshots
+            for dataset in get_backup_units(server):
+                cleanup_unit(server, dataset, args.dry_run)
+
+
+def get_daemon_socket(conf):
+    daemon_conf = conf.get("daemon", None)
+    if daemon_conf is not None and daemon_conf.get("socket", None) is not None:
+        return daemon_conf.get("socket")
+    return default_daemon_socket(conf.backup.directory)
+
+
+# sends a request to the control socket of a running daemon, returns the response or None if no
+# daemon is running
+def daemon_request(conf, request):
+    import socket
+
+    path = get_daemon_socket(conf)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            response = json.loads(f.readline())
+    except (OSError, ValueError):
+        # no daemon listening or the socket is not accessible
+        return None
+    finally:
+        sock.close()
+    if "error" in response:
+        raise Exception(f"snapdump daemon : {response['error']}")
+    return response
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return "-"
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def status(conf, args):
+    response = daemon_request(conf, {"command": "status"})
+    if response is None:
+        log_error(f"snapdump daemon is not running ({get_daemon_socket(conf)})")
+        return 1
+    print(f"snapdump daemon, pid {response['pid']}, up since {format_time(response['started'])}")
+    print(f"Rate limit : {format_rate(response['rate_limit'])}")
+    for dataset, state in response["datasets"].items():
+        running = f", running {state['running']}" if state["running"] is not None else ""
+        print(f"{dataset}{running}:")
+        for task, next_time in state["next"].items():
+            last = state["last"].get(task, None)
+            last_str = "never"
+            if last is not None:
+                last_str = f"{last['outcome']} at {format_time(last['time'])} ({last['seconds']:.1f} seconds)"
+                if last["error"] is not None:
+                    last_str += f" : {last['error']}"
+            print(f"\t{task} : next {format_time(next_time)}, last {last_str}")
+    return 0
+
+
+# changes the rate limit of the running daemon, "schedule" goes back to the rate_limit windows
+def rate_limit(conf, args):
+    request = {"command": "rate_limit"}
+    if args.rate != "schedule":
+        request["rate"] = parse_rate(args.rate)
+    response = daemon_request(conf, request)
+    if response is None:
+        log_error(f"snapdump daemon is not running ({get_daemon_socket(conf)})")
+        return 1
+    source = "override" if response["overridden"] else "schedule"
+    print(f"Rate limit : {format_rate(response['rate'])} ({source})")
+    return 0
+
+
+# writes the report of the pipelines of the run, failed runs are reported as well
+def write_metrics(conf):
+    metrics = conf.get("metrics", None)
+    if metrics is None:
+        return
+    report_file = metrics.get("report_file", None)
+    if report_file is not None:
+        REPORT.write_json(report_file)
+    textfile = metrics.get("textfile", None)
+    if textfile is not None:
+        REPORT.write_prometheus(textfile)
+
+
+# looks up the installed version only when it is asked for, the lookup is slow
+class VersionAction(argparse.Action):
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(option_strings, dest, nargs=0, help="show program's version number and exit")
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from importlib.metadata import version
+
+        print(f"snapdump {version('snapdump')}")
+        parser.exit()
 
 
 def main():
-    version = pkg_resources.require("snapdump")[0].version
     parser = argparse.ArgumentParser(
         description="snapdump : backup and restore zfs snapshots to/from a foreign file system"
     )
-    parser.add_argument(
-        "-v", "--version", action="version", version=f"snapdump {version}"
-    )
+    parser.add_argument("-v", "--version", action=VersionAction)
     parser.add_argument(
         "--cron", "-q", help="Do not log anything except errors", action="store_true"
     )
     parser.add_argument(
         "--conf", "-c", help="Config file name", type=str, default="config.yml"
     )
+    parser.add_argument(
+        "--server",
+        "-S",
+        help="Name of the server of the servers list to operate on, default all",
+        type=str,
+    )
     subparsers = parser.add_subparsers(help="sub-command help", dest="command")
     backup_parser = subparsers.add_parser("backup", help="Backup")
     backup_parser.add_argument(
         "--dataset", "-d", help="Optional dataset to operate on", type=str
     )
+    backup_parser.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of datasets to backup in parallel (default: backup.max_parallel or 1)",
+        type=int,
+    )
     backup_parser.add_argument(
         "--no-verify",
         "-n",
@@ -500,6 +2390,11 @@ def main():
         const=True,
         default=False,
     )
+    backup_parser.add_argument(
+        "--dry-run",
+        help="Show the planned dumps, their estimated sizes and whether they fit, without dumping",
+        action="store_true",
+    )
     restore_parser = subparsers.add_parser("restore", help="Restore")
     restore_parser.add_argument(
         "--snapshot",
@@ -515,6 +2410,12 @@ def main():
         type=str,
         required=False,
     )
+    restore_parser.add_argument(
+        "--recursive",
+        "-r",
+        help="Restore the children of the dataset too (backup.recursive), under the destination dataset",
+        action="store_true",
+    )
     list_parser = subparsers.add_parser(
         "list", help="List available snapshots to restore"
     )
@@ -527,6 +2428,29 @@ def main():
     cleanup_parser.add_argument(
         "--dataset", "-d", help="Dataset to cleanup, default all", type=str
     )
+    cleanup_parser.add_argument(
+        "--dry-run",
+        "-n",
+        help="Show what would be deleted and the space zfs destroy would reclaim",
+        action="store_true",
+    )
+
+    scrub_parser = subparsers.add_parser(
+        "scrub", help="Verify the checksums of all the dumped parts"
+    )
+    scrub_parser.add_argument(
+        "--dataset", "-d", help="Dataset to scrub, default all", type=str
+    )
+    scrub_parser.add_argument(
+        "--jobs", "-j", help="Number of parts to hash in parallel", type=int, default=4
+    )
+
+    reindex_parser = subparsers.add_parser(
+        "reindex", help="Rebuild the catalog of dumps from the backup directory"
+    )
+    reindex_parser.add_argument(
+        "--dataset", "-d", help="Dataset to reindex, default all", type=str
+    )
 
     verify_parser = subparsers.add_parser(
         "verify", help="Verify the integrity of a snapshot chain"
@@ -538,22 +2462,74 @@ def main():
         type=str,
         required=True,
     )
+    verify_parser.add_argument(
+        "--mode",
+        "-m",
+        help="local parses the dumps locally, remote pipes them to zstreamdump on the server, "
+        "both does both (default: verify.mode or local)",
+        choices=VERIFY_MODES,
+    )
+    verify_parser.add_argument(
+        "--full",
+        help="Re-read the whole chain instead of only the dumps that were not verified before",
+        action="store_true",
+    )
+
+    daemon_parser = subparsers.add_parser(
+        "daemon", help="Run the backups, cleanups and scrubs on a schedule"
+    )
+    daemon_parser.add_argument(
+        "--no-verify",
+        "-n",
+        help="Do not verify created streams",
+        action="store_true",
+    )
+    subparsers.add_parser("status", help="Show the state of the running daemon")
+    rate_limit_parser = subparsers.add_parser(
+        "rate-limit", help="Change the rate limit of the running daemon"
+    )
+    rate_limit_parser.add_argument(
+        "rate",
+        help="Bytes per second (for example 50M), unlimited, or schedule to go back to the "
+        "rate_limit settings",
+        type=str,
+    )
     args = parser.parse_args()
-    conf = OmegaConf.load(args.conf)
+    conf = load_config(args.conf)
     global CRON
     CRON = args.cron
-    if args.command == "backup":
-        backup(conf, args)
-    elif args.command == "restore":
-        restore(conf, args)
-    elif args.command == "verify":
-        verify(conf, args)
-    elif args.command == "list":
-        list_snapshots(conf, args)
-    elif args.command == "cleanup":
-        cleanup_snapshots(conf, args)
-    else:
-        parser.print_help()
+    PROGRESS.enabled = not CRON and sys.stderr.isatty()
+    configure_rate_limit(conf)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_rate_limit(args.conf))
+    try:
+        if args.command == "backup":
+            return backup(conf, args)
+        elif args.command == "restore":
+            restore(conf, args)
+        elif args.command == "verify":
+            verify(conf, args)
+        elif args.command == "list":
+            list_snapshots(conf, args)
+        elif args.command == "cleanup":
+            cleanup_snapshots(conf, args)
+        elif args.command == "reindex":
+            reindex(conf, args)
+        elif args.command == "scrub":
+            return scrub(conf, args)
+        elif args.command == "daemon":
+            from snapdump.daemon import daemon
+
+            return daemon(conf, args)
+        elif args.command == "status":
+            return status(conf, args)
+        elif args.command == "rate-limit":
+            return rate_limit(conf, args)
+        else:
+            parser.print_help()
+    finally:
+        close_engine()
+        close_ssh_connections()
+        write_metrics(conf)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+# Compression stages for the dump pipelines.
+# The codec used for a dump is recorded in the dump metadata, dumps without metadata
+# were created before codecs were configurable and are always gzip.
+
+DEFAULT_CODEC = "gzip"
+CODECS = ["gzip", "pigz", "zstd", "lz4", "none"]
+# where the streams are compressed and decompressed: local, or remote on the zfs server inside the
+# ssh command, so only compressed bytes cross the network
+LOCATIONS = ["local", "remote"]
+
+
+def get_compression_settings(conf):
+    compression = conf.backup.get("compression", None)
+    if compression is None:
+        return {"codec": DEFAULT_CODEC, "level": None, "threads": 0, "at": "local"}
+    if isinstance(compression, str):
+        compression = {"codec": compression}
+    settings = {
+        "codec": compression.get("codec", DEFAULT_CODEC),
+        "level": compression.get("level", None),
+        "threads": compression.get("threads", 0),
+        "at": compression.get("at", "local"),
+    }
+    if settings["codec"] not in CODECS:
+        raise Exception(
+            f"Unsupported compression codec '{settings['codec']}', supported codecs : {', '.join(CODECS)}"
+        )
+    if settings["at"] not in LOCATIONS:
+        raise Exception(
+            f"Unsupported compression location '{settings['at']}', supported locations : {', '.join(LOCATIONS)}"
+        )
+    return settings
+
+
+def is_remote(settings):
+    return settings.get("at", "local") == "remote" and settings["codec"] != "none"
+
+
+# returns the compression command for the settings, or None if there is no compression stage
+def compress_cmd(settings):
+    codec = settings["codec"]
+    level = settings.get("level")
+    threads = settings.get("threads", 0)
+    if codec == "none":
+        return None
+    if codec == "gzip":
+        cmd = ["gzip"]
+    elif codec == "pigz":
+        cmd = ["pigz"]
+        if threads > 0:
+            cmd += ["-p", str(threads)]
+    elif codec == "zstd":
+        cmd = ["zstd", "-q", "-c", f"-T{threads}"]
+        if level is not None and level > 19:
+            cmd += ["--ultra"]
+    elif codec == "lz4":
+        cmd = ["lz4", "-q", "-c"]
+    else:
+        raise Exception(f"Unsupported compression codec '{codec}'")
+    if level is not None:
+        cmd += [f"-{level}"]
+    return cmd
+
+
+# returns the decompression command for the settings, or None if there is no compression stage
+def decompress_cmd(settings):
+    codec = settings["codec"]
+    if codec == "none":
+        return None
+    if codec == "gzip":
+        return ["gunzip", "-c"]
+    elif codec == "pigz":
+        return ["pigz", "-d", "-c"]
+    elif codec == "zstd":
+        return ["zstd", "-q", "-d", "-c"]
+    elif codec == "lz4":
+        return ["lz4", "-q", "-d", "-c"]
+    else:
+        raise Exception(f"Unsupported compression codec '{codec}'")
@@ -0,0 +1,115 @@
+# Config loading.
+# Importing OmegaConf is a large part of the startup time of a run, and most runs are cron runs with
+# nothing to do. The resolved config is cached as JSON (keyed by the path, size and modification time
+# of the config file) and later runs load the cache without importing OmegaConf.
+# Configs with interpolations are always loaded with OmegaConf, their values may depend on the environment.
+import hashlib
+import json
+import os
+
+
+# a dict with attribute access, like the OmegaConf config it replaces.
+# a missing key is None, optional keys (server.identity_file, server.ssh_options, ..) can be left out
+class Config(dict):
+    def __getattr__(self, key):
+        if key.startswith("__"):
+            # copy and pickle look up special methods
+            raise AttributeError(key)
+        return self.get(key, None)
+
+
+def _to_config(value):
+    if isinstance(value, dict):
+        return Config({k: _to_config(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_to_config(x) for x in value]
+    return value
+
+
+def _cache_path(config_file):
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    digest = hashlib.sha1(os.path.realpath(config_file).encode()).hexdigest()
+    return f"{cache_dir}/snapdump/config-{digest}.json"
+
+
+def load_config(config_file):
+    st = os.stat(config_file)
+    key = [os.path.realpath(config_file), st.st_size, st.st_mtime_ns]
+    cache_file = _cache_path(config_file)
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return _to_config(cached["config"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from omegaconf import OmegaConf
+
+    conf = OmegaConf.load(config_file)
+    with open(config_file) as f:
+        if "${" in f.read():
+            return conf
+    container = OmegaConf.to_container(conf, resolve=True)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"key": key, "config": container}, f)
+        os.rename(tmp, cache_file)
+    except OSError:
+        # the cache is an optimization, a read only home directory is fine
+        pass
+    return _to_config(container)
+
+
+# the default control socket of the daemon, in the runtime directory ($XDG_RUNTIME_DIR, /run for
+# services): the backup directory is often on NFS and its path can be longer than a unix socket path
+# can be. the name depends on the backup directory, the daemons of several configs do not share it
+def default_daemon_socket(backup_directory):
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", None) or "/run"
+    digest = hashlib.sha1(os.path.abspath(backup_directory).encode()).hexdigest()[:12]
+    return f"{runtime_dir}/snapdump/snapdump-{digest}.sock"
+
+
+# keys of an entry of the servers list that are backup settings of the server, the other keys are
+# its server settings
+SERVER_BACKUP_KEYS = ["datasets", "recursive", "directory"]
+
+
+# returns the configs of the servers of a config, as if each server had a config of its own.
+# with a servers list (servers:) the server block of each config is the server block of the config
+# (the defaults of all the servers, optional) with the keys of the entry, and its backup block has
+# the datasets, recursive roots and directory of the entry. the directory of a server defaults to
+# its name under backup.directory. all the servers share the daemon of the config.
+# a config without a servers list is the config of its single server
+def server_configs(conf):
+    if not isinstance(conf, dict):
+        # configs with interpolations are OmegaConf configs
+        from omegaconf import OmegaConf
+
+        conf = _to_config(OmegaConf.to_container(conf, resolve=True))
+    servers = conf.get("servers", None)
+    if not servers:
+        return [conf]
+    daemon = dict(conf.get("daemon", None) or {})
+    if daemon.get("socket", None) is None:
+        daemon["socket"] = default_daemon_socket(conf.backup.directory)
+    configs = []
+    for entry in servers:
+        name = entry.get("name", None) or entry.get("hostname", None)
+        if name is None:
+            raise Exception("Missing hostname of a server of the servers list")
+        if name in [x["server"]["name"] for x in configs]:
+            raise Exception(f"Duplicate server '{name}' in the servers list")
+        server = dict(conf.get("server", None) or {})
+        server.update({k: v for k, v in entry.items() if k not in SERVER_BACKUP_KEYS})
+        server["name"] = name
+        backup = dict(
+            conf.backup,
+            datasets=entry.get("datasets", None) or [],
+            recursive=entry.get("recursive", None) or [],
+            directory=entry.get("directory", None) or f"{conf.backup.directory}/{name}",
+        )
+        configs.append(_to_config(dict(conf, server=server, backup=backup, daemon=daemon)))
+    return configs
@@ -0,0 +1,352 @@
+# Long-running daemon mode.
+# The daemon keeps the config loaded and the ssh connection to the server open, and schedules the
+# tasks of every dataset itself instead of relying on cron:
+#   backup : when the next full or incremental dump is due (backup.interval_days)
+#   cleanup : every daemon.cleanup_interval_hours (backup.retention_days)
+#   scrub : every daemon.scrub_interval_days
+# Every task is delayed by a random jitter so the datasets do not all start at the same time.
+# At most backup.max_parallel tasks run at a time and at most one task per dataset. The datasets of
+# all the servers of the servers list are scheduled together, the due task of the server with the
+# fewest running tasks starts first and at most backup.max_sends_per_server backups run per server.
+# list and status are answered on a unix control socket from the state and the catalogs the daemon
+# keeps in memory, without scanning the backup directory. rate-limit changes the rate limit of the
+# running dumps and restores.
+# On SIGTERM or SIGINT no new task is started and running dumps stop at their next checkpoint
+# (daemon.shutdown_mode checkpoint) or run to the end (finish). A second signal exits at once.
+import json
+import os
+import random
+import signal
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from snapdump import cli, ssh
+from snapdump.catalog import catalog_path
+from snapdump.metrics import REPORT
+from snapdump.ratelimit import LIMITER
+
+TASKS = ["backup", "cleanup", "scrub"]
+SHUTDOWN_MODES = ["checkpoint", "finish"]
+# parts hashed in parallel by a scheduled scrub, same as the scrub command
+SCRUB_JOBS = 4
+# the scheduler wakes up at least this often
+MAX_SLEEP_SECONDS = 60
+DAY_SECONDS = 60 * 60 * 24
+
+
+def get_daemon_settings(conf):
+    daemon_conf = conf.get("daemon", None) or {}
+    settings = {
+        "socket": cli.get_daemon_socket(conf),
+        "jitter_seconds": daemon_conf.get("jitter_seconds", 300),
+        "retry_minutes": daemon_conf.get("retry_minutes", 30),
+        "cleanup_interval_hours": daemon_conf.get("cleanup_interval_hours", 24),
+        "scrub_interval_days": daemon_conf.get("scrub_interval_days", 30),
+        "shutdown_mode": daemon_conf.get("shutdown_mode", "checkpoint"),
+    }
+    if settings["shutdown_mode"] not in SHUTDOWN_MODES:
+        raise Exception(
+            f"Unsupported daemon shutdown mode '{settings['shutdown_mode']}', "
+            f"supported modes : {', '.join(SHUTDOWN_MODES)}"
+        )
+    return settings
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            response = self.server.daemon.handle_request(json.loads(line))
+        except Exception as err:
+            response = {"error": str(err)}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class _ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+# clock replaces time.time in tests
+class Daemon:
+    def __init__(self, conf, verify, clock=time.time):
+        self.conf = conf
+        self.verify = verify
+        self.clock = clock
+        self.settings = get_daemon_settings(conf)
+        self.jobs = max(1, conf.backup.get("max_parallel", 1))
+        self.started = clock()
+        # a signal can arrive while the main thread holds the lock
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+        self.stopping = False
+        self.running = 0
+        self.servers = cli.get_servers(conf)
+        self.max_sends = conf.backup.get("max_sends_per_server", 0)
+        # the state of each unit, by label (see cli.get_dataset_label)
+        self.datasets = {}
+        # label -> (server config, unit)
+        self.units = {}
+        # label -> (catalog mtime and size, sorted entries)
+        self.catalogs = {}
+        self.catalogs_lock = threading.Lock()
+
+    def jitter(self):
+        return random.uniform(0, self.settings["jitter_seconds"])
+
+    # returns the time of the next run of a task, outcome is the outcome of the last run or None
+    def next_time(self, label, task, now, outcome=None):
+        if task == "backup":
+            conf, dataset = self.units[label]
+            due, _ = cli.get_backup_due_time(conf, dataset, now)
+            if outcome in ("failed", "deferred"):
+                due = max(due, now + self.settings["retry_minutes"] * 60)
+            return max(due, now) + self.jitter()
+        elif task == "cleanup":
+            if outcome is None:
+                return now + self.jitter()
+            return now + self.settings["cleanup_interval_hours"] * 60 * 60 + self.jitter()
+        else:
+            interval = self.settings["scrub_interval_days"] * DAY_SECONDS
+            if interval <= 0:
+                return None
+            if outcome is None:
+                # spreads the first scrubs of the datasets over the interval
+                return now + random.uniform(0, interval)
+            return now + interval + self.jitter()
+
+    def schedule(self, now):
+        # a tree (backup.recursive) is scheduled as one unit, on the schedule of its root
+        for conf in self.servers:
+            for dataset in cli.get_backup_units(conf):
+                label = cli.get_dataset_label(conf, dataset)
+                self.units[label] = (conf, dataset)
+                state = {"running": None, "next": {}, "last": {}}
+                for task in TASKS:
+                    try:
+                        state["next"][task] = self.next_time(label, task, now)
+                    except Exception as err:
+                        cli.log_error(f"Error scheduling {task} of {label} : {err}")
+                        state["next"][task] = now + self.settings["retry_minutes"] * 60
+                self.datasets[label] = state
+
+    def run_task(self, label, task):
+        conf, dataset = self.units[label]
+        start = self.clock()
+        outcome, error = "done", None
+        try:
+            if task == "backup":
+                for name in cli.get_unit_datasets(conf, dataset):
+                    REPORT.forget(cli.get_dataset_label(conf, name))
+                if dataset in cli.get_recursive_roots(conf):
+                    backup_unit = cli.backup_tree
+                else:
+                    backup_unit = cli.backup_dataset
+                _, outcome, elapsed, error = backup_unit(conf, dataset, int(start), self.verify)
+                REPORT.add_backup(label, outcome, elapsed)
+            elif task == "cleanup":
+                if self.get_entries(conf, dataset) is None:
+                    outcome = "skipped"
+                else:
+                    cli.cleanup_unit(conf, dataset)
+            else:
+                corrupted = []
+                with ThreadPoolExecutor(max_workers=SCRUB_JOBS) as executor:
+                    for name in cli.get_unit_datasets(conf, dataset):
+                        corrupted += [
+                            (name, entry, part, part_error)
+                            for entry, part, part_error in cli.scrub_dataset(conf, name, executor)
+                        ]
+                for name, entry, part, part_error in corrupted:
+                    cli.log_error(
+                        f"CORRUPTED {cli.get_dataset_label(conf, name)}@{entry['snapshot']} "
+                        f"({entry['directory']}) part {part} : {part_error}"
+                    )
+                if len(corrupted) > 0:
+                    outcome, error = "failed", f"{len(corrupted)} corrupted parts"
+        except Exception as err:
+            cli.log_error(f"Error running {task} of {label} : {err}")
+            outcome, error = "failed", err
+        now = self.clock()
+        try:
+            next_time = self.next_time(label, task, now, outcome)
+        except Exception as err:
+            cli.log_error(f"Error scheduling {task} of {label} : {err}")
+            next_time = now + self.settings["retry_minutes"] * 60
+        with self.lock:
+            state = self.datasets[label]
+            state["running"] = None
+            state["last"][task] = {
+                "outcome": outcome,
+                "time": start,
+                "seconds": now - start,
+                "error": str(error) if error is not None else None,
+            }
+            state["next"][task] = next_time
+            self.running -= 1
+            self.wakeup.notify()
+        if task == "backup":
+            try:
+                cli.write_metrics(self.conf)
+            except Exception as err:
+                cli.log_error(f"Error writing metrics : {err}")
+
+    # returns the number of running tasks of the server of a unit, only the backups with backup
+    def server_running(self, label, backup=False):
+        server = cli.get_server_key(self.units[label][0])
+        return sum(
+            1
+            for other, state in self.datasets.items()
+            if state["running"] is not None
+            and (not backup or state["running"] == "backup")
+            and cli.get_server_key(self.units[other][0]) == server
+        )
+
+    # starts the due tasks, returns the time of the next task that is not running
+    def start_due_tasks(self, executor, now):
+        next_wakeup = now + MAX_SLEEP_SECONDS
+        due = []
+        for label, state in self.datasets.items():
+            if state["running"] is not None:
+                continue
+            pending = [(t, task) for task, t in state["next"].items() if t is not None]
+            if len(pending) == 0:
+                continue
+            next_time, task = min(pending)
+            if next_time > now:
+                next_wakeup = min(next_wakeup, next_time)
+                continue
+            due.append((next_time, label, task))
+        # the rest is started once a running task is done
+        while self.running < self.jobs:
+            ready = [
+                (self.server_running(label), next_time, label, task)
+                for next_time, label, task in due
+                if task != "backup"
+                or self.max_sends <= 0
+                or self.server_running(label, backup=True) < self.max_sends
+            ]
+            if len(ready) == 0:
+                break
+            _, next_time, label, task = min(ready)
+            due.remove((next_time, label, task))
+            self.datasets[label]["running"] = task
+            self.running += 1
+            cli.log(f"Starting {task} of {label}")
+            executor.submit(self.run_task, label, task)
+        return next_wakeup
+
+    def get_entries(self, conf, dataset):
+        label = cli.get_dataset_label(conf, dataset)
+        dataset_dir = f"{conf.backup.directory}/{cli.normalize_dataset_name(dataset)}"
+        if not os.path.exists(dataset_dir):
+            return None
+        try:
+            st = os.stat(catalog_path(dataset_dir))
+            key = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            key = None
+        with self.catalogs_lock:
+            cached = self.catalogs.get(label)
+            if key is not None and cached is not None and cached[0] == key:
+                return cached[1]
+        entries = cli.get_stored_snapshots(dataset_dir)
+        if key is None:
+            # the catalog was just built
+            st = os.stat(catalog_path(dataset_dir))
+            key = (st.st_mtime_ns, st.st_size)
+        with self.catalogs_lock:
+            self.catalogs[label] = (key, entries)
+        return entries
+
+    def handle_request(self, request):
+        command = request.get("command")
+        if command == "status":
+            with self.lock:
+                return {
+                    "pid": os.getpid(),
+                    "started": self.started,
+                    "stopping": self.stopping,
+                    "rate_limit": LIMITER.current_rate(),
+                    "datasets": json.loads(json.dumps(self.datasets)),
+                }
+        elif command == "list":
+            name = request.get("server")
+            servers = [x for x in self.servers if x.server.get("name", None) == name]
+            if len(servers) == 0:
+                raise Exception(f"Unknown server '{name}'")
+            conf = servers[0]
+            datasets = request.get("datasets") or cli.get_datasets(conf)
+            return {"datasets": {dataset: self.get_entries(conf, dataset) for dataset in datasets}}
+        elif command == "rate_limit":
+            # without a rate the limit follows the rate_limit windows again
+            if "rate" in request:
+                LIMITER.set_override(request["rate"])
+                cli.log(f"Rate limit set to {cli.format_rate(request['rate'])}")
+            else:
+                LIMITER.reset_override()
+                cli.log("Rate limit follows the schedule")
+            return {"rate": LIMITER.current_rate(), "overridden": LIMITER.overridden}
+        raise Exception(f"Unknown command '{command}'")
+
+    def stop(self, signum, frame):
+        with self.lock:
+            if self.stopping:
+                cli.log_error("Exiting without waiting for the running tasks")
+                os._exit(1)
+            self.stopping = True
+            if self.settings["shutdown_mode"] == "checkpoint":
+                cli.STOP_DUMPS.set()
+            cli.log(
+                f"Stopping, waiting for {self.running} running tasks "
+                f"({self.settings['shutdown_mode']})"
+            )
+            self.wakeup.notify()
+
+    # starts the tasks as they are due until the daemon is stopped
+    def loop(self, executor):
+        with self.lock:
+            while not self.stopping:
+                now = self.clock()
+                next_wakeup = self.start_due_tasks(executor, now)
+                self.wakeup.wait(max(0, next_wakeup - now))
+
+    def open_socket(self):
+        path = self.settings["socket"]
+        if os.path.exists(path):
+            if cli.daemon_request(self.conf, {"command": "status"}) is not None:
+                raise Exception(f"snapdump daemon is already running ({path})")
+            # left over by a daemon that did not exit cleanly
+            os.remove(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        server = _ControlServer(path, _ControlHandler)
+        os.chmod(path, 0o600)
+        server.daemon = self
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+    def run(self):
+        server = self.open_socket()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            cli.log(f"snapdump daemon started, control socket {self.settings['socket']}")
+            self.schedule(self.clock())
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                self.loop(executor)
+                # leaving the executor waits for the running tasks
+        finally:
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.settings["socket"]):
+                os.remove(self.settings["socket"])
+        cli.log("snapdump daemon stopped")
+        return 0
+
+
+def daemon(conf, args):
+    # the connection to the server is kept for the lifetime of the daemon
+    ssh.CONTROL_PERSIST = "yes"
+    return Daemon(conf, verify=not args.no_verify).run()
@@ -0,0 +1,370 @@
+# Writes zfs send streams into dump parts with checkpoints, so an interrupted dump can be resumed.
+#
+# A thread pumps the send stream into the compressor and the compressor output is pumped into
+# the parts. Every checkpoint_size bytes of the send stream the compressor input is closed, which
+# ends the compressed frame, and a new compressor is started for the rest of the stream
+# (gzip, pigz, zstd and lz4 all decompress concatenated frames as a single stream).
+# Once a frame is fully written to the parts a checkpoint with the offset of the frame end in the
+# send stream and in the parts is recorded in the dump directory.
+#
+# zfs send -t resume tokens come from a receiving dataset, a dump does not have one.
+# Instead, a resumed dump sends the same snapshot again, skips the part of the send stream that is
+# already stored and continues writing the parts from the checkpoint. The skipped part of the
+# stream is compared with the crc32 recorded in the checkpoint to make sure it did not change.
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from subprocess import Popen, PIPE
+
+from snapdump.checksum import PartHasher
+from snapdump.metrics import new_stages, stop_stages
+from snapdump.parts import PARTIAL_SUFFIX, PartWriter, part_suffix, truncate_parts
+from snapdump.pipeline import PUMP_CHUNK_SIZE, ensure_clean_exit, wait_process
+
+CHECKPOINT_FILE = "checkpoint.json"
+DEFAULT_CHECKPOINT_SIZE = 10 * 1024 ** 3
+
+
+# the dump cannot be resumed from its checkpoint
+class StreamChanged(Exception):
+    pass
+
+
+# the dump was stopped at a checkpoint and can be resumed
+class DumpStopped(Exception):
+    pass
+
+
+def read_checkpoint(dump_dir):
+    path = f"{dump_dir}/{CHECKPOINT_FILE}"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(dump_dir, checkpoint):
+    path = f"{dump_dir}/{CHECKPOINT_FILE}"
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(f"{path}.tmp", path)
+
+
+# one compressed frame of the dump
+class _Frame:
+    def __init__(self, compress):
+        if compress is None:
+            self.process = None
+            read_fd, write_fd = os.pipe()
+            self.stdin = open(write_fd, "wb")
+            self.stdout = open(read_fd, "rb")
+        else:
+            self.process = Popen(compress, stdin=PIPE, stdout=PIPE)
+            self.stdin = self.process.stdin
+            self.stdout = self.process.stdout
+        # set by the send pump once the frame input is complete
+        self.raw_offset = None
+        self.raw_crc32 = None
+        self.eof = False
+        self.stopped = False
+        self.error = None
+        self.done = threading.Event()
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        else:
+            self.stdout.close()
+
+
+# pumps the send stream into a new frame every checkpoint_size bytes
+class _SendPump(threading.Thread):
+    def __init__(
+        self,
+        src,
+        compress,
+        checkpoint_size,
+        raw_offset,
+        raw_crc32,
+        stage,
+        progress,
+        stop,
+        throttle,
+    ):
+        super().__init__(daemon=True)
+        self.src = src
+        self.stage = stage
+        self.progress = progress
+        self.stop = stop
+        self.throttle = throttle
+        self.stopped = False
+        self.compress = compress
+        self.checkpoint_size = checkpoint_size
+        self.skip = raw_offset
+        self.skip_crc32 = raw_crc32
+        self.raw_offset = 0
+        self.raw_crc32 = 0
+        self.buf = bytearray(PUMP_CHUNK_SIZE)
+        self.view = memoryview(self.buf)
+        self.frames = queue.Queue()
+        self.lock = threading.Lock()
+        self.aborted = False
+        self.started = []
+        self.error = None
+
+    def run(self):
+        try:
+            self._skip()
+            eof = False
+            while not eof and not self.stopped:
+                with self.lock:
+                    if self.aborted:
+                        return
+                    frame = _Frame(self.compress)
+                    self.started.append(frame)
+                self.frames.put(frame)
+                try:
+                    eof = self._copy(frame.stdin)
+                except BaseException as err:
+                    frame.error = err
+                    raise
+                finally:
+                    frame.raw_offset = self.raw_offset
+                    frame.raw_crc32 = self.raw_crc32
+                    frame.eof = eof
+                    frame.stopped = self.stopped
+                    try:
+                        frame.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                    frame.done.set()
+        except BaseException as err:
+            self.error = err
+        finally:
+            self.frames.put(None)
+
+    def _skip(self):
+        while self.raw_offset < self.skip:
+            size = min(len(self.buf), self.skip - self.raw_offset)
+            n = self._read(size)
+            if not n:
+                raise StreamChanged("The send stream is shorter than the stored part of the dump")
+            self.raw_crc32 = zlib.crc32(self.view[:n], self.raw_crc32)
+            self.raw_offset += n
+        if self.raw_crc32 != self.skip_crc32:
+            raise StreamChanged("The send stream differs from the stored part of the dump")
+
+    # copies the send stream to dst up to the next checkpoint, returns True at the end of the stream
+    def _copy(self, dst):
+        limit = None
+        if self.checkpoint_size > 0:
+            limit = (self.raw_offset // self.checkpoint_size + 1) * self.checkpoint_size
+        while limit is None or self.raw_offset < limit:
+            if self.stop is not None and self.stop.is_set():
+                # the frame ends here and is checkpointed
+                self.stopped = True
+                return False
+            size = len(self.buf)
+            if limit is not None:
+                size = min(size, limit - self.raw_offset)
+            n = self._read(size)
+            if not n:
+                return True
+            chunk = self.view[:n]
+            self.raw_crc32 = zlib.crc32(chunk, self.raw_crc32)
+            start = time.perf_counter()
+            dst.write(chunk)
+            self.stage.idle_seconds += time.perf_counter() - start
+            self.raw_offset += n
+        return False
+
+    def _read(self, size):
+        start = time.perf_counter()
+        n = self.src.readinto(self.view[:size])
+        self.stage.stall_seconds += time.perf_counter() - start
+        if n:
+            self.stage.bytes += n
+            if self.throttle is not None:
+                self.stage.throttled_seconds += self.throttle(n)
+            if self.progress is not None:
+                self.progress(self.raw_offset + n)
+        return n
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            frames = list(self.started)
+        for frame in frames:
+            frame.kill()
+
+
+def _hash_partial_part(path, hasher):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(PUMP_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+
+
+# copies the output of a frame to the parts, hashing it on the way.
+# the output is read straight into the buffers of the writer
+def _drain(src, writer, hasher, stages):
+    compress_stage = stages.get("compress")
+    hash_stage = stages.get("hash")
+    write_stage = stages["write"]
+    while True:
+        start = time.perf_counter()
+        view = writer.buffer()
+        write_stage.stall_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        n = src.readinto(view)
+        if compress_stage is not None:
+            compress_stage.stall_seconds += time.perf_counter() - start
+        if not n:
+            break
+        chunk = view[:n]
+        if hasher is not None:
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            hasher.update(chunk)
+            hash_stage.stall_seconds += time.perf_counter() - start
+            hash_stage.cpu_seconds += time.thread_time() - cpu_start
+            hash_stage.bytes += n
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        writer.commit(n)
+        write_stage.stall_seconds += time.perf_counter() - start
+        write_stage.cpu_seconds += time.thread_time() - cpu_start
+        write_stage.bytes += n
+        if compress_stage is not None:
+            compress_stage.bytes += n
+
+
+# Writes the output of send_cmd into the parts prefix + suffix, compressing it with compress
+# (None for no compression) and hashing the parts with algorithm (None for no checksums).
+# With resume the dump continues from the checkpoint in the parts directory, with the part size and
+# checksum algorithm it was started with.
+# progress is called with the offset in the send stream as it advances.
+# Once the stop event is set the dump is checkpointed and DumpStopped is raised.
+# throttle is called with the number of bytes read from the send stream and returns the seconds it
+# waited for the rate limit.
+# in_flight is the number of part writes in flight (see PartWriter).
+# Returns ({"algorithm", "digests"} of the parts or None without checksums, the pipeline stages)
+def write_dump_stream(
+    send_cmd,
+    compress,
+    prefix,
+    part_size,
+    algorithm,
+    checkpoint_size,
+    resume=False,
+    progress=None,
+    stop=None,
+    throttle=None,
+    in_flight=1,
+):
+    dump_dir = os.path.dirname(prefix)
+    checkpoint = read_checkpoint(dump_dir) if resume else None
+    if checkpoint is None:
+        checkpoint = {
+            "part_size": part_size,
+            "algorithm": algorithm,
+            "raw_offset": 0,
+            "raw_crc32": 0,
+            "offset": 0,
+            "digests": [],
+        }
+    else:
+        part_size = checkpoint["part_size"]
+        algorithm = checkpoint["algorithm"]
+        if not truncate_parts(prefix, part_size, checkpoint["offset"]):
+            raise StreamChanged("The stored parts of the dump are shorter than its checkpoint")
+
+    names = ["send"]
+    if compress is not None:
+        names.append("compress")
+    if algorithm is not None:
+        names.append("hash")
+    names.append("write")
+    stages = new_stages(*names)
+
+    writer = PartWriter(
+        prefix, part_size, checkpoint["offset"], in_flight=in_flight, buffer_size=PUMP_CHUNK_SIZE
+    )
+    hasher = None
+    if algorithm is not None:
+        hasher = PartHasher(algorithm, part_size, checkpoint["digests"])
+        if checkpoint["offset"] % part_size != 0:
+            # the partial last part is hashed again up to the checkpoint
+            index = checkpoint["offset"] // part_size
+            _hash_partial_part(f"{prefix}{part_suffix(index)}{PARTIAL_SUFFIX}", hasher)
+
+    send = Popen(send_cmd, stdout=PIPE, bufsize=PUMP_CHUNK_SIZE)
+    send_pump = _SendPump(
+        send.stdout,
+        compress,
+        checkpoint_size,
+        checkpoint["raw_offset"],
+        checkpoint["raw_crc32"],
+        stages["send"],
+        progress,
+        stop,
+        throttle,
+    )
+    send_pump.start()
+    try:
+        while True:
+            frame = send_pump.frames.get()
+            if frame is None:
+                send_pump.join()
+                raise send_pump.error
+            _drain(frame.stdout, writer, hasher, stages)
+            frame.stdout.close()
+            frame.done.wait()
+            if frame.process is not None:
+                stages["compress"].cpu_seconds += wait_process(frame.process)
+                ensure_clean_exit(frame.process)
+            if frame.error is not None:
+                raise frame.error
+            if frame.eof:
+                break
+            start = time.perf_counter()
+            writer.sync()
+            stages["write"].stall_seconds += time.perf_counter() - start
+            checkpoint.update(
+                raw_offset=frame.raw_offset,
+                raw_crc32=frame.raw_crc32,
+                offset=writer.offset,
+                digests=list(hasher.digests) if hasher is not None else [],
+            )
+            write_checkpoint(dump_dir, checkpoint)
+            if frame.stopped:
+                raise DumpStopped(f"Dump stopped at {writer.offset} bytes, it will be resumed")
+        start = time.perf_counter()
+        writer.close()
+        stages["write"].stall_seconds += time.perf_counter() - start
+        stages["send"].cpu_seconds += wait_process(send)
+        ensure_clean_exit(send)
+        if writer.offset == 0:
+            # a zfs send stream is never empty, the remote command did not run
+            raise Exception(f"{' '.join(send_cmd)} did not send anything")
+    except BaseException:
+        send.kill()
+        send_pump.abort()
+        send_pump.join()
+        send.wait()
+        writer.abort()
+        raise
+    send_pump.join()
+    stop_stages(stages)
+
+    if os.path.exists(f"{dump_dir}/{CHECKPOINT_FILE}"):
+        os.remove(f"{dump_dir}/{CHECKPOINT_FILE}")
+    if hasher is None:
+        return None, stages
+    return {"algorithm": algorithm, "digests": hasher.finish()}, stages
@@ -0,0 +1,100 @@
+# asyncio engine for remote commands.
+# A single event loop runs in a background thread and every thread of snapdump (the backup workers,
+# the daemon tasks) submits coroutines to it, so the remote commands of a dataset can overlap with
+# each other and with local work (for example listing the zfs snapshots while dump directories are
+# deleted) without a thread per command.
+# Commands can be cancelled or given a timeout, their processes are killed.
+#
+# The streams (dump, restore and remote verify) run on threads with the helpers of pipeline.py:
+# the checkpoints of the dumps and the CPU accounting of the processes (wait4) need the processes
+# to be reaped by snapdump, which asyncio does not allow.
+import asyncio
+import threading
+from asyncio.subprocess import DEVNULL, PIPE
+from subprocess import CalledProcessError
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class Engine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+
+    def _get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+            return self.loop
+
+    # schedules a coroutine, returns a concurrent.futures.Future of its result.
+    # cancelling the future cancels the coroutine
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+
+    # runs a coroutine and waits for its result
+    def run(self, coro):
+        future = self.submit(coro)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def close(self):
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            self.loop = None
+            self.thread = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+ENGINE = Engine()
+
+
+async def _kill(processes):
+    for process in processes:
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+    for process in processes:
+        await process.wait()
+
+
+async def with_timeout(coro, timeout, description):
+    if timeout is None or timeout <= 0:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise CommandTimeout(f"{description} timed out after {timeout} seconds")
+
+
+async def _run_command(cmd, stderr, input):
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdin=DEVNULL if input is None else PIPE, stdout=PIPE, stderr=stderr
+    )
+    try:
+        out, _ = await process.communicate(input)
+    except BaseException:
+        await _kill([process])
+        raise
+    if process.returncode != 0:
+        raise CalledProcessError(process.returncode, cmd, out)
+    return out
+
+
+# runs a command, returns its output. raises CalledProcessError like subprocess.check_output
+async def run_command(cmd, stderr=None, timeout=None, input=None):
+    return await with_timeout(_run_command(cmd, stderr, input), timeout, " ".join(cmd))
+
@@ -0,0 +1,231 @@
+# Throughput metrics of the backup, restore and verify pipelines.
+# Each pipeline run records its stages (send, compress, write, ...) in the run report, per stage:
+#   bytes : bytes the stage produced
+#   wall_seconds : time from the start to the end of the stage
+#   cpu_seconds : user + system time of the local processes or the thread of the stage
+#                 (the zfs commands on the server are not included)
+#   stall_seconds : time the rest of the pipeline waited for the stage
+#   idle_seconds : time the stage waited for the rest of the pipeline
+#   throttled_seconds : time the stage waited for the rate limit (rate_limit)
+# The stage with the most stall time is the bottleneck of the run.
+# At the end of the run the report is written as JSON and as a Prometheus textfile collector file.
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.stall_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.throttled_seconds = 0.0
+        self.started = time.time()
+
+    def stop(self):
+        self.wall_seconds = time.time() - self.started
+
+    def as_dict(self):
+        return {
+            "bytes": self.bytes,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "stall_seconds": round(self.stall_seconds, 3),
+            "idle_seconds": round(self.idle_seconds, 3),
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "bytes_per_second": int(self.bytes / max(self.wall_seconds, 0.001)),
+        }
+
+
+def new_stages(*names):
+    return {name: Stage(name) for name in names}
+
+
+def stop_stages(stages):
+    for stage in stages.values():
+        stage.stop()
+
+
+def format_stages(stages):
+    return ", ".join(
+        f"{stage.name} {stage.bytes / max(stage.wall_seconds, 0.001) / (1024 * 1024):.1f} MB/s"
+        f" (cpu {stage.cpu_seconds:.1f}s, stall {stage.stall_seconds:.1f}s"
+        + (f", throttled {stage.throttled_seconds:.1f}s" if stage.throttled_seconds > 0 else "")
+        + ")"
+        for stage in stages.values()
+    )
+
+
+def _prometheus_labels(labels):
+    return ",".join(f'{k}="{v}"' for k, v in labels.items())
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+# collects the pipeline runs of a snapdump invocation, shared by all the worker threads
+class Report:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.runs = []
+        self.backups = []
+
+    def add(self, operation, dataset, snapshot, stages, **fields):
+        run = {
+            "operation": operation,
+            "dataset": dataset,
+            "snapshot": snapshot,
+            "stages": {name: stage.as_dict() for name, stage in stages.items()},
+        }
+        run.update(fields)
+        with self.lock:
+            self.runs.append(run)
+
+    def add_backup(self, dataset, outcome, seconds):
+        with self.lock:
+            self.backups.append(
+                {"dataset": dataset, "outcome": outcome, "seconds": round(seconds, 3)}
+            )
+
+    # drops the runs of a dataset, a daemon keeps only the latest backup of each dataset in its report
+    def forget(self, dataset):
+        with self.lock:
+            self.runs = [run for run in self.runs if run["dataset"] != dataset]
+            self.backups = [backup for backup in self.backups if backup["dataset"] != dataset]
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "started": int(self.started),
+                "seconds": round(time.time() - self.started, 3),
+                "backups": list(self.backups),
+                "runs": list(self.runs),
+            }
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.as_dict(), indent=2) + "\n")
+
+    def write_prometheus(self, path):
+        report = self.as_dict()
+        # stages of the same operation on a dataset (for example the streams of a restore) are summed
+        totals = {}
+        for run in report["runs"]:
+            for name, stage in run["stages"].items():
+                key = (run["operation"], run["dataset"], name)
+                total = totals.setdefault(key, dict.fromkeys(stage.keys(), 0))
+                for field, value in stage.items():
+                    total[field] += value
+        lines = []
+        for field, help_text in [
+            ("bytes", "Bytes produced by the pipeline stage"),
+            ("wall_seconds", "Wall time of the pipeline stage"),
+            ("cpu_seconds", "Local CPU time of the pipeline stage"),
+            ("stall_seconds", "Time the pipeline waited for the stage"),
+            ("idle_seconds", "Time the stage waited for the pipeline"),
+            ("throttled_seconds", "Time the stage waited for the rate limit"),
+        ]:
+            metric = f"snapdump_stage_{field}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for (operation, dataset, stage), total in sorted(totals.items()):
+                labels = _prometheus_labels(
+                    {"operation": operation, "dataset": dataset, "stage": stage}
+                )
+                lines.append(f"{metric}{{{labels}}} {round(total[field], 3)}")
+        lines.append("# HELP snapdump_backup_seconds Duration of the backup of the dataset")
+        lines.append("# TYPE snapdump_backup_seconds gauge")
+        for backup in report["backups"]:
+            labels = _prometheus_labels({"dataset": backup["dataset"]})
+            lines.append(f"snapdump_backup_seconds{{{labels}}} {backup['seconds']}")
+        lines.append("# HELP snapdump_backup_failed 1 if the backup of the dataset failed")
+        lines.append("# TYPE snapdump_backup_failed gauge")
+        for backup in report["backups"]:
+            labels = _prometheus_labels({"dataset": backup["dataset"]})
+            failed = 1 if backup["outcome"] == "failed" else 0
+            lines.append(f"snapdump_backup_failed{{{labels}}} {failed}")
+        lines.append("# HELP snapdump_run_seconds Duration of the snapdump run")
+        lines.append("# TYPE snapdump_run_seconds gauge")
+        lines.append(f"snapdump_run_seconds {report['seconds']}")
+        lines.append("# HELP snapdump_run_timestamp_seconds Start time of the snapdump run")
+        lines.append("# TYPE snapdump_run_timestamp_seconds gauge")
+        lines.append(f"snapdump_run_timestamp_seconds {report['started']}")
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+REPORT = Report()
+
+
+# a single status line on stderr for interactive runs, shared by the parallel workers
+class Progress:
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # key -> (bytes done, total bytes or None, start time)
+        self.items = {}
+        self.last_render = 0
+        self.width = 0
+
+    def start(self, key, total=None):
+        if self.enabled:
+            with self.lock:
+                self.items[key] = (0, total, time.time())
+
+    def update(self, key, done):
+        if not self.enabled:
+            return
+        with self.lock:
+            if key not in self.items:
+                return
+            _, total, started = self.items[key]
+            self.items[key] = (done, total, started)
+            now = time.time()
+            if now - self.last_render >= self.INTERVAL:
+                self.last_render = now
+                self._render(now)
+
+    def finish(self, key):
+        if self.enabled:
+            with self.lock:
+                self.items.pop(key, None)
+                self._clear()
+
+    def clear(self):
+        if self.enabled:
+            with self.lock:
+                self._clear()
+
+    def _clear(self):
+        if self.width > 0:
+            sys.stderr.write("\r" + " " * self.width + "\r")
+            sys.stderr.flush()
+            self.width = 0
+
+    def _render(self, now):
+        parts = []
+        for key, (done, total, started) in self.items.items():
+            rate = done / max(now - started, 0.001)
+            part = f"{key} {done / (1024 * 1024):.0f} MB {rate / (1024 * 1024):.1f} MB/s"
+            if total:
+                percent = min(100.0, 100.0 * done / total)
+                eta = max(0, total - done) / max(rate, 1)
+                part += f" {percent:.0f}% ETA {int(eta) // 60}:{int(eta) % 60:02d}"
+            parts.append(part)
+        line = " | ".join(parts)
+        sys.stderr.write("\r" + line.ljust(self.width))
+        sys.stderr.flush()
+        self.width = len(line)
+
+
+PROGRESS = Progress()
@@ -0,0 +1,277 @@
+# Dump part files.
+# A dump is stored as parts of part_size bytes named like split -a3 names them
+# (snapshot-part-aaa, snapshot-part-aab, ..), so the part with index i holds the stream bytes
+# [i * part_size, (i + 1) * part_size).
+# Past snapshot-part-zzz the suffixes grow by three letters (zzzaaa, zzzaab, .. zzzzzz, zzzzzzaaa, ..)
+# so the parts still sort by name in stream order and the number of parts is not limited.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SUFFIX_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+SUFFIX_LENGTH = 3
+SUFFIXES_PER_BLOCK = len(SUFFIX_LETTERS) ** SUFFIX_LENGTH
+# the part being written, renamed to the part name once it is complete and fsynced
+PARTIAL_SUFFIX = ".partial"
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+def part_suffix(index):
+    block, index = divmod(index, SUFFIXES_PER_BLOCK)
+    suffix = ""
+    for _ in range(SUFFIX_LENGTH):
+        index, letter = divmod(index, len(SUFFIX_LETTERS))
+        suffix = SUFFIX_LETTERS[letter] + suffix
+    return SUFFIX_LETTERS[-1] * SUFFIX_LENGTH * block + suffix
+
+
+def part_index(suffix):
+    block = len(suffix) // SUFFIX_LENGTH - 1
+    index = 0
+    for letter in suffix[-SUFFIX_LENGTH:]:
+        index = index * len(SUFFIX_LETTERS) + SUFFIX_LETTERS.index(letter)
+    return block * SUFFIXES_PER_BLOCK + index
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _pwrite_all(fd, data, position):
+    while len(data) > 0:
+        n = os.pwrite(fd, data, position)
+        data = data[n:]
+        position += n
+
+
+# an open part file
+class _Part:
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        # bytes written to the part so far, the part is complete at part_size
+        self.size = 0
+        # writes submitted to the write threads and not done yet
+        self.pending = 0
+
+
+# Writes a stream into the parts prefix + suffix.
+# A writer created with an offset continues an existing dump that was truncated to that offset.
+# The stream is written with buffer() and commit(): the producer reads the next chunk into the
+# buffer returned by buffer() and commit(n) writes its first n bytes, no copy is made on the way.
+# A part is written as prefix + suffix + .partial, completed parts are fsynced and renamed.
+# sync() makes everything written so far durable.
+# Completed parts are fsynced and renamed by a background thread, the stream is not stopped while
+# a part is flushed to disk.
+# With in_flight > 1 the chunks are written by in_flight threads with pwrite, so several writes
+# (possibly to several parts) are in flight at a time, which hides the write latency of distributed
+# file systems. The producer then gets a new buffer once one of the writes is done.
+class PartWriter:
+    def __init__(self, prefix, part_size, offset=0, in_flight=1, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.prefix = prefix
+        self.directory = os.path.dirname(prefix) or "."
+        self.part_size = part_size
+        self.offset = offset
+        self.in_flight = max(1, in_flight)
+        self.part = None
+        self.lock = threading.Condition()
+        self.error = None
+        # (buffer, memoryview), one more than the writes in flight for the producer to fill
+        self.free = [
+            (buf, memoryview(buf))
+            for buf in (bytearray(buffer_size) for _ in range(self.in_flight + 1))
+        ]
+        self.current = None
+        self.executor = None
+        if self.in_flight > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.in_flight)
+        self.finisher = ThreadPoolExecutor(max_workers=1)
+        # futures of the parts being fsynced and renamed
+        self.finishing = []
+        if offset % part_size != 0:
+            path = self.path(offset // part_size)
+            if not os.path.exists(f"{path}{PARTIAL_SUFFIX}"):
+                # dumps started before the parts were written as .partial
+                os.rename(path, f"{path}{PARTIAL_SUFFIX}")
+            self.part = _Part(path, os.open(f"{path}{PARTIAL_SUFFIX}", os.O_WRONLY))
+            self.part.size = offset % part_size
+
+    def path(self, index):
+        return f"{self.prefix}{part_suffix(index)}"
+
+    # returns a memoryview of the buffer the next chunk is read into
+    def buffer(self):
+        if self.current is None:
+            with self.lock:
+                while len(self.free) == 0 and self.error is None:
+                    self.lock.wait()
+                self._check()
+                self.current = self.free.pop()
+        return self.current[1]
+
+    # writes the first n bytes of the buffer returned by buffer()
+    def commit(self, n):
+        buf, view = self.current
+        self.current = None
+        if self.executor is None:
+            self._write(view[:n])
+            self.free.append((buf, view))
+            return
+        # a chunk can span the end of a part, the buffer is free once all its writes are done
+        writes = []
+        data = view[:n]
+        with self.lock:
+            self._check()
+            while len(data) > 0:
+                part = self._current_part()
+                count = min(len(data), self.part_size - part.size)
+                writes.append((part, data[:count], part.size))
+                part.size += count
+                part.pending += 1
+                self.offset += count
+                data = data[count:]
+                if part.size == self.part_size:
+                    self.part = None
+        remaining = [len(writes)]
+        for part, chunk, position in writes:
+            self.executor.submit(self._write_async, part, chunk, position, (buf, view), remaining)
+
+    # copies data to the parts, for callers that do not read into the buffers of the writer
+    def write(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            view = self.buffer()
+            n = min(len(view), len(data))
+            view[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _current_part(self):
+        if self.part is None:
+            path = self.path(self.offset // self.part_size)
+            fd = os.open(f"{path}{PARTIAL_SUFFIX}", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.part = _Part(path, fd)
+        return self.part
+
+    def _write(self, data):
+        while len(data) > 0:
+            part = self._current_part()
+            n = min(len(data), self.part_size - part.size)
+            _pwrite_all(part.fd, data[:n], part.size)
+            part.size += n
+            self.offset += n
+            data = data[n:]
+            if part.size == self.part_size:
+                self.part = None
+                # errors of the parts finished so far are raised here
+                for future in [f for f in self.finishing if f.done()]:
+                    future.result()
+                    self.finishing.remove(future)
+                self.finishing.append(self.finisher.submit(self._finish_part, part))
+
+    def _write_async(self, part, data, position, buffer, remaining):
+        try:
+            _pwrite_all(part.fd, data, position)
+            with self.lock:
+                part.pending -= 1
+                complete = part.pending == 0 and part.size == self.part_size
+            if complete:
+                self._finish_part(part)
+        except BaseException as err:
+            with self.lock:
+                if self.error is None:
+                    self.error = err
+        finally:
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self.free.append(buffer)
+                self.lock.notify_all()
+
+    def _finish_part(self, part):
+        os.fsync(part.fd)
+        os.close(part.fd)
+        os.rename(f"{part.path}{PARTIAL_SUFFIX}", part.path)
+
+    # waits for the writes in flight and the parts being finished
+    def _wait(self):
+        for future in self.finishing:
+            future.result()
+        self.finishing = []
+        if self.executor is None:
+            return
+        # the buffer the producer holds is not in flight
+        buffers = self.in_flight + (0 if self.current is not None else 1)
+        with self.lock:
+            while len(self.free) < buffers and self.error is None:
+                self.lock.wait()
+            self._check()
+
+    def sync(self):
+        self._wait()
+        if self.part is not None:
+            os.fsync(self.part.fd)
+        # the renames of the completed parts
+        _fsync_dir(self.directory)
+
+    # completes the dump, the last part is renamed even if it is not full
+    def close(self):
+        self._wait()
+        if self.part is not None:
+            part, self.part = self.part, None
+            self._finish_part(part)
+        _fsync_dir(self.directory)
+        self._shutdown()
+
+    # stops writing after an error, the parts are left as they are
+    def abort(self):
+        self._shutdown()
+        if self.part is not None:
+            os.close(self.part.fd)
+            self.part = None
+
+    def _shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.finisher.shutdown(wait=True)
+
+
+# truncates the parts with the given prefix to the first offset bytes of the stream.
+# returns False if the parts on disk hold less than offset bytes.
+def truncate_parts(prefix, part_size, offset):
+    directory, name = os.path.split(prefix)
+    sizes = {}
+    paths = {}
+    for file in os.listdir(directory):
+        if file.startswith(name):
+            suffix = file[len(name) :]
+            if suffix.endswith(PARTIAL_SUFFIX):
+                suffix = suffix[: -len(PARTIAL_SUFFIX)]
+            index = part_index(suffix)
+            sizes[index] = os.path.getsize(f"{directory}/{file}")
+            paths[index] = f"{directory}/{file}"
+    for index in range(offset // part_size):
+        if sizes.get(index) != part_size:
+            return False
+    if offset % part_size != 0 and sizes.get(offset // part_size, 0) < offset % part_size:
+        return False
+    for index in sorted(sizes.keys()):
+        path = paths[index]
+        start = index * part_size
+        if start >= offset:
+            os.remove(path)
+        elif start + sizes[index] > offset:
+            os.truncate(path, offset - start)
+        elif start + part_size <= offset and path.endswith(PARTIAL_SUFFIX):
+            # the dump was interrupted before the complete part was renamed
+            os.rename(path, f"{prefix}{part_suffix(index)}")
+    return True
@@ -0,0 +1,49 @@
+# Helpers for running shell pipelines and pumping streams between them.
+import os
+from subprocess import Popen, PIPE
+
+PUMP_CHUNK_SIZE = 1024 * 1024
+
+
+def ensure_clean_exit(process):
+    if process.returncode != 0:
+        raise Exception(
+            f"{' '.join(process.args)} exited with non zero exit code {process.returncode}"
+        )
+
+
+# starts the commands as a pipeline (cmd1 | cmd2 | ...), returns the processes
+def start_pipeline(commands, stdout=PIPE, bufsize=-1, stdin=None):
+    processes = []
+    for idx, cmd in enumerate(commands):
+        out = stdout if idx == len(commands) - 1 else PIPE
+        if len(processes) > 0:
+            stdin = processes[-1].stdout
+        processes.append(Popen(cmd, stdin=stdin, stdout=out, bufsize=bufsize))
+    for process in processes[:-1]:
+        process.stdout.close()
+    return processes
+
+
+# waits for a process, returns its cpu time (user + system)
+def wait_process(process):
+    if process.returncode is not None:
+        return 0.0
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+# waits for a pipeline whose output was consumed, returns the cpu time of its processes
+def reap_pipeline(processes):
+    cpu_seconds = sum(wait_process(process) for process in processes)
+    for process in reversed(processes):
+        ensure_clean_exit(process)
+    return cpu_seconds
+
+
+def kill_pipeline(processes):
+    for process in processes:
+        process.kill()
+    for process in processes:
+        process.wait()
@@ -0,0 +1,85 @@
+# Read-ahead for restores.
+# A background thread runs the source pipelines (cat parts | decompress) of a list of streams one
+# after the other and buffers their output in a bounded queue, so the next streams are already read
+# and decompressed while the current one is received.
+import queue
+import threading
+import time
+
+from snapdump.metrics import Stage
+from snapdump.pipeline import PUMP_CHUNK_SIZE, kill_pipeline, reap_pipeline, start_pipeline
+
+# queue markers
+_END = object()
+_ERROR = object()
+
+
+# stats has a read stage per stream: the time the source waits for buffer space is its idle time and
+# the time the consumer waits for data is its stall time
+class Prefetcher(threading.Thread):
+    def __init__(self, sources, buffer_size, chunk_size=PUMP_CHUNK_SIZE):
+        super().__init__(daemon=True)
+        self.sources = sources
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=max(1, buffer_size // chunk_size))
+        self.stats = [Stage("read") for _ in sources]
+        self.lock = threading.Lock()
+        self.aborted = False
+        self.processes = []
+        self.current = 0
+
+    def _put(self, item, stats):
+        start = time.time()
+        while not self.aborted:
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stats.idle_seconds += time.time() - start
+
+    def run(self):
+        for commands, stats in zip(self.sources, self.stats):
+            try:
+                stats.started = time.time()
+                with self.lock:
+                    if self.aborted:
+                        return
+                    self.processes = start_pipeline(commands, bufsize=self.chunk_size)
+                stdout = self.processes[-1].stdout
+                while not self.aborted:
+                    chunk = stdout.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    self._put(chunk, stats)
+                if self.aborted:
+                    return
+                stats.cpu_seconds = reap_pipeline(self.processes)
+                stats.stop()
+                self._put(_END, stats)
+            except Exception as err:
+                self._put((_ERROR, err), stats)
+                return
+
+    # yields the chunks of the next stream
+    def stream(self):
+        stats = self.stats[self.current]
+        self.current += 1
+        while True:
+            start = time.time()
+            item = self.queue.get()
+            stats.stall_seconds += time.time() - start
+            if item is _END:
+                break
+            if isinstance(item, tuple) and item[0] is _ERROR:
+                raise item[1]
+            stats.bytes += len(item)
+            yield item
+
+    def close(self):
+        with self.lock:
+            self.aborted = True
+            processes = self.processes
+        if self.is_alive():
+            kill_pipeline(processes)
+        self.join()
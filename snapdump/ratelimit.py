@@ -0,0 +1,83 @@
+# Bandwidth limiting of the dump and restore streams.
+# A single token bucket is shared by all the streams of the process, so parallel dumps share the
+# limit of the link. The limit depends on the time of day (rate_limit.windows) and is looked up
+# for every chunk, a running dump speeds up or slows down when a window starts or ends.
+# The daemon can override the limit while it runs (snapdump rate-limit).
+import threading
+import time
+from datetime import datetime
+
+
+# windows is a list of (start minute, end minute, rate or None) in local time, a window that ends
+# before it starts wraps around midnight. rate is the limit outside of the windows, None for no limit.
+# clock, now and sleep replace time.monotonic, datetime.now and time.sleep in tests
+class RateLimiter:
+    def __init__(
+        self, rate=None, windows=None, clock=time.monotonic, now=datetime.now, sleep=time.sleep
+    ):
+        self.clock = clock
+        self.now = now
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.windows = windows or []
+        self.override = None
+        self.overridden = False
+        self.tokens = 0.0
+        self.last = self.clock()
+
+    def configure(self, rate, windows):
+        with self.lock:
+            self.rate = rate
+            self.windows = windows
+
+    # sets a rate that replaces the schedule, reset_override goes back to the schedule
+    def set_override(self, rate):
+        with self.lock:
+            self.override = rate
+            self.overridden = True
+
+    def reset_override(self):
+        with self.lock:
+            self.override = None
+            self.overridden = False
+
+    def _current_rate(self):
+        if self.overridden:
+            return self.override
+        now = self.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self.rate
+
+    def current_rate(self):
+        with self.lock:
+            return self._current_rate()
+
+    # takes n bytes from the bucket, waits until they are available.
+    # returns the number of seconds it waited
+    def consume(self, n):
+        with self.lock:
+            rate = self._current_rate()
+            now = self.clock()
+            if rate is None:
+                self.tokens = 0.0
+                self.last = now
+                return 0.0
+            # at most one second of unused bandwidth is saved up
+            self.tokens = min(float(rate), self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+LIMITER = RateLimiter()
@@ -0,0 +1,49 @@
+# Fair scheduling of the tasks of several servers on a fixed number of threads.
+# The next task goes to the server with the fewest running tasks, a server with many datasets does
+# not take all the threads while the other servers wait. A server at its limit of running tasks does
+# not take a thread to wait for a slot, its next task waits in its queue instead.
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# runs tasks, a list of (key, function), on jobs threads with at most limit running tasks per key
+# (0 for no limit). the tasks of a key start in order, among the keys with the fewest running tasks
+# the key that started a task the longest ago goes first. returns the results of the functions in
+# the order of tasks
+def run_fair(tasks, jobs, limit=0):
+    queues = {}
+    for index, (key, function) in enumerate(tasks):
+        queues.setdefault(key, []).append((index, function))
+    running = dict.fromkeys(queues, 0)
+    # key -> sequence number of its last started task
+    started = dict.fromkeys(queues, 0)
+    futures = [None] * len(tasks)
+    done = threading.Condition()
+
+    def run(key, function):
+        try:
+            return function()
+        finally:
+            with done:
+                running[key] -= 1
+                done.notify()
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        with done:
+            sequence = 0
+            while any(len(x) > 0 for x in queues.values()):
+                ready = [
+                    key
+                    for key, queue in queues.items()
+                    if len(queue) > 0 and (limit <= 0 or running[key] < limit)
+                ]
+                if len(ready) == 0 or sum(running.values()) >= max(1, jobs):
+                    done.wait()
+                    continue
+                key = min(ready, key=lambda x: (running[x], started[x]))
+                index, function = queues[key].pop(0)
+                running[key] += 1
+                sequence += 1
+                started[key] = sequence
+                futures[index] = executor.submit(run, key, function)
+    return [future.result() for future in futures]
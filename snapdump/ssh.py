@@ -0,0 +1,115 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+# The master exits on its own if it is idle for this long, this keeps an
+# orphaned master (for example after kill -9) from lingering forever.
+# The daemon sets it to "yes", its master lives as long as the daemon.
+CONTROL_PERSIST = 300
+
+
+# A persistent ssh connection that all ssh invocations to the same server are
+# multiplexed over (ControlMaster/ControlPath).
+# The master is started lazily on first use and lives until close() is called.
+# If the master cannot be established ssh invocations fall back to direct connections.
+class ControlMaster:
+    def __init__(self, ssh_cmd):
+        self.ssh_cmd = ssh_cmd
+        self.lock = threading.Lock()
+        self.control_dir = None
+        self.control_path = None
+        self.failed = False
+        # timing counters
+        self.handshakes = 0
+        self.handshake_seconds = 0.0
+        self.sessions = 0
+
+    def _start(self):
+        if self.control_dir is None:
+            self.control_dir = tempfile.mkdtemp(prefix="snapdump-ssh-")
+            self.control_path = f"{self.control_dir}/master"
+        cmd = self.ssh_cmd + [
+            "-M",
+            "-N",
+            "-f",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            f"ControlPersist={CONTROL_PERSIST}",
+        ]
+        start = time.time()
+        ret = subprocess.call(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        self.handshake_seconds += time.time() - start
+        self.handshakes += 1
+        if ret != 0:
+            self.failed = True
+
+    def options(self):
+        with self.lock:
+            if self.failed:
+                return []
+            if self.control_path is None or not os.path.exists(self.control_path):
+                self._start()
+                if self.failed:
+                    return []
+            self.sessions += 1
+        return ["-o", f"ControlPath={self.control_path}", "-o", "ControlMaster=no"]
+
+    def stats(self):
+        with self.lock:
+            avg_handshake = 0
+            if self.handshakes > 0:
+                avg_handshake = self.handshake_seconds / self.handshakes
+            return {
+                "handshakes": self.handshakes,
+                "handshake_seconds": self.handshake_seconds,
+                "sessions": self.sessions,
+                # every multiplexed session would have paid for its own handshake
+                "saved_seconds": max(0, self.sessions - self.handshakes)
+                * avg_handshake,
+            }
+
+    def close(self):
+        with self.lock:
+            if self.control_path is not None and os.path.exists(self.control_path):
+                subprocess.call(
+                    self.ssh_cmd
+                    + ["-O", "exit", "-o", f"ControlPath={self.control_path}"],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            if self.control_dir is not None:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+            self.control_path = None
+
+
+# ssh command (tuple) -> ControlMaster
+MASTERS = {}
+MASTERS_LOCK = threading.Lock()
+
+
+def get_control_master(ssh_cmd):
+    key = tuple(ssh_cmd)
+    with MASTERS_LOCK:
+        if key not in MASTERS:
+            MASTERS[key] = ControlMaster(list(ssh_cmd))
+        return MASTERS[key]
+
+
+# closes all masters, returns a list of (destination, stats) for masters that were used
+def close_control_masters():
+    with MASTERS_LOCK:
+        masters = list(MASTERS.values())
+        MASTERS.clear()
+    ret = []
+    for master in masters:
+        stats = master.stats()
+        master.close()
+        if stats["handshakes"] > 0:
+            ret.append((master.ssh_cmd[1], stats))
+    return ret
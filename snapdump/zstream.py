@@ -0,0 +1,278 @@
+# Streaming parser for the ZFS send stream format (dmu_replay_record_t records).
+# The stream is read sequentially in chunks and only one record is held in memory at a time.
+# Checksums are verified the same way zstreamdump does it: every record carries the fletcher-4
+# checksum of the stream up to its checksum field and DRR_END carries the checksum of the stream
+# before it.
+import struct
+from itertools import accumulate
+
+try:
+    import numpy
+except ImportError:  # optional, makes checksum verification much faster
+    numpy = None
+
+DMU_BACKUP_MAGIC = 0x2F5BACBAC
+DMU_COMPOUNDSTREAM = 2
+
+DRR_BEGIN = 0
+DRR_OBJECT = 1
+DRR_FREEOBJECTS = 2
+DRR_WRITE = 3
+DRR_FREE = 4
+DRR_END = 5
+DRR_WRITE_BYREF = 6
+DRR_SPILL = 7
+DRR_WRITE_EMBEDDED = 8
+DRR_OBJECT_RANGE = 9
+DRR_REDACT = 10
+
+RECORD_SIZE = 312
+CHECKSUM_OFFSET = RECORD_SIZE - 32
+DEFAULT_READ_SIZE = 8 * 1024 * 1024
+# larger than the largest possible payload (16M blocks), guards against garbage lengths
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+MASK64 = (1 << 64) - 1
+FLETCHER_BLOCK = 1 << 16
+
+
+class StreamError(Exception):
+    pass
+
+
+def _fletcher4_python(words, state):
+    a, b, c, d = state
+    for i in range(0, len(words), FLETCHER_BLOCK):
+        block = words[i : i + FLETCHER_BLOCK]
+        a_values = list(accumulate(block, initial=a))
+        b_values = list(accumulate(a_values[1:], initial=b))
+        c_values = list(accumulate(b_values[1:], initial=c))
+        d = (d + sum(c_values[1:])) & MASK64
+        a, b, c = a_values[-1] & MASK64, b_values[-1] & MASK64, c_values[-1] & MASK64
+    return a, b, c, d
+
+
+_numpy_weights = None
+
+
+def _fletcher4_numpy(words, state):
+    # closed form of fletcher-4 over a block of n words:
+    # a' = a + sum(w), b' = b + n*a + sum((n-i)*w), and so on.
+    # uint64 arithmetic wraps exactly like the fletcher-4 accumulators.
+    global _numpy_weights
+    if _numpy_weights is None:
+        k = numpy.arange(FLETCHER_BLOCK, 0, -1, dtype=numpy.uint64)
+        _numpy_weights = (
+            k,
+            k * (k + 1) // 2,
+            k * (k + 1) * (k + 2) // 6,
+        )
+    a, b, c, d = state
+    for i in range(0, len(words), FLETCHER_BLOCK):
+        block = words[i : i + FLETCHER_BLOCK].astype(numpy.uint64)
+        n = len(block)
+        wb, wc, wd = (w[FLETCHER_BLOCK - n :] for w in _numpy_weights)
+        sa = int(block.sum(dtype=numpy.uint64))
+        sb = int(numpy.dot(block, wb))
+        sc = int(numpy.dot(block, wc))
+        sd = int(numpy.dot(block, wd))
+        t2 = n * (n + 1) // 2
+        t3 = n * (n + 1) * (n + 2) // 6
+        a, b, c, d = (
+            (a + sa) & MASK64,
+            (b + n * a + sb) & MASK64,
+            (c + n * b + t2 * a + sc) & MASK64,
+            (d + n * c + t2 * b + t3 * a + sd) & MASK64,
+        )
+    return a, b, c, d
+
+
+# incremental fletcher-4 over 32 bit words, byteswap is used for streams created on
+# a machine with the opposite endianness.
+class Fletcher4:
+    def __init__(self, byteswap=False):
+        self.byteswap = byteswap
+        self.state = (0, 0, 0, 0)
+
+    def reset(self):
+        self.state = (0, 0, 0, 0)
+
+    def update(self, data):
+        if len(data) % 4 != 0:
+            raise StreamError("Unaligned data in zfs stream")
+        if len(data) == 0:
+            return
+        if numpy is not None:
+            dtype = ">u4" if self.byteswap else "<u4"
+            words = numpy.frombuffer(data, dtype=dtype)
+            self.state = _fletcher4_numpy(words, self.state)
+        else:
+            endian = ">" if self.byteswap else "<"
+            words = struct.unpack(f"{endian}{len(data) // 4}I", data)
+            self.state = _fletcher4_python(words, self.state)
+
+
+def checksum_hex(state):
+    return ":".join(f"{x:x}" for x in state)
+
+
+class _Reader:
+    def __init__(self, f, read_size):
+        self.f = f
+        self.read_size = read_size
+        self.offset = 0
+
+    def read_exact(self, n, allow_eof=False):
+        data = self.f.read(n)
+        if len(data) < n:
+            chunks = [data]
+            size = len(data)
+            while size < n:
+                chunk = self.f.read(n - size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            data = b"".join(chunks)
+        if len(data) == 0 and allow_eof:
+            return None
+        if len(data) < n:
+            raise StreamError(f"Truncated zfs stream at offset {self.offset + len(data)}")
+        self.offset += n
+        return data
+
+
+def _payload_size(drr_type, record, endian):
+    if drr_type == DRR_BEGIN:
+        (size,) = struct.unpack_from(f"{endian}I", record, 4)
+    elif drr_type == DRR_OBJECT:
+        bonuslen, raw_bonuslen = struct.unpack_from(f"{endian}I4xI", record, 28)
+        size = raw_bonuslen if raw_bonuslen != 0 else (bonuslen + 7) // 8 * 8
+    elif drr_type == DRR_WRITE:
+        (logical_size,) = struct.unpack_from(f"{endian}Q", record, 32)
+        compression = record[50]
+        (compressed_size,) = struct.unpack_from(f"{endian}Q", record, 96)
+        size = compressed_size if compression != 0 else logical_size
+    elif drr_type == DRR_SPILL:
+        (length,) = struct.unpack_from(f"{endian}Q", record, 16)
+        (compressed_size,) = struct.unpack_from(f"{endian}Q", record, 40)
+        size = compressed_size if compressed_size != 0 else length
+    elif drr_type == DRR_WRITE_EMBEDDED:
+        (psize,) = struct.unpack_from(f"{endian}I", record, 52)
+        size = (psize + 7) // 8 * 8
+    elif drr_type in (
+        DRR_FREEOBJECTS,
+        DRR_FREE,
+        DRR_END,
+        DRR_WRITE_BYREF,
+        DRR_OBJECT_RANGE,
+        DRR_REDACT,
+    ):
+        size = 0
+    else:
+        raise StreamError(f"Unknown record type {drr_type}")
+    if size > MAX_PAYLOAD_SIZE:
+        raise StreamError(f"Invalid payload size {size} for record type {drr_type}")
+    return size
+
+
+# Parses a zfs send stream from the file object f.
+# Returns a dict describing the stream:
+#   toguid, fromguid, toname : from the first BEGIN record
+#   checksum : the checksum of the last END record
+#   substreams : list of (toguid, fromguid, toname) of the BEGIN records of a compound (send -R) stream
+#   records, bytes : totals
+def parse_stream(f, verify_checksums=True, read_size=DEFAULT_READ_SIZE):
+    reader = _Reader(f, read_size)
+    endian = None
+    checksum = None
+    result = None
+    in_stream = False
+    compound = False
+    records = 0
+    while True:
+        record = reader.read_exact(RECORD_SIZE, allow_eof=True)
+        if record is None:
+            break
+        records += 1
+        if endian is None:
+            (magic,) = struct.unpack_from("<Q", record, 8)
+            if magic == DMU_BACKUP_MAGIC:
+                endian = "<"
+            elif struct.unpack_from(">Q", record, 8)[0] == DMU_BACKUP_MAGIC:
+                endian = ">"
+            else:
+                raise StreamError("Not a zfs send stream (invalid magic)")
+            checksum = Fletcher4(byteswap=endian != "<")
+
+        (drr_type,) = struct.unpack_from(f"{endian}I", record, 0)
+        before = checksum.state
+        if verify_checksums:
+            checksum.update(record[:CHECKSUM_OFFSET])
+            stored = struct.unpack_from(f"{endian}4Q", record, CHECKSUM_OFFSET)
+            if stored != (0, 0, 0, 0) and stored != checksum.state:
+                raise StreamError(
+                    f"Invalid checksum in record {records} at offset {reader.offset - RECORD_SIZE}"
+                )
+            checksum.update(record[CHECKSUM_OFFSET:])
+
+        if drr_type == DRR_BEGIN:
+            (magic,) = struct.unpack_from(f"{endian}Q", record, 8)
+            if magic != DMU_BACKUP_MAGIC:
+                raise StreamError(f"Invalid magic in BEGIN record {records}")
+            (versioninfo,) = struct.unpack_from(f"{endian}Q", record, 16)
+            toguid, fromguid = struct.unpack_from(f"{endian}QQ", record, 40)
+            toname = record[56:RECORD_SIZE].split(b"\0", 1)[0].decode("utf-8", "replace")
+            if result is None:
+                result = {
+                    "toguid": toguid,
+                    "fromguid": fromguid,
+                    "toname": toname,
+                    "substreams": [],
+                }
+                compound = versioninfo & 0x3 == DMU_COMPOUNDSTREAM
+            elif compound:
+                result["substreams"].append(
+                    {"toguid": toguid, "fromguid": fromguid, "toname": toname}
+                )
+            else:
+                raise StreamError(f"Unexpected BEGIN record {records}")
+            in_stream = True
+        elif drr_type == DRR_END:
+            end_checksum = struct.unpack_from(f"{endian}4Q", record, 8)
+            (toguid,) = struct.unpack_from(f"{endian}Q", record, 40)
+            if result is None:
+                raise StreamError("END record before BEGIN record")
+            if in_stream:
+                if verify_checksums and end_checksum != before:
+                    raise StreamError(
+                        f"END checksum {checksum_hex(end_checksum)} differs from stream checksum {checksum_hex(before)}"
+                    )
+                result["checksum"] = checksum_hex(end_checksum)
+                in_stream = False
+            elif not compound:
+                raise StreamError(f"Unexpected END record {records}")
+            checksum.reset()
+        elif not in_stream:
+            raise StreamError(f"Record {records} of type {drr_type} outside of a stream")
+
+        size = _payload_size(drr_type, record, endian)
+        while size > 0:
+            data = reader.read_exact(min(size, read_size))
+            if verify_checksums:
+                checksum.update(data)
+            size -= len(data)
+
+        if not in_stream and not compound:
+            # a plain stream ends with its END record
+            if reader.read_exact(1, allow_eof=True) is not None:
+                raise StreamError("Unexpected data after END record")
+            break
+
+    if result is None:
+        raise StreamError("Empty zfs stream")
+    if in_stream:
+        raise StreamError("Truncated zfs stream, missing END record")
+    result["records"] = records
+    result["bytes"] = reader.offset
+    return result
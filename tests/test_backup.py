@@ -0,0 +1,223 @@
+# End to end tests of backup against the fake zfs server of the benchmarks (benchmarks/fakezfs)
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import pytest
+
+from snapdump.cli import TIME_FORMAT
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_BIN = f"{REPO}/benchmarks/fakezfs/bin"
+DATASET = "bench/data"
+
+
+@pytest.fixture
+def server(tmp_path):
+    now = time.time()
+    snapshots = [
+        {
+            "name": datetime.utcfromtimestamp(now - 3600 * index).strftime(TIME_FORMAT),
+            "guid": 10 - index,
+            "creation": now - 3600 * index,
+        }
+        for index in reversed(range(3))
+    ]
+    with open(tmp_path / "state-bench.json", "w") as f:
+        json.dump({DATASET: snapshots}, f)
+    env = dict(os.environ)
+    env.update(
+        PATH=f"{FAKE_BIN}:{env['PATH']}",
+        PYTHONPATH=REPO,
+        SNAPDUMP_FAKE_STATE=f"{tmp_path}/state-{{host}}.json",
+        SNAPDUMP_FAKE_SIZE=str(64 * 1024),
+        SNAPDUMP_FAKE_HANDSHAKE="0",
+        XDG_CACHE_HOME=str(tmp_path / "cache"),
+    )
+    return tmp_path, env
+
+
+def write_config(path, servers=None):
+    conf = {
+        "server": {
+            "hostname": "bench",
+            "ssh_user": "root",
+            "identity_file": None,
+            "ssh_options": None,
+        },
+        "backup": {
+            "directory": f"{path}/backups",
+            "datasets": [DATASET],
+            "interval_days": {"full": 30, "incremental": 1},
+            "retention_days": 90,
+            "split_size": "1G",
+            "dump_dead_seconds": 60,
+            "compression": {"codec": "gzip"},
+        },
+    }
+    if servers is not None:
+        del conf["backup"]["datasets"]
+        conf["servers"] = [{"hostname": server, "datasets": [DATASET]} for server in servers]
+    with open(path / "config.yml", "w") as f:
+        json.dump(conf, f)
+    return str(path / "config.yml")
+
+
+def snapdump(env, config, *args):
+    return subprocess.run(
+        [sys.executable, f"{REPO}/bin/snapdump", "-c", config] + list(args),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+@pytest.mark.parametrize("servers", [None, ["bench"]])
+def test_dry_run_nothing_due(server, servers):
+    path, env = server
+    config = write_config(path, servers)
+    assert snapdump(env, config, "backup", "--no-verify").returncode == 0
+    ret = snapdump(env, config, "backup", "--dry-run")
+    assert ret.returncode == 0, ret.stderr.decode()
+    label = DATASET if servers is None else f"bench:{DATASET}"
+    assert f"\t{label} : not due until" in ret.stdout.decode()
+
+
+# a restore that is executed again skips the streams that are already on the destination
+def test_restore_again(server):
+    path, env = server
+    config = write_config(path)
+    assert snapdump(env, config, "backup", "--no-verify").returncode == 0
+    with open(path / "state-bench.json") as f:
+        snapshot = json.load(f)[DATASET][-1]["name"]
+    args = ["restore", "-s", f"{DATASET}@{snapshot}", "-d", "bench/restore"]
+    ret = snapdump(env, config, *args)
+    assert ret.returncode == 0, ret.stderr.decode()
+    ret = snapdump(env, config, *args)
+    assert ret.returncode == 0, ret.stderr.decode()
+    assert "Skipping 1 stream(s) already received by bench/restore" in ret.stdout.decode()
+
+
+# restore and remote verify decompress according to how each dump was written, not to the
+# current compression.at setting
+def test_restore_after_compression_moved(server):
+    path, env = server
+    config = write_config(path)
+    with open(config) as f:
+        conf = json.load(f)
+    conf["backup"]["compression"]["at"] = "remote"
+    with open(config, "w") as f:
+        json.dump(conf, f)
+    assert snapdump(env, config, "backup", "--no-verify").returncode == 0
+    write_config(path)
+    with open(path / "state-bench.json") as f:
+        snapshot = json.load(f)[DATASET][-1]["name"]
+    ret = snapdump(env, config, "verify", "-s", f"{DATASET}@{snapshot}", "--mode", "remote")
+    assert ret.returncode == 0, ret.stderr.decode()
+    ret = snapdump(env, config, "restore", "-s", f"{DATASET}@{snapshot}", "-d", "bench/restore")
+    assert ret.returncode == 0, ret.stderr.decode()
+
+
+def test_verify_remote(server):
+    path, env = server
+    config = write_config(path)
+    assert snapdump(env, config, "backup", "--no-verify").returncode == 0
+    with open(path / "state-bench.json") as f:
+        snapshot = json.load(f)[DATASET][-1]["name"]
+    ret = snapdump(env, config, "verify", "-s", f"{DATASET}@{snapshot}", "--mode", "remote")
+    assert ret.returncode == 0, ret.stderr.decode()
+    assert "ZFS stream intact" in ret.stdout.decode()
+    # a missing part fails the verification
+    part = sorted(glob.glob(f"{path}/backups/**/*-part-*", recursive=True))[0]
+    os.remove(part)
+    ret = snapdump(env, config, "verify", "-s", f"{DATASET}@{snapshot}", "--mode", "remote")
+    assert ret.returncode != 0
+
+
+def test_scrub(server):
+    path, env = server
+    config = write_config(path)
+    assert snapdump(env, config, "backup", "--no-verify").returncode == 0
+    ret = snapdump(env, config, "scrub", "-j", "2")
+    assert ret.returncode == 0, ret.stderr.decode()
+    assert "All parts intact" in ret.stdout.decode()
+    # a byte flipped in a part is found, the part keeps its size
+    part = sorted(glob.glob(f"{path}/backups/**/*-part-*", recursive=True))[0]
+    with open(part, "r+b") as f:
+        f.seek(100)
+        byte = f.read(1)
+        f.seek(100)
+        f.write(bytes([byte[0] ^ 1]))
+    ret = snapdump(env, config, "scrub", "-j", "2")
+    assert ret.returncode == 1
+    assert f"part {os.path.basename(part)} : sha256" in ret.stdout.decode() + ret.stderr.decode()
+
+
+def write_bookmarks_config(path):
+    config = write_config(path)
+    with open(config) as f:
+        conf = json.load(f)
+    conf["backup"]["interval_days"]["incremental"] = 0
+    conf["backup"]["bookmarks"] = {"enabled": True}
+    with open(config, "w") as f:
+        json.dump(conf, f)
+    return config
+
+
+# removes a snapshot and with bookmark its bookmark from the fake zfs server
+def destroy_on_server(path, snapshot, bookmark=False):
+    with open(path / "state-bench.json") as f:
+        state = json.load(f)
+    state[DATASET] = [x for x in state[DATASET] if x["name"] != snapshot]
+    if bookmark:
+        marks = state["#bookmarks"][DATASET]
+        state["#bookmarks"][DATASET] = [x for x in marks if x["name"] != snapshot]
+    with open(path / "state-bench.json", "w") as f:
+        json.dump(state, f)
+
+
+def dumped_snapshots(path):
+    with open(path / "state-bench.json") as f:
+        state = json.load(f)
+    return [x["name"] for x in state["#bookmarks"][DATASET]]
+
+
+# once the dumped snapshot is destroyed the next incremental is sent from its bookmark
+def test_incremental_from_bookmark(server):
+    path, env = server
+    config = write_bookmarks_config(path)
+    assert snapdump(env, config, "backup", "--no-verify").returncode == 0
+    [base] = dumped_snapshots(path)
+    # the snapshot is used while it is on the server
+    time.sleep(1)
+    ret = snapdump(env, config, "backup", "--no-verify")
+    assert ret.returncode == 0, ret.stderr.decode()
+    assert f"based on {base}\n" in ret.stdout.decode()
+    base = dumped_snapshots(path)[-1]
+    destroy_on_server(path, base)
+    time.sleep(1)
+    ret = snapdump(env, config, "backup", "--no-verify")
+    assert ret.returncode == 0, ret.stderr.decode()
+    assert f"based on {base} (bookmark)" in ret.stdout.decode()
+    snapshot = dumped_snapshots(path)[-1]
+    ret = snapdump(env, config, "restore", "-s", f"{DATASET}@{snapshot}", "-d", "bench/restore")
+    assert ret.returncode == 0, ret.stderr.decode()
+
+
+# without the snapshot and its bookmark there is no incremental source, the backup is aborted
+def test_incremental_base_missing(server):
+    path, env = server
+    config = write_bookmarks_config(path)
+    assert snapdump(env, config, "backup", "--no-verify").returncode == 0
+    [base] = dumped_snapshots(path)
+    destroy_on_server(path, base, bookmark=True)
+    time.sleep(1)
+    ret = snapdump(env, config, "backup", "--no-verify")
+    assert ret.returncode != 0
+    output = ret.stdout.decode() + ret.stderr.decode()
+    assert f"{DATASET}@{base} snapshot is not on the zfs server" in output
+    assert len(glob.glob(f"{path}/backups/**/incr##*", recursive=True)) == 0
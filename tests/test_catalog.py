@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+
+from snapdump.catalog import (
+    append_catalog,
+    catalog_lock,
+    catalog_path,
+    compact_catalog,
+    read_catalog,
+    write_catalog,
+)
+
+
+def entry(directory, **fields):
+    return dict({"directory": directory, "group": directory.split("/")[0]}, **fields)
+
+
+def test_no_catalog(tmp_path):
+    assert read_catalog(tmp_path) is None
+    compact_catalog(tmp_path)
+    assert not os.path.exists(catalog_path(tmp_path))
+
+
+def test_replay(tmp_path):
+    append_catalog(
+        tmp_path,
+        [
+            dict(entry("g1/full##a"), op="add"),
+            dict(entry("g1/incr##b"), op="add"),
+            dict(entry("g2/full##c"), op="add"),
+        ],
+    )
+    append_catalog(
+        tmp_path,
+        [
+            {"op": "update", "directory": "g2/full##c", "fields": {"verified": True}},
+            # updates of entries that were removed are ignored
+            {"op": "update", "directory": "g3/full##d", "fields": {"verified": True}},
+            {"op": "remove_group", "group": "g1"},
+        ],
+    )
+    assert read_catalog(tmp_path) == {"g2/full##c": entry("g2/full##c", verified=True)}
+
+
+# a line that was partially written by a crash during an append is ignored
+def test_truncated_last_line(tmp_path):
+    append_catalog(tmp_path, [dict(entry("g1/full##a"), op="add")])
+    with open(catalog_path(tmp_path), "a") as f:
+        f.write('{"op": "add", "directory": "g1/in')
+    assert list(read_catalog(tmp_path)) == ["g1/full##a"]
+    # the next append is not joined to the torn line
+    append_catalog(tmp_path, [dict(entry("g1/incr##b"), op="add")])
+    assert list(read_catalog(tmp_path)) == ["g1/full##a", "g1/incr##b"]
+
+
+def test_compact(tmp_path):
+    append_catalog(tmp_path, [dict(entry("g1/full##a"), op="add")])
+    append_catalog(tmp_path, [dict(entry("g2/full##b"), op="add")])
+    append_catalog(
+        tmp_path, [{"op": "update", "directory": "g2/full##b", "fields": {"size": 10}}]
+    )
+    append_catalog(tmp_path, [{"op": "remove_group", "group": "g1"}])
+    entries = read_catalog(tmp_path)
+    compact_catalog(tmp_path)
+    assert read_catalog(tmp_path) == entries
+    with open(catalog_path(tmp_path)) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines == [dict(entry("g2/full##b", size=10), op="add")]
+    # no temporary file is left behind
+    assert os.listdir(tmp_path) == [os.path.basename(catalog_path(tmp_path))]
+
+
+# an append while the catalog is rewritten waits for the rewrite and goes to the new file
+def test_append_during_rewrite(tmp_path):
+    append_catalog(tmp_path, [dict(entry("g1/full##a"), op="add")])
+    with catalog_lock(tmp_path):
+        thread = threading.Thread(
+            target=append_catalog, args=(tmp_path, [dict(entry("g1/incr##b"), op="add")])
+        )
+        thread.start()
+        time.sleep(0.1)
+        assert thread.is_alive()
+        write_catalog(tmp_path, {"g1/full##a": entry("g1/full##a", rewritten=True)})
+    thread.join()
+    entries = read_catalog(tmp_path)
+    assert list(entries) == ["g1/full##a", "g1/incr##b"]
+    assert entries["g1/full##a"]["rewritten"]
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from snapdump.checksum import PartHasher, hash_file, new_hash
+from snapdump.parts import PartWriter
+
+PART_SIZE = 1000
+
+
+# the digests computed while the parts are written are the digests of the part files
+@pytest.mark.parametrize("algorithm", ["sha256", "blake2b"])
+def test_hash_while_writing(tmp_path, algorithm):
+    data = os.urandom(3500)
+    writer = PartWriter(f"{tmp_path}/snap-part-", PART_SIZE)
+    hasher = PartHasher(algorithm, PART_SIZE)
+    for start in range(0, len(data), 333):
+        chunk = data[start : start + 333]
+        hasher.update(chunk)
+        writer.write(chunk)
+    writer.close()
+    digests = hasher.finish()
+    paths = [f"{tmp_path}/{x}" for x in sorted(os.listdir(tmp_path))]
+    assert digests == [hash_file(path, algorithm, read_size=100)[0] for path in paths]
+    assert [hash_file(path, algorithm)[1] for path in paths] == [1000, 1000, 1000, 500]
+
+
+# a resumed dump continues hashing from the digests of its checkpoint
+def test_hash_continued():
+    data = os.urandom(3500)
+    hasher = PartHasher("sha256", PART_SIZE)
+    hasher.update(data)
+    expected = hasher.finish()
+    hasher = PartHasher("sha256", PART_SIZE)
+    hasher.update(data[:2000])
+    hasher = PartHasher("sha256", PART_SIZE, hasher.digests)
+    hasher.update(data[2000:])
+    assert hasher.finish() == expected
+
+
+def test_unsupported_algorithm():
+    with pytest.raises(Exception, match="Unsupported checksum algorithm 'md5'"):
+        new_hash("md5")
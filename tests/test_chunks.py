@@ -0,0 +1,39 @@
+import os
+
+from snapdump import chunks as chunks_module
+from snapdump.chunks import Chunker
+
+AVERAGE_SIZE = 4096
+
+
+def chunk(data, piece_size=100000):
+    chunker = Chunker(AVERAGE_SIZE)
+    chunks = []
+    for idx in range(0, len(data), piece_size):
+        chunks += chunker.feed(data[idx : idx + piece_size])
+    return chunks + chunker.finish()
+
+
+def test_chunks():
+    data = os.urandom(1024 * 1024)
+    chunks = chunk(data)
+    assert b"".join(chunks) == data
+    assert all(AVERAGE_SIZE // 2 <= len(x) <= AVERAGE_SIZE * 4 for x in chunks[:-1])
+    # the boundaries depend on the content, not on how the stream is fed
+    assert chunk(data, 777) == chunks
+
+
+# bytes inserted at the start of the stream only change the first chunks
+def test_chunks_shifted():
+    data = os.urandom(1024 * 1024)
+    chunks = chunk(data)
+    shifted = chunk(os.urandom(10) + data)
+    assert len(set(chunks) & set(shifted)) >= len(chunks) - 2
+
+
+# the chunks of the python fallback are the ones of numpy
+def test_chunks_without_numpy(monkeypatch):
+    data = os.urandom(256 * 1024)
+    chunks = chunk(data)
+    monkeypatch.setattr(chunks_module, "numpy", None)
+    assert chunk(data) == chunks
@@ -0,0 +1,32 @@
+from snapdump import cli
+from snapdump.config import Config
+
+
+def test_destroy_specs():
+    names = list("abcdefgh")
+    assert cli.get_destroy_specs(names, set()) == []
+    assert cli.get_destroy_specs(names, {"a", "b", "d", "e", "f", "h"}) == ["a", "b", "d%f", "h"]
+    assert cli.get_destroy_specs(names, set(names)) == ["a%h"]
+
+
+def test_destroy_batches(monkeypatch):
+    commands = []
+
+    def ssh_cmd(conf, command, stderr=None):
+        commands.append(command)
+        return b"destroy\tpool/data@a\nreclaim\t4096\n"
+
+    monkeypatch.setattr(cli, "ssh_cmd", ssh_cmd)
+    conf = Config(server=Config(hostname="zfs", ssh_user="root"))
+    specs = [f"s{idx}" for idx in range(cli.DESTROY_BATCH_SIZE + 1)]
+    assert cli.zfs_destroy_snapshots(conf, "pool/data", specs, dry_run=True) == 2 * 4096
+    assert commands == [
+        ["zfs", "destroy", "-nvp", "pool/data@" + ",".join(specs[:-1])],
+        ["zfs", "destroy", "-nvp", f"pool/data@{specs[-1]}"],
+    ]
+    commands.clear()
+    cli.zfs_destroy_snapshots(conf, "pool/data", specs)
+    assert [x[2] for x in commands] == [
+        "pool/data@" + ",".join(specs[:-1]),
+        f"pool/data@{specs[-1]}",
+    ]
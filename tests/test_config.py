@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+from snapdump.config import Config, _cache_path, load_config
+
+CONFIG = """
+server:
+  hostname: zfs
+  ssh_user: root
+backup:
+  directory: /backups
+  datasets: [pool/a]
+"""
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    path = tmp_path / "config.yml"
+    path.write_text(CONFIG)
+    return str(path)
+
+
+def test_missing_key(config_file):
+    conf = load_config(config_file)
+    assert conf.server.hostname == "zfs"
+    assert conf.server.identity_file is None
+    assert conf.server.ssh_options is None
+    assert conf.rate_limit is None
+
+
+def test_cache(config_file, monkeypatch):
+    conf = load_config(config_file)
+    assert os.path.exists(_cache_path(config_file))
+    # the cached config is loaded without OmegaConf
+    monkeypatch.setitem(sys.modules, "omegaconf", None)
+    cached = load_config(config_file)
+    assert isinstance(cached, Config)
+    assert cached == conf
+
+
+# the cache is not used once the config file changes
+def test_cache_invalidation(config_file, monkeypatch):
+    load_config(config_file)
+    with open(config_file, "a") as f:
+        f.write("  retention_days: 90\n")
+    assert load_config(config_file).backup.retention_days == 90
+    monkeypatch.setitem(sys.modules, "omegaconf", None)
+    assert load_config(config_file).backup.retention_days == 90
+
+
+# configs with interpolations are not cached
+def test_interpolation(config_file, monkeypatch):
+    monkeypatch.setenv("SNAPDUMP_TEST_HOST", "zfs2")
+    with open(config_file, "a") as f:
+        f.write("daemon:\n  host: ${oc.env:SNAPDUMP_TEST_HOST}\n")
+    assert load_config(config_file).daemon.host == "zfs2"
+    assert not os.path.exists(_cache_path(config_file))
@@ -0,0 +1,159 @@
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from snapdump import cli
+from snapdump.config import _to_config, default_daemon_socket
+from snapdump.daemon import DAY_SECONDS, MAX_SLEEP_SECONDS, Daemon
+
+START = 1700000000.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = START
+
+    def __call__(self):
+        return self.now
+
+
+# records the tasks the scheduler starts without running them
+class Recorder:
+    def __init__(self):
+        self.started = []
+
+    def submit(self, fn, label, task):
+        self.started.append((label, task))
+
+
+def make_conf(tmp_path, **daemon):
+    return _to_config(
+        {
+            "server": {"hostname": "zfs", "ssh_user": "root"},
+            "backup": {
+                "directory": str(tmp_path),
+                "datasets": ["pool/a", "pool/b"],
+                "interval_days": {"full": 30, "incremental": 1},
+                "retention_days": 90,
+                "max_parallel": 2,
+            },
+            "daemon": dict({"jitter_seconds": 0, "scrub_interval_days": 0}, **daemon),
+        }
+    )
+
+
+@pytest.fixture
+def due(monkeypatch):
+    # dataset -> time its next backup is due
+    due = {}
+    monkeypatch.setattr(cli, "get_backup_due_time", lambda conf, dataset, now: (due[dataset], None))
+    monkeypatch.setattr(cli, "STOP_DUMPS", threading.Event())
+    monkeypatch.setattr(cli, "write_metrics", lambda conf: None)
+    return due
+
+
+def test_start_due_tasks(tmp_path, due):
+    clock = Clock()
+    due.update({"pool/a": START, "pool/b": START + 3600})
+    daemon = Daemon(make_conf(tmp_path, cleanup_interval_hours=24), False, clock=clock)
+    daemon.schedule(START)
+    # the first cleanups start right away, scrubs are disabled
+    assert daemon.datasets["pool/b"]["next"] == {
+        "backup": START + 3600,
+        "cleanup": START,
+        "scrub": None,
+    }
+    executor = Recorder()
+    assert daemon.start_due_tasks(executor, START) == START + MAX_SLEEP_SECONDS
+    # one task per dataset, at most backup.max_parallel
+    assert executor.started == [("pool/a", "backup"), ("pool/b", "cleanup")]
+    assert daemon.start_due_tasks(executor, START) == START + MAX_SLEEP_SECONDS
+    assert len(executor.started) == 2
+
+
+def test_run_task(tmp_path, due, monkeypatch):
+    clock = Clock()
+    due.update({"pool/a": START, "pool/b": START})
+    daemon = Daemon(make_conf(tmp_path, retry_minutes=30), False, clock=clock)
+    daemon.schedule(START)
+    outcomes = {"pool/a": "done", "pool/b": "failed"}
+    monkeypatch.setattr(
+        cli,
+        "backup_dataset",
+        lambda conf, dataset, now, verify: (dataset, outcomes[dataset], 1.0, None),
+    )
+    executor = Recorder()
+    daemon.start_due_tasks(executor, START)
+    clock.now = START + 600
+    due.update({"pool/a": START + DAY_SECONDS, "pool/b": START})
+    for label, task in executor.started:
+        daemon.run_task(label, task)
+    assert daemon.running == 0
+    state = daemon.datasets["pool/a"]
+    assert state["running"] is None
+    assert state["last"]["backup"]["outcome"] == "done"
+    assert state["next"]["backup"] == START + DAY_SECONDS
+    # a failed backup that is still due is retried after daemon.retry_minutes
+    state = daemon.datasets["pool/b"]
+    assert state["last"]["backup"]["outcome"] == "failed"
+    assert state["next"]["backup"] == START + 600 + 30 * 60
+
+
+# the loop starts the tasks as the clock reaches their time and returns once stopped
+def test_loop(tmp_path, due, monkeypatch):
+    clock = Clock()
+    due.update({"pool/a": START, "pool/b": START + 3600})
+    daemon = Daemon(make_conf(tmp_path, cleanup_interval_hours=0), False, clock=clock)
+    daemon.schedule(START)
+    for label in daemon.datasets:
+        daemon.datasets[label]["next"]["cleanup"] = None
+    backups = []
+    done = threading.Event()
+
+    def backup_dataset(conf, dataset, now, verify):
+        backups.append((dataset, now))
+        due[dataset] = START + DAY_SECONDS
+        if len(backups) == 2:
+            done.set()
+        else:
+            # the next backup is due once the loop wakes up
+            clock.now = START + 3600
+        return dataset, "done", 1.0, None
+
+    monkeypatch.setattr(cli, "backup_dataset", backup_dataset)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        thread = threading.Thread(target=daemon.loop, args=(executor,))
+        thread.start()
+        assert done.wait(10)
+        daemon.stop(signal.SIGTERM, None)
+        thread.join(10)
+        assert not thread.is_alive()
+    assert backups == [("pool/a", int(START)), ("pool/b", int(START + 3600))]
+
+
+@pytest.mark.parametrize("mode, stop_dumps", [("checkpoint", True), ("finish", False)])
+def test_stop(tmp_path, due, mode, stop_dumps):
+    daemon = Daemon(make_conf(tmp_path, shutdown_mode=mode), False, clock=Clock())
+    daemon.stop(signal.SIGTERM, None)
+    assert daemon.stopping
+    assert cli.STOP_DUMPS.is_set() == stop_dumps
+    # no task is started once the daemon is stopping
+    executor = Recorder()
+    daemon.schedule(START)
+    daemon.loop(executor)
+    assert executor.started == []
+
+
+def test_default_socket(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    conf = make_conf(tmp_path)
+    socket = cli.get_daemon_socket(conf)
+    assert socket.startswith("/run/user/1000/snapdump/snapdump-")
+    assert socket == default_daemon_socket(str(tmp_path))
+    assert default_daemon_socket("/other") != socket
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert cli.get_daemon_socket(conf).startswith("/run/snapdump/")
+    conf.daemon["socket"] = "/tmp/snapdump.sock"
+    assert cli.get_daemon_socket(conf) == "/tmp/snapdump.sock"
@@ -0,0 +1,111 @@
+import gzip
+import os
+import random
+import sys
+import threading
+
+import pytest
+
+from snapdump.checksum import hash_file
+from snapdump.dump import (
+    CHECKPOINT_FILE,
+    DumpStopped,
+    StreamChanged,
+    read_checkpoint,
+    write_dump_stream,
+)
+
+SIZE = 3 * 1024 * 1024
+PART_SIZE = 300000
+CHECKPOINT_SIZE = 256 * 1024
+# writes SIZE bytes of random data of a seed, like a zfs send of a snapshot
+SEND = (
+    "import random, sys; "
+    "sys.stdout.buffer.write(random.Random(int(sys.argv[1])).randbytes(int(sys.argv[2])))"
+)
+
+
+def send_cmd(seed=1, size=SIZE):
+    return [sys.executable, "-c", SEND, str(seed), str(size)]
+
+
+def stream(seed=1, size=SIZE):
+    return random.Random(seed).randbytes(size)
+
+
+def part_paths(dump_dir):
+    return [f"{dump_dir}/{x}" for x in sorted(os.listdir(dump_dir)) if x != CHECKPOINT_FILE]
+
+
+def dump(dump_dir, compress=None, resume=False, stop_at=None, seed=1, size=SIZE, in_flight=1):
+    stop = threading.Event()
+
+    def progress(offset):
+        if stop_at is not None and offset >= stop_at:
+            stop.set()
+
+    checksums, _ = write_dump_stream(
+        send_cmd(seed, size),
+        compress,
+        f"{dump_dir}/snap-part-",
+        PART_SIZE,
+        "sha256",
+        CHECKPOINT_SIZE,
+        resume=resume,
+        progress=progress,
+        stop=stop,
+        in_flight=in_flight,
+    )
+    return checksums
+
+
+def read_dump(dump_dir, compress):
+    data = b"".join(open(path, "rb").read() for path in part_paths(dump_dir))
+    return gzip.decompress(data) if compress is not None else data
+
+
+# a dump stopped at a checkpoint and resumed has the stream and checksums of an uninterrupted dump
+@pytest.mark.parametrize("compress", [None, ["gzip", "-1"]])
+@pytest.mark.parametrize("in_flight", [1, 4])
+def test_stop_and_resume(tmp_path, compress, in_flight):
+    with pytest.raises(DumpStopped):
+        dump(tmp_path, compress, stop_at=SIZE // 3, in_flight=in_flight)
+    checkpoint = read_checkpoint(tmp_path)
+    assert checkpoint["raw_offset"] >= SIZE // 3
+    # the last part is partial, it is hashed again on resume
+    assert compress is not None or checkpoint["offset"] % PART_SIZE != 0
+    checksums = dump(tmp_path, compress, resume=True, in_flight=in_flight)
+    assert not os.path.exists(tmp_path / CHECKPOINT_FILE)
+    assert read_dump(tmp_path, compress) == stream()
+    digests = [hash_file(path, "sha256")[0] for path in part_paths(tmp_path)]
+    assert checksums == {"algorithm": "sha256", "digests": digests}
+    if compress is None:
+        os.mkdir(tmp_path / "full")
+        assert dump(tmp_path / "full") == checksums
+
+
+# the parts written past the checkpoint before the dump was killed are dropped on resume
+def test_resume_after_kill(tmp_path):
+    with pytest.raises(DumpStopped):
+        dump(tmp_path, stop_at=SIZE // 3)
+    with open(part_paths(tmp_path)[-1], "ab") as f:
+        f.write(b"garbage")
+    dump(tmp_path, resume=True)
+    assert read_dump(tmp_path, None) == stream()
+
+
+def test_resume_changed_stream(tmp_path):
+    with pytest.raises(DumpStopped):
+        dump(tmp_path, stop_at=SIZE // 3)
+    with pytest.raises(StreamChanged, match="differs"):
+        dump(tmp_path, resume=True, seed=2)
+    with pytest.raises(StreamChanged, match="shorter"):
+        dump(tmp_path, resume=True, size=CHECKPOINT_SIZE // 2)
+
+
+def test_resume_missing_parts(tmp_path):
+    with pytest.raises(DumpStopped):
+        dump(tmp_path, stop_at=SIZE // 3)
+    os.remove(part_paths(tmp_path)[0])
+    with pytest.raises(StreamChanged, match="stored parts"):
+        dump(tmp_path, resume=True)
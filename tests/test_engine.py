@@ -0,0 +1,25 @@
+import pytest
+
+from snapdump import cli
+from snapdump.engine import ENGINE, CommandTimeout, run_command
+from snapdump.config import Config
+
+
+def test_command_timeout():
+    with pytest.raises(CommandTimeout):
+        ENGINE.run(run_command(["sleep", "5"], timeout=0.1))
+
+
+def test_no_timeout_by_default():
+    conf = Config(server=Config(hostname="zfs", ssh_user="root"))
+    assert cli.get_command_timeout(conf) == 0
+
+
+# a send estimate that times out is unknown, it does not fail the backup
+def test_send_estimate_timeout(monkeypatch):
+    def ssh_cmd(conf, command, stderr=None):
+        raise CommandTimeout("zfs send -nvP timed out")
+
+    monkeypatch.setattr(cli, "ssh_cmd", ssh_cmd)
+    assert cli.zfs_send_estimate(None, ["zfs", "send", "pool/data@b", "-i", "a"]) is None
+    assert cli.zfs_property_estimate(None, "pool/data", True) is None
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from snapdump.parts import PARTIAL_SUFFIX, PartWriter, part_index, part_suffix, truncate_parts
+
+PART_SIZE = 1000
+
+
+def parts(path):
+    return sorted(os.listdir(path))
+
+
+def read_parts(path):
+    return b"".join(open(f"{path}/{name}", "rb").read() for name in parts(path))
+
+
+@pytest.mark.parametrize(
+    "index, suffix",
+    [
+        (0, "aaa"),
+        (1, "aab"),
+        (26, "aba"),
+        (26**3 - 1, "zzz"),
+        (26**3, "zzzaaa"),
+        (2 * 26**3 - 1, "zzzzzz"),
+        (2 * 26**3, "zzzzzzaaa"),
+    ],
+)
+def test_part_suffix(index, suffix):
+    assert part_suffix(index) == suffix
+    assert part_index(suffix) == index
+
+
+# the parts sort by name in stream order past the three letter suffixes
+def test_part_suffix_order():
+    suffixes = [part_suffix(index) for index in range(26**3 - 5, 26**3 + 5)]
+    assert suffixes == sorted(suffixes)
+
+
+@pytest.mark.parametrize("in_flight", [1, 4])
+def test_write(tmp_path, in_flight):
+    data = os.urandom(3500)
+    writer = PartWriter(f"{tmp_path}/snap-part-", PART_SIZE, in_flight=in_flight, buffer_size=300)
+    writer.write(data)
+    writer.sync()
+    # the last part is not complete
+    assert parts(tmp_path)[-1] == f"snap-part-aad{PARTIAL_SUFFIX}"
+    writer.close()
+    assert parts(tmp_path) == ["snap-part-aaa", "snap-part-aab", "snap-part-aac", "snap-part-aad"]
+    assert read_parts(tmp_path) == data
+
+
+# an interrupted dump is truncated to its last checkpoint and continued from there
+@pytest.mark.parametrize("in_flight", [1, 4])
+def test_truncate_and_continue(tmp_path, in_flight):
+    data = os.urandom(3500)
+    writer = PartWriter(f"{tmp_path}/snap-part-", PART_SIZE, in_flight=in_flight)
+    writer.write(data[:2700])
+    writer.sync()
+    writer.abort()
+    assert truncate_parts(f"{tmp_path}/snap-part-", PART_SIZE, 1500)
+    assert parts(tmp_path) == ["snap-part-aaa", "snap-part-aab"]
+    assert os.path.getsize(tmp_path / "snap-part-aab") == 500
+    writer = PartWriter(f"{tmp_path}/snap-part-", PART_SIZE, offset=1500, in_flight=in_flight)
+    writer.write(data[1500:])
+    writer.close()
+    assert read_parts(tmp_path) == data
+
+
+# a complete part that was not renamed before the interruption is renamed
+def test_truncate_renames_complete_part(tmp_path):
+    for name, size in [("snap-part-aaa", PART_SIZE), (f"snap-part-aab{PARTIAL_SUFFIX}", PART_SIZE)]:
+        with open(tmp_path / name, "wb") as f:
+            f.write(b"x" * size)
+    assert truncate_parts(f"{tmp_path}/snap-part-", PART_SIZE, 2000)
+    assert parts(tmp_path) == ["snap-part-aaa", "snap-part-aab"]
+
+
+def test_truncate_missing_bytes(tmp_path):
+    with open(tmp_path / "snap-part-aaa", "wb") as f:
+        f.write(b"x" * 500)
+    assert not truncate_parts(f"{tmp_path}/snap-part-", PART_SIZE, 800)
+    assert not truncate_parts(f"{tmp_path}/snap-part-", PART_SIZE, 1200)
+    assert parts(tmp_path) == ["snap-part-aaa"]
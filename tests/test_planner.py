@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from snapdump import cli
+from snapdump.config import _to_config
+
+GB = 1024**3
+NOW = 1700000000
+
+
+def make_conf(directory, hostname="zfs"):
+    return _to_config(
+        {
+            "server": {"hostname": hostname, "ssh_user": "root"},
+            "backup": {
+                "directory": str(directory),
+                "datasets": ["pool/a", "pool/b"],
+                "interval_days": {"full": 30, "incremental": 1},
+                "retention_days": 90,
+            },
+        }
+    )
+
+
+# a dataset whose planning failed is reported with its error, not as not due
+def test_log_plan_failed(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(cli, "get_backup_space", lambda conf, now: (10 * GB, 0))
+    conf = make_conf(tmp_path)
+    results = [("pool/b", "failed", 0.0, Exception("cannot open 'pool/b'"))]
+    cli.log_backup_plan(conf, ["pool/a", "pool/b"], {}, [], [], results, NOW)
+    out = capsys.readouterr().out
+    assert "\tpool/a : not due until" in out
+    assert "\tpool/b : planning failed: cannot open 'pool/b'" in out
+    assert "pool/b : not due" not in out
+
+
+def plan(dataset, size):
+    return {"dataset": dataset, "size": size * GB}
+
+
+def sizes(plans):
+    return [x["size"] // GB for x in plans]
+
+
+@pytest.fixture
+def space(monkeypatch):
+    # directory -> (free bytes, bytes of the dumps past retention)
+    space = {}
+    monkeypatch.setattr(cli, "SPACE_RESERVED", {})
+    monkeypatch.setattr(cli, "get_backup_space", lambda conf, now: space[conf.backup.directory])
+    # the directories of the tests are on different file systems
+    monkeypatch.setattr(cli, "get_backup_target", lambda conf: conf.backup.directory)
+    return space
+
+
+# the largest dumps that fit are admitted first, the others are deferred
+def test_admit(tmp_path, space):
+    conf = make_conf(tmp_path)
+    space[str(tmp_path)] = (8 * GB, 0)
+    plans = [plan("pool/a", 2), plan("pool/b", 6), plan("pool/c", 3)]
+    admitted, deferred = cli.admit_dumps(conf, plans, NOW, dry_run=True)
+    assert sizes(admitted) == [6, 2]
+    assert sizes(deferred) == [3]
+    assert cli.SPACE_RESERVED == {}
+
+
+def test_admit_min_free_space(tmp_path, space):
+    conf = make_conf(tmp_path)
+    conf.backup["min_free_space"] = "3G"
+    space[str(tmp_path)] = (8 * GB, 0)
+    admitted, deferred = cli.admit_dumps(conf, [plan("pool/a", 6)], NOW, dry_run=True)
+    assert (admitted, sizes(deferred)) == ([], [6])
+
+
+# the dumps past retention count as free space, they are deleted before the dump that needs it
+def test_admit_expired(tmp_path, space, monkeypatch):
+    deleted = []
+    monkeypatch.setattr(
+        cli, "delete_expired_dump_dirs", lambda conf, dataset_dir, now: deleted.append(dataset_dir)
+    )
+    conf = make_conf(tmp_path)
+    for dataset in conf.backup.datasets:
+        os.mkdir(f"{tmp_path}/{cli.normalize_dataset_name(dataset)}")
+    space[str(tmp_path)] = (5 * GB, 4 * GB)
+    plans = [plan("pool/a", 3), plan("pool/b", 6), plan("pool/c", 1)]
+    admitted, deferred = cli.admit_dumps(conf, plans, NOW, dry_run=True)
+    assert (sizes(admitted), sizes(deferred)) == ([6, 3], [1])
+    assert deleted == []
+    admitted, deferred = cli.admit_dumps(conf, plans, NOW)
+    assert (sizes(admitted), sizes(deferred)) == ([6, 3], [1])
+    assert len(deleted) == 2
+
+
+# the running dumps reserve their space until they are done, on their file system only
+def test_admit_reserved(tmp_path, space):
+    conf = make_conf(tmp_path / "one")
+    other = make_conf(tmp_path / "two", hostname="other")
+    space[str(tmp_path / "one")] = (8 * GB, 0)
+    space[str(tmp_path / "two")] = (8 * GB, 0)
+    admitted, _ = cli.admit_dumps(conf, [plan("pool/a", 6)], NOW)
+    assert sizes(admitted) == [6]
+    _, deferred = cli.admit_dumps(conf, [plan("pool/b", 6)], NOW)
+    assert sizes(deferred) == [6]
+    admitted, _ = cli.admit_dumps(other, [plan("pool/b", 6)], NOW)
+    assert sizes(admitted) == [6]
+    cli.release_space(conf, "pool/a")
+    admitted, _ = cli.admit_dumps(conf, [plan("pool/b", 6)], NOW)
+    assert sizes(admitted) == [6]
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from snapdump.cli import get_rate_limit_settings
+from snapdump.config import _to_config
+from snapdump.ratelimit import RateLimiter
+
+MB = 1024 * 1024
+
+
+# time of the tests, sleeping advances it
+class Clock:
+    def __init__(self, hour, minute=0):
+        self.start = datetime(2026, 1, 1, hour, minute)
+        self.seconds = 0.0
+
+    def monotonic(self):
+        return self.seconds
+
+    def now(self):
+        return self.start + timedelta(seconds=self.seconds)
+
+    def sleep(self, seconds):
+        self.seconds += seconds
+
+
+def limiter(clock, rate=None, windows=None):
+    return RateLimiter(rate, windows, clock=clock.monotonic, now=clock.now, sleep=clock.sleep)
+
+
+def test_unlimited():
+    clock = Clock(12)
+    assert limiter(clock).consume(100 * MB) == 0.0
+    assert clock.seconds == 0.0
+
+
+def test_token_bucket():
+    clock = Clock(12)
+    bucket = limiter(clock, rate=10 * MB)
+    # the bucket starts empty, the stream goes at the rate
+    assert bucket.consume(5 * MB) == pytest.approx(0.5)
+    assert bucket.consume(10 * MB) == pytest.approx(1.0)
+    assert clock.seconds == pytest.approx(1.5)
+    # at most one second of unused bandwidth is saved up
+    clock.seconds += 60
+    assert bucket.consume(10 * MB) == 0.0
+    assert bucket.consume(5 * MB) == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize(
+    "hour, minute, rate",
+    [(7, 59, None), (8, 0, 10 * MB), (17, 59, 10 * MB), (18, 0, None), (23, 30, MB), (1, 0, MB)],
+)
+def test_windows(hour, minute, rate):
+    # business hours, and a window that wraps past midnight
+    windows = [(8 * 60, 18 * 60, 10 * MB), (23 * 60, 6 * 60, MB)]
+    assert limiter(Clock(hour, minute), windows=windows).current_rate() == rate
+
+
+# a running stream follows the rate of the window it is in
+def test_window_change():
+    clock = Clock(17, 59)
+    bucket = limiter(clock, windows=[(8 * 60, 18 * 60, 10 * MB)])
+    assert bucket.consume(10 * MB) == pytest.approx(1.0)
+    clock.seconds = 60
+    assert bucket.consume(100 * MB) == 0.0
+    # back in the window the next day, with one second of bandwidth saved up
+    clock.seconds = 24 * 3600 - 60
+    assert bucket.consume(20 * MB) == pytest.approx(1.0)
+
+
+def test_override():
+    clock = Clock(12)
+    bucket = limiter(clock, rate=10 * MB)
+    bucket.set_override(None)
+    assert bucket.consume(100 * MB) == 0.0
+    bucket.set_override(MB)
+    assert bucket.consume(MB) == pytest.approx(1.0)
+    bucket.reset_override()
+    assert bucket.current_rate() == 10 * MB
+
+
+def test_settings():
+    conf = _to_config(
+        {
+            "rate_limit": {
+                "rate": "unlimited",
+                "windows": [
+                    {"start": "08:00", "end": "18:00", "rate": "50M"},
+                    # yaml reads 22:30 as minutes
+                    {"start": 22 * 60 + 30, "end": "6:00", "rate": "1M"},
+                ],
+            }
+        }
+    )
+    assert get_rate_limit_settings(conf) == (
+        None,
+        [(8 * 60, 18 * 60, 50 * MB), (22 * 60 + 30, 6 * 60, MB)],
+    )
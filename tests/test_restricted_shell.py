@@ -0,0 +1,131 @@
+# Runs restricted_shell/allowed_backup_commands.py like sshd does, the allowed commands are executed
+# by the fake zfs of the benchmarks
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHELL = f"{REPO}/restricted_shell/allowed_backup_commands.py"
+FAKE_BIN = f"{REPO}/benchmarks/fakezfs/bin"
+
+
+@pytest.fixture
+def shell(tmp_path):
+    state = tmp_path / "state.json"
+    snapshots = [
+        {"name": name, "guid": guid, "creation": 1600000000 + guid}
+        for guid, name in enumerate("abc")
+    ]
+    with open(state, "w") as f:
+        json.dump({"storage/home": snapshots, "storage/vms/vm-101-disk-0": snapshots[:1]}, f)
+    env = dict(os.environ)
+    env.update(PATH=f"{FAKE_BIN}:{env['PATH']}", SNAPDUMP_FAKE_STATE=str(state))
+
+    def run(cmd, stdin=None):
+        env["SSH_ORIGINAL_COMMAND"] = cmd
+        ret = subprocess.run(
+            [sys.executable, SHELL],
+            env=env,
+            input=None if stdin is None else stdin.encode(),
+            stdin=subprocess.DEVNULL if stdin is None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        return ret.returncode, ret.stdout.decode(errors="replace")
+
+    return run
+
+
+def denied(result):
+    return result == (1, "Access denied\n")
+
+
+def unmanaged(result):
+    return result[0] == 1 and "is not in the list of managed datasets" in result[1]
+
+
+def test_list(shell):
+    assert shell("zfs list -H -t snapshot -o name -s creation -r storage/home")[0] == 0
+    assert denied(shell("zfs list storage/home; rm -rf /"))
+
+
+def test_snapshot(shell):
+    assert shell("zfs snapshot storage/home@d") == (0, "")
+    assert shell("zfs snapshot -r storage/vms@d") == (0, "")
+    # only the recursive datasets are snapshotted with their children
+    assert unmanaged(shell("zfs snapshot -r storage/home@d"))
+    assert unmanaged(shell("zfs snapshot tank/other@d"))
+    assert denied(shell("zfs snapshot storage/home@d storage/home@e"))
+
+
+def test_destroy(shell):
+    assert shell("zfs destroy -nvp storage/home@a%b,c")[0] == 0
+    assert shell("zfs destroy storage/home@a,c") == (0, "")
+    assert shell("zfs destroy storage/vms/vm-101-disk-0@a") == (0, "")
+    assert unmanaged(shell("zfs destroy tank/other@a"))
+    assert denied(shell("zfs destroy storage/home"))
+    assert denied(shell("zfs destroy -r storage/home@a"))
+    assert denied(shell("zfs destroy storage/home@a,tank/other@b"))
+
+
+def test_bookmark(shell):
+    assert shell("zfs bookmark storage/home@b storage/home#b") == (0, "")
+    assert shell("zfs destroy storage/home#b") == (0, "")
+    # the bookmark is named like its snapshot, in the same dataset
+    assert denied(shell("zfs bookmark storage/home@b storage/home#c"))
+    assert denied(shell("zfs bookmark storage/home@b storage/datasets01#b"))
+    assert unmanaged(shell("zfs bookmark tank/other@b tank/other#b"))
+
+
+def test_send(shell):
+    assert shell("zfs send -nvP -c storage/home@b -i a")[0] == 0
+    assert shell("zfs bookmark storage/home@a storage/home#a") == (0, "")
+    assert shell("zfs send -nvP storage/home@b -i 'storage/home#a'")[0] == 0
+    assert unmanaged(shell("zfs send -nvP tank/other@b"))
+    assert denied(shell("zfs send -R storage/home@b"))
+    assert denied(shell("zfs send storage/home@b > /tmp/stream"))
+
+
+def test_pipelines(shell):
+    assert shell("zfs send -nvP storage/home@b | gzip -3")[0] == 0
+    assert unmanaged(shell("zfs send tank/other@b | zstd -3 -T0"))
+    assert denied(shell("zfs send storage/home@b | sh"))
+    assert denied(shell("gunzip | sh"))
+    assert denied(shell("zfs send storage/home@b | gzip | gzip"))
+    # the compressors only take the flags snapdump sends
+    assert shell("zfs send -nvP storage/home@b | zstd -q -c -T0 --ultra -22")[0] == 0
+    assert not denied(shell("zfs send -nvP storage/home@b | pigz -p 4 -6"))
+    assert denied(shell("zfs send storage/home@b | zstd -ofile"))
+    assert denied(shell("zfs send storage/home@b | gzip -f"))
+    assert denied(shell("zstd -d -c -ofile | zfs recv -F storage/new"))
+
+
+def test_recv(shell):
+    assert not denied(shell("zfs recv -F -u tank/restore"))
+    assert denied(shell("zfs recv -A storage/home"))
+    assert denied(shell("zfs recv -s -F storage/home"))
+
+
+def test_agent(shell):
+    ops = [
+        {"op": "list", "dataset": "storage/home"},
+        {"op": "snapshot", "dataset": "storage/home", "snapshot": "d"},
+        {"op": "destroy", "dataset": "storage/home", "snapshots": "a%b", "dry_run": True},
+        {"op": "send", "dataset": "storage/home", "snapshot": "b", "base": "a", "flags": "-c"},
+        {"op": "list", "dataset": "tank/other"},
+        {"op": "snapshot", "dataset": "storage/home", "snapshot": "d; rm -rf /"},
+        {"op": "send", "dataset": "storage/home", "snapshot": "b", "flags": "-R"},
+        {"op": "rollback", "dataset": "storage/home"},
+    ]
+    code, out = shell("snapdump-agent", json.dumps({"ops": ops}))
+    assert code == 0
+    results = json.loads(out)["results"]
+    assert [x["name"] for x in results[0]["snapshots"]] == [f"storage/home@{x}" for x in "abc"]
+    assert results[1] == {"ok": True}
+    assert results[2] == {"ok": True, "reclaim": 2 * 4096}
+    assert results[3]["ok"] and results[3]["size"] > 0
+    assert [x["ok"] for x in results[4:]] == [False] * 4
+    assert shell("snapdump-agent", "not json") == (1, "Invalid agent request\n")
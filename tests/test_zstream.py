@@ -0,0 +1,58 @@
+# Parses the streams of the fake zfs of the benchmarks (benchmarks/fakezfs/stream.py)
+import io
+import os
+import sys
+
+import pytest
+
+from snapdump import zstream
+from snapdump.zstream import RECORD_SIZE, StreamError, parse_stream
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, f"{REPO}/benchmarks/fakezfs")
+
+import stream  # noqa: E402
+
+
+def generate(base=None):
+    out = io.BytesIO()
+    stream.generate(out, "tank/data", "b", base, 1024 * 1024, 0.5, 0.1, 4)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("base", [None, "a"])
+def test_parse(base):
+    data = generate(base)
+    result = parse_stream(io.BytesIO(data), read_size=1000)
+    assert result["toguid"] == stream.guid_of("tank/data@b")
+    assert result["fromguid"] == (0 if base is None else stream.guid_of("tank/data@a"))
+    assert result["toname"] == "tank/data@b"
+    assert result["bytes"] == len(data)
+
+
+# the checksums of the python fallback match the ones of numpy
+def test_parse_without_numpy(monkeypatch):
+    data = generate()
+    checksum = parse_stream(io.BytesIO(data))["checksum"]
+    monkeypatch.setattr(zstream, "numpy", None)
+    assert parse_stream(io.BytesIO(data))["checksum"] == checksum
+
+
+def test_corrupted_payload():
+    data = bytearray(generate())
+    data[-RECORD_SIZE - 100] ^= 1
+    with pytest.raises(StreamError, match="checksum"):
+        parse_stream(io.BytesIO(bytes(data)))
+    # the corruption is only found by the checksums
+    parse_stream(io.BytesIO(bytes(data)), verify_checksums=False)
+
+
+def test_truncated():
+    data = generate()
+    with pytest.raises(StreamError, match="Truncated"):
+        parse_stream(io.BytesIO(data[: len(data) // 2]))
+
+
+def test_not_a_stream():
+    with pytest.raises(StreamError, match="invalid magic"):
+        parse_stream(io.BytesIO(bytes(RECORD_SIZE)))